@@ -0,0 +1,89 @@
+from uuid import UUID
+
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from .models import User
+from .user_state import is_user_active
+
+
+class ClaimsUser:
+    """
+    Authenticated user built from claims of the access token (id, username, is_verified, active key id) - no query is made to create it.
+    Any other attribute (email, check_password(), save(), ...) is taken from the User row, which is loaded on first such access.
+    Claims may be up to ACCESS_TOKEN_LIFETIME old - clients get a fresh token with every refresh and after changing their key.
+    """
+    is_authenticated = True
+    is_anonymous = False
+    is_active = True # ClaimsJWTAuthentication checks it (cached) on every request
+
+    def __init__(self, token):
+        self.token = token
+
+    @cached_property
+    def id(self):
+        return UUID(str(self.token[api_settings.USER_ID_CLAIM]))
+
+    @property
+    def pk(self):
+        return self.id
+
+    @cached_property
+    def username(self):
+        return self.token['username'] if 'username' in self.token else self.get_user().username # Tokens issued before claims were added
+
+    @cached_property
+    def is_verified(self):
+        return self.token['is_verified'] if 'is_verified' in self.token else self.get_user().is_verified
+
+    @cached_property
+    def active_key_id(self):
+        """Id of user's active UserKey when the token was issued (None if unknown). May be stale - requests resolve the key from db."""
+        active_key = self.token.get('active_key')
+        return UUID(active_key) if active_key else None
+
+    def get_user(self):
+        """User model instance - loaded once."""
+        if '_user' not in self.__dict__:
+            try:
+                self.__dict__['_user'] = User.objects.get(id=self.id)
+            except User.DoesNotExist:
+                raise AuthenticationFailed(_('User not found'), code='user_not_found')
+        return self.__dict__['_user']
+
+    def __getattr__(self, name): # Called only for attributes not defined above
+        if name.startswith('_') or name == 'token':
+            raise AttributeError(name)
+        return getattr(self.get_user(), name)
+
+    def __eq__(self, other):
+        return getattr(other, 'pk', None) == self.pk and isinstance(other, (ClaimsUser, User))
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    def __str__(self):
+        return self.username
+
+
+def load_user(user):
+    """User model instance of the authenticated user - row of ClaimsUser is loaded (once), User is returned as is."""
+    return user.get_user() if isinstance(user, ClaimsUser) else user
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication that doesn't load the user from db on every request - request.user is a ClaimsUser.
+    Only whether the user still exists and is active is checked, against cache (see accounts.user_state).
+    """
+
+    def get_user(self, validated_token):
+        if api_settings.USER_ID_CLAIM not in validated_token:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+        user = ClaimsUser(validated_token)
+        if not is_user_active(user.id): # Deleted and deactivated users lose access before their token expires
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        return user
@@ -0,0 +1,8 @@
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
+class KeyRotationConflict(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'Key rotation cannot be performed in its current state.'
+    default_code = 'key_rotation_conflict'
@@ -0,0 +1,50 @@
+from hashlib import sha256
+
+from django.conf import settings
+from django.db import transaction
+
+from app.caching import TwoLevelCache
+
+from .models import UserKey
+from .serializers import PublicKeySerializer
+
+
+public_key_cache = TwoLevelCache(
+    prefix='public_key',
+    maxsize=settings.USERS_KEY_CACHE_SIZE,
+    timeout=settings.USERS_KEY_CACHE_TIMEOUT,
+    local_timeout=settings.USERS_KEY_LOCAL_CACHE_TIMEOUT,
+)
+
+
+def get_public_keys(user_ids):
+    """
+    Serialized active public keys of given verified users, in order of `user_ids` (users without a key are left out).
+    Keys are read from cache, the missing ones are loaded with one query and cached.
+    """
+    cache_keys = {user_id: public_key_cache.make_key(user_id) for user_id in user_ids}
+    cached = public_key_cache.get_many(list(cache_keys.values()))
+    public_keys = {user_id: cached[cache_key] for user_id, cache_key in cache_keys.items() if cache_key in cached}
+
+    if missing := [user_id for user_id in user_ids if user_id not in public_keys]:
+        user_keys = UserKey.objects.active().filter(user__in=missing, user__is_verified=True).only('id', 'user', 'public_key', 'fingerprint')
+        loaded = {user_key.user_id: dict(PublicKeySerializer(user_key).data) for user_key in user_keys}
+        public_key_cache.set_many({cache_keys[user_id]: public_key for user_id, public_key in loaded.items()})
+        public_keys.update(loaded)
+
+    return [public_keys[user_id] for user_id in user_ids if user_id in public_keys]
+
+
+def public_keys_etag(public_keys):
+    """Strong ETag of key lookup response - keys are immutable, so it changes only when a user gets another key (fingerprint)."""
+    parts = sorted(f"{public_key['user']}:{public_key['id']}:{public_key['fingerprint']}" for public_key in public_keys)
+    return '"%s"' % sha256(','.join(parts).encode()).hexdigest()[:32]
+
+
+def invalidate_public_keys(user_ids):
+    """Drop cached public keys of given users. Must be called whenever user's key is created or deleted or user stops being verified."""
+    keys = [public_key_cache.make_key(user_id) for user_id in user_ids]
+    if not keys:
+        return
+    public_key_cache.delete_many(keys)
+    transaction.on_commit(lambda: public_key_cache.delete_many(keys)) # Drop again after commit - concurrent request could have cached the old key in the meantime
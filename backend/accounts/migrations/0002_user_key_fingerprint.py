@@ -0,0 +1,39 @@
+# Generated by Django 5.2.5 on 2026-10-17 18:42
+
+import django.contrib.postgres.indexes
+import django.db.models.functions.text
+from django.db import migrations, models
+from hashlib import sha256
+
+
+def fill_fingerprints(apps, schema_editor):
+    UserKey = apps.get_model('accounts', 'UserKey')
+    batch = []
+    for user_key in UserKey.objects.only('id', 'public_key').iterator(chunk_size=1000): # Keys are streamed - not all loaded in memory at once
+        user_key.fingerprint = sha256(bytes(user_key.public_key)).hexdigest()
+        batch.append(user_key)
+        if len(batch) == 1000:
+            UserKey.objects.bulk_update(batch, ['fingerprint'])
+            batch = []
+    UserKey.objects.bulk_update(batch, ['fingerprint'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userkey',
+            name='fingerprint',
+            field=models.CharField(default='', editable=False, max_length=64),
+        ),
+        migrations.RunPython(fill_fingerprints, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('username'), name='text_pattern_ops'), condition=models.Q(('is_verified', True)), name='user_directory_prefix_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.5 on 2026-10-17 18:48
+
+from django.db import migrations, models
+
+
+def deactivate_older_keys(apps, schema_editor):
+    """Users could have had many keys - only the latest one stays active."""
+    UserKey = apps.get_model('accounts', 'UserKey')
+    latest_keys = UserKey.objects.order_by('user_id', '-created_at').distinct('user_id').values('id')
+    UserKey.objects.exclude(id__in=latest_keys).update(is_active=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_user_key_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userkey',
+            name='is_active',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.RunPython(deactivate_older_keys, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='userkey',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_active', True)), fields=('user',), name='unique_active_user_key'),
+        ),
+    ]
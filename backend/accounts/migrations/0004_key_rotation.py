@@ -0,0 +1,24 @@
+# Generated by Django 5.2.5 on 2026-10-17 18:51
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_user_key_is_active'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KeyRotation',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='key_rotation', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('new_key', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_KEY_MODEL)),
+                ('old_key', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_KEY_MODEL)),
+            ],
+        ),
+    ]
@@ -1,12 +1,21 @@
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, UserManager
 from django.contrib.auth.validators import UnicodeUsernameValidator
+from django.contrib.postgres.indexes import OpClass
 from django.core.mail import send_mail
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.db import models
+from django.db.models import Q
+from django.db.models.functions import Upper
 
+from hashlib import sha256
 from uuid import uuid4
 
+def get_fingerprint(public_key):
+    return sha256(bytes(public_key)).hexdigest()
+
+
 class BaseUser(AbstractBaseUser, PermissionsMixin):
     """
     An abstract base class implementing a fully featured User model with
@@ -77,9 +86,22 @@ class User(BaseUser):
     def __str__(self) -> str:
         return self.username
 
+    @cached_property
+    def active_key(self):
+        """User's active UserKey (None if user has no key yet) - fetched once per instance with a lookup on the unique_active_user_key index."""
+        return self.keys.active().first()
+
     class Meta(BaseUser.Meta):
         swappable = "AUTH_USER_MODEL"
         ordering = ['username']
+        indexes = [
+            models.Index(OpClass(Upper('username'), name='text_pattern_ops'), condition=Q(is_verified=True), name='user_directory_prefix_idx'), # Case insensitive username prefix search in the directory (LIKE 'PREFIX%')
+        ]
+
+
+class UserKeyQuerySet(models.QuerySet):
+    def active(self):
+        return self.filter(is_active=True)
 
 
 class UserKey(models.Model):
@@ -88,8 +110,18 @@ class UserKey(models.Model):
     public_key = models.BinaryField(blank=False)
     private_key = models.BinaryField(blank=False)
     salt = models.BinaryField(blank=False)
+    fingerprint = models.CharField(max_length=64, default='', editable=False) # SHA-256 (hex) of public key - lets clients tell keys apart without downloading them
+    is_active = models.BooleanField(default=True) # Key that is used for new NoteItems - previous keys are kept so that NoteItems still wrapped with them can be decrypted
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = UserKeyQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        self.fingerprint = get_fingerprint(self.public_key)
+        if (update_fields := kwargs.get('update_fields')) is not None and 'public_key' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'fingerprint'}
+        super().save(*args, **kwargs)
+
     def clean(self):
         super().clean()
         for value in [self.public_key, self.private_key, self.salt]:
@@ -98,3 +130,17 @@ class UserKey(models.Model):
 
     class Meta:
         swappable = "AUTH_USER_KEY_MODEL"
+        constraints = [
+            models.UniqueConstraint(fields=['user'], condition=Q(is_active=True), name='unique_active_user_key'), # At most one active key per user - also the index active key lookups use
+        ]
+
+
+class KeyRotation(models.Model):
+    """
+    User's key rotation in progress. Symmetric keys of user's NoteItems re-wrapped with `new_key` are staged on the NoteItems
+    (in batches, so it can be resumed) while `old_key` stays active - on commit they are swapped in and `new_key` becomes active at once.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='key_rotation') # One rotation per user at a time
+    old_key = models.ForeignKey(UserKey, on_delete=models.CASCADE, related_name='+')
+    new_key = models.OneToOneField(UserKey, on_delete=models.CASCADE, related_name='+') # Pending (inactive) key - deleting it cancels the rotation
+    created_at = models.DateTimeField(auto_now_add=True)
@@ -0,0 +1,76 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+
+from django.conf import settings
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class UserDirectoryPagination(BasePagination):
+    """
+    Keyset pagination of users ordered by (unique) username - every page is one index range scan no matter how deep the client is.
+    Always paginated, response is `{"next": <url>, "results": [...]}`.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+
+        queryset = queryset.order_by('username')
+        if username := self.decode_cursor(request):
+            queryset = queryset.filter(username__gt=username) # Seek past the last user of the previous page
+
+        page = list(queryset[:self.page_size + 1]) # Fetch one extra row to know if there is a next page without running COUNT(*)
+        self.has_next = len(page) > self.page_size
+        self.page = page[:self.page_size]
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(request.query_params[self.page_size_query_param], strict=True, cutoff=settings.USERS_DIRECTORY_MAX_PAGE_SIZE)
+        except (KeyError, ValueError):
+            return settings.USERS_DIRECTORY_PAGE_SIZE
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            username = json.loads(urlsafe_b64decode(encoded.encode('ascii')))
+        except (TypeError, ValueError, BinasciiError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(username, str):
+            raise NotFound(self.invalid_cursor_message)
+        return username
+
+    def encode_cursor(self, user):
+        return urlsafe_b64encode(json.dumps(user.username).encode(settings.DEFAULT_ENCODING)).decode('ascii')
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.page_size_query_param, self.page_size)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
@@ -0,0 +1,96 @@
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+
+from .exceptions import KeyRotationConflict
+from .key_cache import invalidate_public_keys
+from .models import KeyRotation, User, UserKey
+
+
+def get_note_item_model():
+    return apps.get_model('notes', 'NoteItem') # Resolved lazily - notes app depends on accounts, not the other way round
+
+
+def encrypted_note_items(rotation):
+    """NoteItems whose symmetric key has to be re-wrapped for the rotation - encrypted notes the old key has access to."""
+    return get_note_item_model().objects.filter(user_key=rotation.old_key_id, note__is_encrypted=True)
+
+
+def lock_key_holders(user_ids):
+    """
+    Lock rows of given users until the current transaction ends, so that none of their key rotations commits meanwhile. Taken by every
+    path that writes keys wrapped for a user's active key to NoteItems, commit_rotation takes the same lock before checking staged keys.
+    """
+    list(User.objects.select_for_update().filter(id__in=user_ids).order_by('id').values_list('id', flat=True)) # Locked in id order to avoid deadlocks
+
+
+def start_rotation(user_id, key_data):
+    """Create pending (inactive) key of the user and start rotating to it. Fails if user has no active key or a rotation is already in progress."""
+    with transaction.atomic():
+        user = User.objects.select_for_update().get(id=user_id) # Serializes rotation starts (and key creation) of the user
+        if KeyRotation.objects.filter(user=user).exists():
+            raise KeyRotationConflict('Key rotation is already in progress. Commit or cancel it first.')
+        if not (old_key := user.keys.active().first()):
+            raise KeyRotationConflict('User has no active key to rotate.')
+
+        new_key = UserKey.objects.create(user=user, is_active=False, **key_data)
+        get_note_item_model().objects.filter(user_key=old_key, pending_encryption_key__isnull=False).update(pending_encryption_key=None) # Leftovers of a cancelled rotation
+        return KeyRotation.objects.create(user=user, old_key=old_key, new_key=new_key)
+
+
+def get_progress(rotation):
+    """Number of keys to re-wrap and already staged - counted with one query, so the client can resume the rotation any time."""
+    counts = encrypted_note_items(rotation).aggregate(total=Count('id'), rewrapped=Count('id', filter=Q(pending_encryption_key__isnull=False)))
+    return {
+        'old_key': rotation.old_key_id,
+        'new_key': rotation.new_key_id,
+        'created_at': rotation.created_at,
+        'total': counts['total'],
+        'rewrapped': counts['rewrapped'],
+        'remaining': counts['total'] - counts['rewrapped'],
+    }
+
+
+def get_pending_keys(rotation, limit):
+    """(note_id, encryption_key) of NoteItems not re-wrapped yet. Staged ones drop out, so asking again after each batch needs no cursor."""
+    return list(encrypted_note_items(rotation).filter(pending_encryption_key__isnull=True).order_by('note_id').values_list('note_id', 'encryption_key')[:limit])
+
+
+def stage_keys(rotation, keys):
+    """
+    Stage re-wrapped keys given as {note_id: encryption_key}. Keys are written with bulk_update in chunks of
+    `USERS_KEY_ROTATION_CHUNK_SIZE` rows, each in its own short transaction. Staging a key again overwrites it. Returns number of staged keys.
+    """
+    note_items = list(encrypted_note_items(rotation).filter(note__in=keys).only('id', 'note_id'))
+    for note_item in note_items:
+        note_item.pending_encryption_key = keys[note_item.note_id]
+
+    chunk_size = settings.USERS_KEY_ROTATION_CHUNK_SIZE
+    for start in range(0, len(note_items), chunk_size):
+        with transaction.atomic():
+            get_note_item_model().objects.bulk_update(note_items[start:start + chunk_size], ['pending_encryption_key'])
+    return len(note_items)
+
+
+def commit_rotation(user_id):
+    """Swap staged keys in and make the new key active - all in one transaction. Fails if some key was not re-wrapped yet."""
+    with transaction.atomic():
+        lock_key_holders([user_id]) # Concurrent share can neither add a key for the old key nor replace a staged one until the keys are moved
+        rotation = KeyRotation.objects.select_for_update().select_related('old_key', 'new_key').get(user=user_id) # Concurrent commit/cancel waits and then finds no rotation
+        if remaining := encrypted_note_items(rotation).filter(pending_encryption_key__isnull=True).count():
+            raise KeyRotationConflict(f'{remaining} note keys are not re-wrapped yet.')
+
+        get_note_item_model().move_to_key(rotation.old_key, rotation.new_key)
+        UserKey.objects.filter(pk=rotation.old_key_id).update(is_active=False) # Old key is retained (inactive) - it is the only way a key gets replaced
+        UserKey.objects.filter(pk=rotation.new_key_id).update(is_active=True)
+        rotation.delete()
+        invalidate_public_keys([user_id])
+    return rotation.new_key
+
+
+def cancel_rotation(user_id):
+    with transaction.atomic():
+        rotation = KeyRotation.objects.select_for_update().get(user=user_id)
+        get_note_item_model().objects.filter(user_key=rotation.old_key_id, pending_encryption_key__isnull=False).update(pending_encryption_key=None)
+        UserKey.objects.filter(pk=rotation.new_key_id).delete() # Rotation is deleted with its pending key
@@ -1,7 +1,9 @@
 from django.conf import settings
+from django.db import transaction
 from rest_framework import serializers
 
-from .models import User, UserKey
+from .exceptions import KeyRotationConflict
+from .models import User, UserKey, KeyRotation
 
 class UserCreateSerializer(serializers.ModelSerializer):
     class Meta:
@@ -22,15 +24,15 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ['id', 'username', 'email', 'public_key', 'private_key', 'salt']
 
     def get_public_key(self, obj):
-        key = obj.keys.first()
+        key = obj.active_key # Fetched once and reused by all key fields
         return key.public_key if key else None
 
     def get_private_key(self, obj):
-        key = obj.keys.first()
+        key = obj.active_key
         return key.private_key if key else None
 
     def get_salt(self, obj):
-        key = obj.keys.first()
+        key = obj.active_key
         return key.salt if key else None
 
 class UserUpdateSerializer(serializers.ModelSerializer):
@@ -77,8 +79,13 @@ class UserKeySerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         try:
             user_id = self.context.get('user_id', None)
-            user = User.objects.get(id=user_id)
-            user_key = UserKey.objects.create(user=user, **validated_data)
+            with transaction.atomic():
+                user = User.objects.select_for_update().get(id=user_id) # Serializes key creation of the user so that only one key ends up active
+                if KeyRotation.objects.filter(user=user).exists():
+                    raise serializers.ValidationError({'detail': 'Key rotation is in progress. Commit or cancel it first.'})
+                if user.keys.active().exists(): # NoteItems are wrapped with the active key - replacing it without re-wrapping them would lose access to every note
+                    raise KeyRotationConflict('User already has an active key. Replace it with key rotation (`rotation/`).')
+                user_key = UserKey.objects.create(user=user, **validated_data)
             return user_key
         except User.DoesNotExist:
             raise serializers.ValidationError({'detail': 'User must first be logged in and have valid JSON Web Token in header'})
@@ -102,6 +109,65 @@ class UserKeySerializer(serializers.ModelSerializer):
             data['salt'] = base64.b64encode(bytes(instance.salt)).decode('ascii')
         return data
 
+def decode_public_key(public_key):
+    """Public key as sent by the client - keys are stored as UTF-8 (PEM / base64) text, anything else is returned base64 encoded."""
+    public_key_bytes = bytes(public_key)
+    try:
+        return public_key_bytes.decode(settings.DEFAULT_ENCODING)
+    except UnicodeDecodeError:
+        import base64
+        return base64.b64encode(public_key_bytes).decode('ascii')
+
+class UserDirectorySerializer(serializers.ModelSerializer):
+    """Entry of the user directory - public key itself is fetched only for users the note is actually shared with."""
+    fingerprint = serializers.CharField(read_only=True) # Annotated by the view - fingerprint of user's active key
+
+    class Meta:
+        model = User
+        fields = ['id', 'username', 'fingerprint']
+
+class PublicKeySerializer(serializers.ModelSerializer):
+    public_key = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UserKey
+        fields = ['id', 'user', 'public_key', 'fingerprint']
+
+    def get_public_key(self, obj):
+        return decode_public_key(obj.public_key)
+
+class PublicKeyLookupSerializer(serializers.Serializer):
+    users = serializers.CharField(required=True, allow_blank=False) # Comma separated ids of users
+
+    def validate_users(self, value):
+        ids = dict.fromkeys(id.strip() for id in value.split(',') if id.strip()) # Unique ids in order they were given
+        if len(ids) > settings.USERS_KEY_LOOKUP_MAX:
+            raise serializers.ValidationError(f'At most {settings.USERS_KEY_LOOKUP_MAX} users can be looked up at once.')
+        field = serializers.UUIDField()
+        return list(dict.fromkeys(field.run_validation(id) for id in ids))
+
+class KeyRotationSerializer(serializers.Serializer):
+    old_key = serializers.UUIDField()
+    new_key = serializers.UUIDField()
+    created_at = serializers.DateTimeField()
+    total = serializers.IntegerField() # Number of encrypted notes whose key has to be re-wrapped
+    rewrapped = serializers.IntegerField()
+    remaining = serializers.IntegerField()
+
+class RotationKeySerializer(serializers.Serializer):
+    note = serializers.UUIDField()
+    encryption_key = serializers.CharField(allow_blank=False) # Note's symmetric key wrapped with the new public key
+
+    def to_representation(self, instance):
+        note_id, encryption_key = instance
+        return {'note': str(note_id), 'encryption_key': str(encryption_key, settings.DEFAULT_ENCODING)}
+
+class RotationKeysSerializer(serializers.Serializer):
+    keys = RotationKeySerializer(many=True, allow_empty=False, max_length=settings.USERS_KEY_ROTATION_BATCH_SIZE)
+
+    def validate_keys(self, value):
+        return {key['note']: key['encryption_key'].encode(settings.DEFAULT_ENCODING) for key in value}
+
 class UserActivationSerializer(serializers.Serializer):
     email = serializers.EmailField(required=True, allow_blank=False)
     otp = serializers.IntegerField(required=True)
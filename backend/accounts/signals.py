@@ -0,0 +1,17 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import User
+from .user_state import invalidate_user_state
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, **kwargs):
+    """Keep cached active state in sync - `is_active` may have changed (no need to check, saving users is rare)."""
+    if not created:
+        invalidate_user_state([instance.pk])
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    invalidate_user_state([instance.pk])
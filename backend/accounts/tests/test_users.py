@@ -1,9 +1,22 @@
+import threading
+
 import pytest
 from model_bakery import baker
 from rest_framework import status
 from django.conf import settings
 
-from accounts.models import User, UserKey
+from django.db import IntegrityError, connection, transaction
+
+from rest_framework.test import APIRequestFactory
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from accounts.authentication import ClaimsJWTAuthentication, ClaimsUser
+from accounts.models import User, UserKey, KeyRotation
+from accounts.rotation import lock_key_holders
+from accounts.tokens import UserClaimsRefreshToken
+from accounts.user_state import is_user_active
+from notes.models import Note, NoteItem
 
 
 @pytest.mark.django_db
@@ -170,3 +183,407 @@ class TestUserKey:
             UserKey.objects.get(id=user_key.id)
 
 
+
+
+@pytest.mark.django_db
+class TestUserDirectory:
+
+    def make_user(self, username, is_verified=True, public_key=None):
+        user = baker.make(User, username=username, is_verified=is_verified)
+        if public_key is not None:
+            baker.make(UserKey, user=user, public_key=public_key.encode(settings.DEFAULT_ENCODING))
+        return user
+
+    def test_if_directory_listed_but_user_not_authenticated_returns_401(self, api_client):
+        response = api_client.get('/users/users/')
+
+        assert status.HTTP_401_UNAUTHORIZED == response.status_code
+
+    def test_if_directory_listed_returns_only_verified_users_with_keys(self, api_client, authenticate):
+        alice = self.make_user('alice', public_key='alice_key')
+        self.make_user('bob', public_key=None) # No key - can't be shared with
+        self.make_user('carol', is_verified=False, public_key='carol_key')
+        authenticate(api_client, alice)
+
+        response = api_client.get('/users/users/')
+
+        assert status.HTTP_200_OK == response.status_code
+        assert response.data == {
+            'next': None,
+            'results': [{'id': str(alice.id), 'username': 'alice', 'fingerprint': alice.keys.get().fingerprint}],
+        }
+
+    def test_if_user_has_many_keys_fingerprint_of_active_is_listed(self, api_client, authenticate):
+        user = self.make_user('alice', public_key='old_key')
+        user.keys.update(is_active=False)
+        new_key = baker.make(UserKey, user=user, public_key=b'new_key')
+        authenticate(api_client, user)
+
+        response = api_client.get('/users/users/')
+
+        assert [entry['fingerprint'] for entry in response.data['results']] == [new_key.fingerprint]
+
+    def test_if_directory_searched_returns_users_with_username_prefix(self, api_client, authenticate):
+        users = [self.make_user(username, public_key=f'{username}_key') for username in ['Alice', 'alfred', 'bob', 'malice']]
+        authenticate(api_client, users[0])
+
+        response = api_client.get('/users/users/', {'search': 'AL'})
+
+        assert status.HTTP_200_OK == response.status_code
+        assert [entry['username'] for entry in response.data['results']] == ['Alice', 'alfred']
+
+    def test_if_directory_paginated_returns_all_users_once(self, api_client, authenticate):
+        usernames = [f'user{index:02}' for index in range(7)]
+        users = [self.make_user(username, public_key=f'{username}_key') for username in usernames]
+        authenticate(api_client, users[0])
+
+        listed = []
+        response = api_client.get('/users/users/', {'page_size': 3})
+        while True:
+            assert status.HTTP_200_OK == response.status_code
+            assert len(response.data['results']) <= 3
+            listed += [entry['username'] for entry in response.data['results']]
+            if not response.data['next']:
+                break
+            response = api_client.get(response.data['next'])
+
+        assert listed == usernames
+
+    def test_if_cursor_invalid_returns_404(self, api_client, authenticate):
+        authenticate(api_client, self.make_user('alice', public_key='alice_key'))
+
+        response = api_client.get('/users/users/', {'cursor': 'not-a-cursor'})
+
+        assert status.HTTP_404_NOT_FOUND == response.status_code
+
+    def test_if_keys_looked_up_returns_active_public_key_of_verified_users(self, api_client, authenticate):
+        alice = self.make_user('alice', public_key='alice_old_key')
+        alice.keys.update(is_active=False)
+        alice_key = baker.make(UserKey, user=alice, public_key=b'alice_key')
+        bob = self.make_user('bob', public_key='bob_key')
+        carol = self.make_user('carol', is_verified=False, public_key='carol_key')
+        authenticate(api_client, alice)
+
+        response = api_client.get('/users/keys/lookup/', {'users': f'{alice.id},{bob.id},{carol.id}'})
+
+        assert status.HTTP_200_OK == response.status_code
+        keys = {entry['user']: entry for entry in response.data}
+        assert set(keys) == {alice.id, bob.id}
+        assert keys[alice.id] == {'id': str(alice_key.id), 'user': alice.id, 'public_key': 'alice_key', 'fingerprint': alice_key.fingerprint}
+        assert keys[bob.id]['public_key'] == 'bob_key'
+
+    def test_if_keys_looked_up_with_invalid_id_returns_400(self, api_client, authenticate):
+        authenticate(api_client, self.make_user('alice', public_key='alice_key'))
+
+        response = api_client.get('/users/keys/lookup/', {'users': 'not-an-id'})
+
+        assert status.HTTP_400_BAD_REQUEST == response.status_code
+
+    def test_if_too_many_keys_looked_up_returns_400(self, api_client, authenticate, settings):
+        settings.USERS_KEY_LOOKUP_MAX = 2
+        users = [self.make_user(f'user{index}', public_key=f'key{index}') for index in range(3)]
+        authenticate(api_client, users[0])
+
+        response = api_client.get('/users/keys/lookup/', {'users': ','.join(str(user.id) for user in users)})
+
+        assert status.HTTP_400_BAD_REQUEST == response.status_code
+
+
+@pytest.mark.django_db
+class TestPublicKeyLookup:
+
+    def make_user(self, username, public_key):
+        user = baker.make(User, username=username, is_verified=True)
+        user_key = baker.make(UserKey, user=user, public_key=public_key.encode(settings.DEFAULT_ENCODING))
+        return user, user_key
+
+    def test_if_keys_looked_up_response_carries_etag_and_cache_control(self, api_client, authenticate, settings):
+        user, user_key = self.make_user('alice', 'alice_key')
+        authenticate(api_client, user)
+
+        response = api_client.get('/users/keys/lookup/', {'users': str(user.id)})
+
+        assert status.HTTP_200_OK == response.status_code
+        assert response['ETag']
+        assert response['Cache-Control'] == f'private, max-age={settings.USERS_KEY_LOOKUP_MAX_AGE}'
+
+    def test_if_keys_looked_up_with_matching_etag_returns_304(self, api_client, authenticate):
+        user, user_key = self.make_user('alice', 'alice_key')
+        authenticate(api_client, user)
+        etag = api_client.get('/users/keys/lookup/', {'users': str(user.id)})['ETag']
+
+        response = api_client.get('/users/keys/lookup/', {'users': str(user.id)}, HTTP_IF_NONE_MATCH=etag)
+
+        assert status.HTTP_304_NOT_MODIFIED == response.status_code
+        assert response['ETag'] == etag
+
+    def test_if_keys_looked_up_again_they_are_served_from_cache(self, api_client, authenticate, django_assert_num_queries):
+        alice, alice_key = self.make_user('alice', 'alice_key')
+        bob, bob_key = self.make_user('bob', 'bob_key')
+        authenticate(api_client, alice)
+        api_client.get('/users/keys/lookup/', {'users': f'{alice.id},{bob.id}'})
+
+        with django_assert_num_queries(0):
+            response = api_client.get('/users/keys/lookup/', {'users': f'{bob.id},{alice.id}'})
+
+        assert [entry['public_key'] for entry in response.data] == ['bob_key', 'alice_key']
+
+    def test_if_key_deleted_and_created_lookup_returns_current_key(self, api_client, authenticate):
+        user, user_key = self.make_user('alice', 'alice_key')
+        authenticate(api_client, user)
+        etag = api_client.get('/users/keys/lookup/', {'users': str(user.id)})['ETag']
+
+        api_client.delete(f'/users/keys/{user_key.id}/')
+        response = api_client.get('/users/keys/lookup/', {'users': str(user.id)})
+
+        assert response.data == []
+
+        api_client.post('/users/keys/', {'public_key': 'new_key', 'private_key': 'private', 'salt': 'salt'})
+        response = api_client.get('/users/keys/lookup/', {'users': str(user.id)}, HTTP_IF_NONE_MATCH=etag)
+
+        assert status.HTTP_200_OK == response.status_code
+        assert response.data[0]['public_key'] == 'new_key'
+        assert response['ETag'] != etag
+
+
+@pytest.mark.django_db
+class TestActiveUserKey:
+
+    def test_if_key_created_while_active_key_exists_returns_409(self, api_client, authenticate):
+        user = baker.make(User)
+        authenticate(api_client, user)
+        old_key = baker.make(UserKey, user=user, public_key=b'old_key')
+        note_item = baker.make(NoteItem, user_key=old_key, permission='O')
+
+        response = api_client.post('/users/keys/', {'public_key': 'new_key', 'private_key': 'private', 'salt': 'salt'})
+
+        assert status.HTTP_409_CONFLICT == response.status_code # Key is replaced by rotation, which re-wraps NoteItems
+        assert user.keys.active().get() == old_key
+        assert user.keys.count() == 1
+        assert NoteItem.objects.get(id=note_item.id).user_key_id == old_key.id
+
+    def test_if_second_active_key_saved_raises_integrity_error(self):
+        user = baker.make(User)
+        baker.make(UserKey, user=user)
+
+        with pytest.raises(IntegrityError):
+            baker.make(UserKey, user=user)
+
+    def test_if_user_key_me_retrieved_returns_active_key(self, api_client, authenticate):
+        user = baker.make(User)
+        authenticate(api_client, user)
+        baker.make(UserKey, user=user, public_key=b'old_key', is_active=False)
+        active_key = baker.make(UserKey, user=user, public_key=b'active_key')
+
+        response = api_client.get('/users/keys/me/')
+
+        assert status.HTTP_200_OK == response.status_code
+        assert response.data['id'] == str(active_key.id)
+
+    def test_if_user_details_retrieved_key_is_fetched_once(self, api_client, django_assert_num_queries):
+        user = baker.make(User)
+        baker.make(UserKey, user=user, public_key=b'old_key', private_key=b'old_private_key', salt=b'old_salt', is_active=False)
+        baker.make(UserKey, user=user, public_key=b'active_key', private_key=b'private_key', salt=b'salt')
+        api_client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserClaimsRefreshToken.for_user(user).access_token}')
+        is_user_active(user.id) # Active state of the user is cached
+
+        with django_assert_num_queries(2): # User and their active key - authentication itself doesn't query
+            response = api_client.get('/users/users/me/')
+
+        assert bytes(response.data['public_key']) == b'active_key'
+
+
+@pytest.mark.django_db
+class TestKeyRotation:
+    new_keys = {'public_key': 'new_public_key', 'private_key': 'new_private_key', 'salt': 'new_salt'}
+
+    def make_user_with_notes(self, api_client, authenticate, encrypted=3, plaintext=1):
+        user = baker.make(User)
+        authenticate(api_client, user)
+        user_key = baker.make(UserKey, user=user)
+        for index in range(encrypted):
+            baker.make(NoteItem, note=baker.make(Note, owner=user, is_encrypted=True), user_key=user_key, encryption_key=f'old{index}'.encode(), permission='O')
+        for index in range(plaintext):
+            baker.make(NoteItem, note=baker.make(Note, owner=user, is_encrypted=False), user_key=user_key, encryption_key=None, permission='O')
+        return user, user_key
+
+    def rewrap(self, pending_keys):
+        return {'keys': [{'note': key['note'], 'encryption_key': key['encryption_key'].replace('old', 'new')} for key in pending_keys]}
+
+    def test_if_rotation_started_new_key_is_pending(self, api_client, authenticate):
+        user, user_key = self.make_user_with_notes(api_client, authenticate)
+
+        response = api_client.post('/users/keys/rotation/', self.new_keys)
+
+        assert status.HTTP_201_CREATED == response.status_code
+        assert response.data['old_key'] == str(user_key.id)
+        assert (response.data['total'], response.data['rewrapped'], response.data['remaining']) == (3, 0, 3)
+        assert UserKey.objects.get(id=response.data['new_key']).is_active is False
+        assert user.keys.active().get() == user_key
+
+    def test_if_rotation_started_twice_returns_409(self, api_client, authenticate):
+        self.make_user_with_notes(api_client, authenticate)
+        api_client.post('/users/keys/rotation/', self.new_keys)
+
+        response = api_client.post('/users/keys/rotation/', self.new_keys)
+
+        assert status.HTTP_409_CONFLICT == response.status_code
+
+    def test_if_rotation_started_without_key_returns_409(self, api_client, authenticate):
+        authenticate(api_client, baker.make(User))
+
+        response = api_client.post('/users/keys/rotation/', self.new_keys)
+
+        assert status.HTTP_409_CONFLICT == response.status_code
+
+    def test_if_key_created_during_rotation_returns_400(self, api_client, authenticate):
+        self.make_user_with_notes(api_client, authenticate)
+        api_client.post('/users/keys/rotation/', self.new_keys)
+
+        response = api_client.post('/users/keys/', self.new_keys)
+
+        assert status.HTTP_400_BAD_REQUEST == response.status_code
+
+    def test_if_all_keys_rewrapped_in_batches_rotation_commits(self, api_client, authenticate):
+        user, user_key = self.make_user_with_notes(api_client, authenticate)
+        new_key_id = api_client.post('/users/keys/rotation/', self.new_keys).data['new_key']
+
+        first_batch = api_client.get('/users/keys/rotation/pending/', {'limit': 2}).data
+        response = api_client.post('/users/keys/rotation/keys/', self.rewrap(first_batch), format='json')
+        assert status.HTTP_200_OK == response.status_code
+        assert (response.data['staged'], response.data['remaining']) == (2, 1)
+
+        assert status.HTTP_409_CONFLICT == api_client.post('/users/keys/rotation/commit/').status_code # One key is still missing
+
+        second_batch = api_client.get('/users/keys/rotation/pending/').data # Resumes where the first batch ended
+        assert len(second_batch) == 1 and second_batch[0]['note'] not in {key['note'] for key in first_batch}
+        api_client.post('/users/keys/rotation/keys/', self.rewrap(second_batch), format='json')
+        response = api_client.post('/users/keys/rotation/commit/')
+
+        assert status.HTTP_200_OK == response.status_code
+        assert response.data['id'] == new_key_id
+        assert str(user.keys.active().get().id) == new_key_id
+        user_key.refresh_from_db()
+        assert user_key.is_active is False # Retained
+        note_items = NoteItem.objects.filter(note__owner=user)
+        assert {str(note_item.user_key_id) for note_item in note_items} == {new_key_id} # Plaintext notes are moved as well
+        assert sorted(bytes(note_item.encryption_key) for note_item in note_items if note_item.encryption_key) == [b'new0', b'new1', b'new2']
+        assert not KeyRotation.objects.filter(user=user).exists()
+
+    @pytest.mark.django_db(transaction=True) # Share and commit run in concurrent transactions
+    def test_if_note_shared_while_rotation_commits_commit_waits_and_returns_409(self, api_client, authenticate):
+        user, user_key = self.make_user_with_notes(api_client, authenticate, encrypted=1, plaintext=0)
+        api_client.post('/users/keys/rotation/', self.new_keys)
+        api_client.post('/users/keys/rotation/keys/', self.rewrap(api_client.get('/users/keys/rotation/pending/').data), format='json')
+        shared, committing = threading.Event(), threading.Event()
+
+        def share_in_other_transaction(): # Same as share endpoint - new NoteItem holds symmetric key wrapped for user's old key
+            with transaction.atomic():
+                lock_key_holders([user.id])
+                baker.make(NoteItem, note=baker.make(Note, is_encrypted=True), user_key=user_key, encryption_key=b'old_shared', permission='R')
+                shared.set()
+                committing.wait(timeout=10)
+            connection.close()
+
+        thread = threading.Thread(target=share_in_other_transaction)
+        thread.start()
+        shared.wait(timeout=10)
+        threading.Timer(0.2, committing.set).start()
+        response = api_client.post('/users/keys/rotation/commit/') # Waits until the share commits
+        thread.join()
+
+        assert status.HTTP_409_CONFLICT == response.status_code
+        assert user.keys.active().get() == user_key
+
+    def test_if_rotation_cancelled_pending_key_and_staged_keys_are_dropped(self, api_client, authenticate):
+        user, user_key = self.make_user_with_notes(api_client, authenticate)
+        new_key_id = api_client.post('/users/keys/rotation/', self.new_keys).data['new_key']
+        api_client.post('/users/keys/rotation/keys/', self.rewrap(api_client.get('/users/keys/rotation/pending/').data), format='json')
+
+        response = api_client.delete('/users/keys/rotation/')
+
+        assert status.HTTP_204_NO_CONTENT == response.status_code
+        assert not UserKey.objects.filter(id=new_key_id).exists()
+        assert not NoteItem.objects.filter(pending_encryption_key__isnull=False).exists()
+        assert status.HTTP_404_NOT_FOUND == api_client.get('/users/keys/rotation/').status_code
+
+
+@pytest.mark.django_db
+class TestClaimsAuthentication:
+
+    def make_verified_user(self):
+        user = User.objects.create_user(username='alice', email='alice@domain.com', password='alice1234', is_verified=True)
+        user_key = baker.make(UserKey, user=user)
+        return user, user_key
+
+    def authenticate_with_token(self, token):
+        request = APIRequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {token}')
+        return ClaimsJWTAuthentication().authenticate(request)[0]
+
+    def test_if_tokens_obtained_access_token_carries_user_claims(self, api_client):
+        user, user_key = self.make_verified_user()
+
+        response = api_client.post('/users/jwt/create/', {'username': 'alice', 'password': 'alice1234'})
+
+        assert status.HTTP_200_OK == response.status_code
+        token = AccessToken(response.data['access'])
+        assert (token['username'], token['is_verified'], token['active_key']) == ('alice', True, str(user_key.id))
+
+    def test_if_request_authenticated_user_is_built_from_claims_without_query(self, django_assert_num_queries):
+        user, user_key = self.make_verified_user()
+        token = UserClaimsRefreshToken.for_user(user).access_token
+        self.authenticate_with_token(token) # Caches active state of the user
+
+        with django_assert_num_queries(0):
+            claims_user = self.authenticate_with_token(token)
+            assert isinstance(claims_user, ClaimsUser)
+            assert (claims_user.id, claims_user.username, claims_user.is_verified, claims_user.active_key_id) == (user.id, 'alice', True, user_key.id)
+
+        with django_assert_num_queries(1): # Other attributes load the user once
+            assert claims_user.email == 'alice@domain.com'
+            assert claims_user.check_password('alice1234')
+
+    @pytest.mark.parametrize('deleted', [True, False])
+    def test_if_user_deleted_or_deactivated_token_is_rejected(self, deleted):
+        user, user_key = self.make_verified_user()
+        token = UserClaimsRefreshToken.for_user(user).access_token
+        self.authenticate_with_token(token) # Active state is cached
+
+        if deleted:
+            user.delete()
+        else:
+            user.is_active = False
+            user.save()
+
+        with pytest.raises(AuthenticationFailed):
+            self.authenticate_with_token(token)
+
+    def test_if_token_has_no_claims_user_is_loaded_for_them(self, django_assert_num_queries):
+        user, user_key = self.make_verified_user()
+        claims_user = self.authenticate_with_token(RefreshToken.for_user(user).access_token) # Token issued before claims were added
+
+        with django_assert_num_queries(1):
+            assert claims_user.username == 'alice'
+        assert claims_user.active_key_id is None
+
+    def test_if_key_created_response_carries_token_with_new_active_key(self, api_client):
+        user, user_key = self.make_verified_user()
+        api_client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserClaimsRefreshToken.for_user(user).access_token}')
+        user_key.delete() # E.g. deleted on another device
+
+        response = api_client.post('/users/keys/', {'public_key': 'new_key', 'private_key': 'private', 'salt': 'salt'})
+
+        assert status.HTTP_201_CREATED == response.status_code
+        assert AccessToken(response.data['access_token'])['active_key'] == response.data['id']
+
+    def test_if_token_refreshed_claims_are_read_again(self, api_client):
+        user, user_key = self.make_verified_user()
+        refresh_token = UserClaimsRefreshToken.for_user(user)
+        user.keys.update(is_active=False)
+        new_key = baker.make(UserKey, user=user)
+        api_client.cookies['refresh_token'] = str(refresh_token)
+
+        response = api_client.post('/users/jwt/refresh/', {}, format='json')
+
+        assert status.HTTP_200_OK == response.status_code
+        assert AccessToken(response.data['access'])['active_key'] == str(new_key.id)
@@ -0,0 +1,44 @@
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from .models import User
+
+
+def set_user_claims(token, user):
+    """Embed what most requests need to know about the user in the token - ClaimsJWTAuthentication builds request.user from it without a query."""
+    token['username'] = user.username
+    token['is_verified'] = user.is_verified
+    token['active_key'] = str(user.active_key.pk) if user.active_key else None
+
+
+class UserClaimsRefreshToken(RefreshToken):
+    """Refresh token carrying user claims - access tokens made from it copy them."""
+
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        set_user_claims(token, user)
+        return token
+
+
+def issue_access_token(user):
+    """New access token with current claims of the user, e.g. after user's active key changed."""
+    token = AccessToken.for_user(user)
+    set_user_claims(token, user)
+    return str(token)
+
+
+class UserClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    token_class = UserClaimsRefreshToken
+
+
+class UserClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    """Refresh access token with claims read from db again - claims of an access token are at most ACCESS_TOKEN_LIFETIME old."""
+
+    def validate(self, attrs):
+        data = super().validate(attrs)
+        access = AccessToken(data['access'])
+        set_user_claims(access, User.objects.get(**{api_settings.USER_ID_FIELD: access[api_settings.USER_ID_CLAIM]}))
+        data['access'] = str(access)
+        return data
@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.db import transaction
+
+from app.caching import TwoLevelCache, MISSING
+
+from .models import User
+
+
+user_state_cache = TwoLevelCache(
+    prefix='user_active',
+    maxsize=settings.USERS_STATE_CACHE_SIZE,
+    timeout=settings.USERS_STATE_CACHE_TIMEOUT,
+    local_timeout=settings.USERS_STATE_LOCAL_CACHE_TIMEOUT,
+)
+
+
+def is_user_active(user_id):
+    """Whether the user still exists and is active - read from cache, loaded with one (indexed) query on cache miss."""
+    cache_key = user_state_cache.make_key(user_id)
+    is_active = user_state_cache.get(cache_key)
+    if is_active is MISSING:
+        is_active = User.objects.filter(id=user_id, is_active=True).exists()
+        user_state_cache.set(cache_key, is_active)
+    return is_active
+
+
+def invalidate_user_state(user_ids):
+    """Drop cached active state of given users. Must be called whenever a user is deleted or their `is_active` changes."""
+    keys = [user_state_cache.make_key(user_id) for user_id in user_ids]
+    user_state_cache.delete_many(keys)
+    transaction.on_commit(lambda: user_state_cache.delete_many(keys)) # Drop again after commit - concurrent request could have cached the old state in the meantime
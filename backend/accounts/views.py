@@ -4,9 +4,13 @@ import string
 from django.shortcuts import get_object_or_404
 from django.core.cache import cache
 from django.conf import settings
+from django.db.models import OuterRef, Subquery
+from django.utils.http import parse_etags
 from rest_framework import status
 from rest_framework import serializers
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import _positive_int
 from rest_framework.mixins import CreateModelMixin, ListModelMixin, RetrieveModelMixin, UpdateModelMixin, DestroyModelMixin
 from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
@@ -14,14 +18,19 @@ from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenVerifyView, TokenRefreshView
 from rest_framework_simplejwt.tokens import RefreshToken
-from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 
-from .models import User, UserKey
+from .models import User, UserKey, KeyRotation
 from .serializers import UserCreateSerializer, UserSerializer, UserUpdateSerializer, UserKeySerializer, \
-                        UserActivationSerializer, ResendActivationEmailSerializer
+                        UserActivationSerializer, ResendActivationEmailSerializer, UserDirectorySerializer, \
+                        PublicKeyLookupSerializer, KeyRotationSerializer, RotationKeySerializer, RotationKeysSerializer
 from .account_activation import verify_activation_key
 from .tasks import send_verification_mail
 from .permissions import HasEmailVerifiedPermission
+from .pagination import UserDirectoryPagination
+from .key_cache import get_public_keys, public_keys_etag, invalidate_public_keys
+from .authentication import load_user
+from .tokens import UserClaimsRefreshToken, UserClaimsTokenObtainPairSerializer, UserClaimsTokenRefreshSerializer, issue_access_token
+from .rotation import start_rotation, get_progress, get_pending_keys, stage_keys, commit_rotation, cancel_rotation
 
 
 class UserViewSet(CreateModelMixin, ListModelMixin, GenericViewSet): # No retrive action here
@@ -37,32 +46,22 @@ class UserViewSet(CreateModelMixin, ListModelMixin, GenericViewSet): # No retriv
         return [IsAuthenticated()]
 
     def list(self, request, *args, **kwargs):
-        users = User.objects.prefetch_related('keys').all()
-
-        users_data = []
-        for user in users:
-            if not user.is_verified:
-                continue
-
-            user_key = user.keys.first() # Assuming one UserKey per User
-            if not user_key or not user_key.public_key:
-                continue
-
-            try:
-                public_key_bytes = bytes(user_key.public_key)
-                public_key_decoded = public_key_bytes.decode(settings.DEFAULT_ENCODING)
-                user_data = {
-                    'id': str(user.id),
-                    'username': user.username,
-                    'public_key': public_key_decoded
-                }
-            except UnicodeDecodeError:
-                import base64
-                user_data['public_key'] = base64.b64decode(public_key_bytes).decode('ascii')
+        """
+        Directory of verified users having an active key, ordered by username: `{"next": <url>, "results": [{"id", "username", "fingerprint"}]}`.
+        Query params: `search` (case insensitive username prefix), `page_size`, `cursor`. Public keys themselves are fetched with `/users/keys/lookup/`.
+        """
+        active_key = UserKey.objects.active().filter(user=OuterRef('pk'))
+        users = User.objects.filter(is_verified=True) \
+            .annotate(fingerprint=Subquery(active_key.values('fingerprint')[:1])) \
+            .filter(fingerprint__isnull=False) \
+            .only('id', 'username')
 
-            users_data.append(user_data)
+        if search := request.query_params.get('search', '').strip():
+            users = users.filter(username__istartswith=search) # UPPER(username) LIKE 'PREFIX%' - uses user_directory_prefix_idx
 
-        return Response(users_data, status=status.HTTP_200_OK)
+        paginator = UserDirectoryPagination()
+        page = paginator.paginate_queryset(users, request, view=self)
+        return paginator.get_paginated_response(UserDirectorySerializer(page, many=True).data)
 
     def _make_otp(self, email):
         otp = ''.join([random.choice(string.digits) for _ in range(6)])
@@ -96,7 +95,7 @@ class UserViewSet(CreateModelMixin, ListModelMixin, GenericViewSet): # No retriv
         PUT: Chagnes data about specific user
         DELETE: Deletes specific user
         """
-        user = get_object_or_404(User, id=request.user.id)
+        user = load_user(request.user) # Authentication doesn't load the user - it's loaded here just once
         if request.method == 'GET':
             serializer = UserSerializer(user)
             return Response(serializer.data, status=status.HTTP_200_OK)
@@ -116,6 +115,7 @@ class UserViewSet(CreateModelMixin, ListModelMixin, GenericViewSet): # No retriv
             if original_email != new_email:
                 user.is_verified = False
                 user.save()
+                invalidate_public_keys([user.id]) # Keys of unverified users are not served
 
                 otp = self._make_otp(new_email)
                 send_verification_mail.delay(otp, new_username, new_email)
@@ -123,11 +123,12 @@ class UserViewSet(CreateModelMixin, ListModelMixin, GenericViewSet): # No retriv
             return Response(serializer.data, status=status.HTTP_200_OK)
         elif request.method == 'DELETE':
             user.delete()
+            invalidate_public_keys([user.id])
             return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(detail=False, methods=['POST'], permission_classes=[IsAuthenticated])
     def change_password(self, request):
-        user = request.user
+        user = load_user(request.user)
         current_password = request.data.get('currentPassword')
         new_password = request.data.get('newPassword')
 
@@ -148,9 +149,100 @@ class UserKeyViewSet(CreateModelMixin, RetrieveModelMixin, DestroyModelMixin, Ge
         context.update({'user_id': self.request.user.id})
         return context
 
+    def create(self, request, *args, **kwargs):
+        response = super().create(request, *args, **kwargs)
+        response.data['access_token'] = issue_access_token(load_user(request.user)) # Claims of the current token carry no (or a deleted) key
+        return response
+
+    def perform_create(self, serializer):
+        user_key = serializer.save()
+        invalidate_public_keys([user_key.user_id])
+
+    def perform_destroy(self, instance):
+        instance.delete()
+        invalidate_public_keys([instance.user_id])
+
+    @action(detail=False, methods=['GET'])
+    def lookup(self, request):
+        """
+        Public keys of users given as `?users=<id>,<id>` - active key of every verified user, unknown users are left out.
+        Keys are served from cache. Response carries ETag and may be reused by the client for `USERS_KEY_LOOKUP_MAX_AGE` seconds,
+        after that client revalidates it with If-None-Match and gets 304 unless some of the users got another key.
+        """
+        serializer = PublicKeyLookupSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+
+        public_keys = get_public_keys(serializer.validated_data['users'])
+        etag = public_keys_etag(public_keys)
+        headers = {'ETag': etag, 'Cache-Control': f'private, max-age={settings.USERS_KEY_LOOKUP_MAX_AGE}'}
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(public_keys, status=status.HTTP_200_OK, headers=headers)
+
+    @action(detail=False, methods=['GET', 'POST', 'DELETE'])
+    def rotation(self, request):
+        """
+        Rotation of user's keypair:
+        GET: Progress of the rotation in progress
+        POST: Start rotation - upload new keys (same as creating a key), they stay inactive until the rotation is committed
+        DELETE: Cancel rotation and drop the new keys
+
+        Then repeatedly fetch `rotation/pending/`, re-wrap the keys with the new public key and send them to `rotation/keys/`
+        until nothing is pending and finish with `rotation/commit/`. Progress is kept on the server, so the rotation can be resumed any time.
+        """
+        if request.method == 'POST':
+            serializer = UserKeySerializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+            rotation = start_rotation(request.user.id, serializer.validated_data)
+            return Response(KeyRotationSerializer(get_progress(rotation)).data, status=status.HTTP_201_CREATED)
+
+        if request.method == 'DELETE':
+            try:
+                cancel_rotation(request.user.id)
+            except KeyRotation.DoesNotExist:
+                raise NotFound('No key rotation in progress.')
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
+        rotation = self._get_rotation(request)
+        return Response(KeyRotationSerializer(get_progress(rotation)).data, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['GET'], url_path='rotation/pending')
+    def rotation_pending(self, request):
+        """Next (at most `limit`) note keys that are not re-wrapped yet - `[{"note": <id>, "encryption_key": <key wrapped with the old public key>}]`."""
+        rotation = self._get_rotation(request)
+        try:
+            limit = _positive_int(request.query_params['limit'], strict=True, cutoff=settings.USERS_KEY_ROTATION_BATCH_SIZE)
+        except (KeyError, ValueError):
+            limit = settings.USERS_KEY_ROTATION_BATCH_SIZE
+        pending_keys = get_pending_keys(rotation, limit)
+        return Response(RotationKeySerializer(pending_keys, many=True).data, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['POST'], url_path='rotation/keys')
+    def rotation_keys(self, request):
+        """Stage a batch of re-wrapped keys `{"keys": [{"note": <id>, "encryption_key": "..."}]}`. Keys of notes that don't need re-wrapping are ignored."""
+        rotation = self._get_rotation(request)
+        serializer = RotationKeysSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        staged = stage_keys(rotation, serializer.validated_data['keys'])
+        return Response({'staged': staged, **KeyRotationSerializer(get_progress(rotation)).data}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['POST'], url_path='rotation/commit')
+    def rotation_commit(self, request):
+        """Swap all re-wrapped keys in and make the new key active at once. Returns 409 if some keys are not re-wrapped yet."""
+        try:
+            user_key = commit_rotation(request.user.id)
+        except KeyRotation.DoesNotExist:
+            raise NotFound('No key rotation in progress.')
+        data = UserKeySerializer(user_key).data
+        data['access_token'] = issue_access_token(load_user(request.user)) # Token with the new active key - the current one points to the retired key
+        return Response(data, status=status.HTTP_200_OK)
+
+    def _get_rotation(self, request):
+        return get_object_or_404(KeyRotation, user=request.user.id)
+
     @action(detail=False, methods=['GET'])
     def me(self, request):
-        user_key = get_object_or_404(UserKey, user=request.user.id)
+        user_key = get_object_or_404(UserKey.objects.active(), user=request.user.id)
         serializer = UserKeySerializer(user_key).data
         return Response(serializer, status=status.HTTP_200_OK)
 
@@ -163,7 +255,7 @@ class APIViewBase(APIView):
         return self.serializer_class(*args, **kwargs)
 
     def gen_tokens_for_user(self, user) -> Response:
-        refresh_token = RefreshToken.for_user(user)
+        refresh_token = UserClaimsRefreshToken.for_user(user)
         access_token = refresh_token.access_token
         response_data = {'access_token': str(access_token)}
 
@@ -224,7 +316,7 @@ class ResendActivationEmailViewSet(APIViewBase):
 
 
 class CreateJWT(TokenObtainPairView):
-    serializer_class = TokenObtainPairSerializer
+    serializer_class = UserClaimsTokenObtainPairSerializer
     permission_classes = [HasEmailVerifiedPermission]
 
     def post(self, request, *args, **kwargs):
@@ -240,6 +332,7 @@ class CreateJWT(TokenObtainPairView):
         return response
 
 class RefreshJWT(TokenRefreshView):
+    serializer_class = UserClaimsTokenRefreshSerializer # Access token gets claims read from db again
     def post(self, request, *args, **kwargs):
 
         refresh_token = request.COOKIES.get('refresh_token')
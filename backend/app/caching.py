@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+
+logger = logging.getLogger(__name__)
+
+MISSING = object() # Sentinel returned on cache miss (None is a legit cached value)
+
+
+class TwoLevelCache:
+    """
+    Bounded in-process LRU in front of a shared django cache (Redis).
+    Local entries live for `local_timeout` seconds only, that is the upper bound of how long another worker can serve
+    a value that was invalidated elsewhere. Shared cache errors are logged and treated as misses so that the app keeps
+    working (just slower) when Redis is down.
+    """
+
+    def __init__(self, prefix, maxsize, timeout, local_timeout, alias='shared'):
+        self.prefix = prefix
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.local_timeout = local_timeout
+        self.alias = alias
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def make_key(self, *parts):
+        return ':'.join([self.prefix, *(str(part) for part in parts)])
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._local.get(key)
+            if entry and entry[0] > now:
+                self._local.move_to_end(key)
+                self.local_hits += 1
+                return entry[1]
+
+        try:
+            value = caches[self.alias].get(key, MISSING)
+        except Exception:
+            logger.warning('Shared cache unavailable, reading %s from db', key, exc_info=True)
+            value = MISSING
+
+        if value is MISSING:
+            with self._lock:
+                self.misses += 1
+            return MISSING
+
+        self._set_local(key, value, shared_hits=1)
+        return value
+
+    def get_many(self, keys):
+        """Return dict with cached values of given keys - keys that are not cached are left out. Shared cache is asked once for all local misses."""
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._local.get(key)
+                if entry and entry[0] > now:
+                    self._local.move_to_end(key)
+                    found[key] = entry[1]
+            self.local_hits += len(found)
+
+        remaining = [key for key in keys if key not in found]
+        if not remaining:
+            return found
+
+        try:
+            shared = caches[self.alias].get_many(remaining)
+        except Exception:
+            logger.warning('Shared cache unavailable, reading %s from db', remaining, exc_info=True)
+            shared = {}
+
+        with self._lock:
+            self.misses += len(remaining) - len(shared)
+        for key, value in shared.items():
+            self._set_local(key, value, shared_hits=1)
+        found.update(shared)
+        return found
+
+    def set(self, key, value):
+        self._set_local(key, value)
+        try:
+            caches[self.alias].set(key, value, timeout=self.timeout)
+        except Exception:
+            logger.warning('Shared cache unavailable, %s not cached', key, exc_info=True)
+
+    def set_many(self, mapping):
+        for key, value in mapping.items():
+            self._set_local(key, value)
+        try:
+            caches[self.alias].set_many(mapping, timeout=self.timeout)
+        except Exception:
+            logger.warning('Shared cache unavailable, %s not cached', list(mapping), exc_info=True)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._local.pop(key, None)
+        try:
+            caches[self.alias].delete_many(keys)
+        except Exception:
+            logger.warning('Shared cache unavailable, %s not invalidated', keys, exc_info=True)
+
+    def clear_local(self):
+        with self._lock:
+            self._local.clear()
+
+    def stats(self):
+        """Hit/miss counters of this process."""
+        with self._lock:
+            local_hits, shared_hits, misses, local_size = self.local_hits, self.shared_hits, self.misses, len(self._local)
+        lookups = local_hits + shared_hits + misses
+        return {
+            'local_hits': local_hits,
+            'shared_hits': shared_hits,
+            'misses': misses,
+            'hit_ratio': (local_hits + shared_hits) / lookups if lookups else 0.0,
+            'local_size': local_size,
+        }
+
+    def _set_local(self, key, value, shared_hits=0):
+        with self._lock:
+            self.shared_hits += shared_hits
+            self._local[key] = (time.monotonic() + self.local_timeout, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.maxsize: # Evict least recently used entries
+                self._local.popitem(last=False)
@@ -41,6 +41,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework_simplejwt.token_blacklist',                             # https://django-rest-framework-simplejwt.readthedocs.io/en/latest/blacklist_app.html
     'corsheaders', # pip install django-cors-headers
     'rest_framework', # pip install djangorestframework
@@ -167,7 +168,7 @@ DEFAULT_ENCODING = 'utf-8'
 REST_FRAMEWORK = {
     'COERCE_DECIMAL_TO_STRING': False,
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'accounts.authentication.ClaimsJWTAuthentication', # request.user is built from token claims - user is not loaded from db on every request
     ),
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated'
@@ -187,6 +188,40 @@ SPECTACULAR_SETTINGS = {
 
 ACCOUNT_ACTIVATION_TIME = 60*60*24 # One day in seconds - this setting defines how long user has to click a link in the verification email upon registerning
 
+USERS_DIRECTORY_PAGE_SIZE = 50 # Number of users per page of /users/users/ (directory of users notes can be shared with)
+USERS_DIRECTORY_MAX_PAGE_SIZE = 200 # Upper bound for the `page_size` query param of the directory
+USERS_KEY_LOOKUP_MAX = 100 # Max number of users whose public keys can be fetched with one /users/keys/lookup/ request
+USERS_KEY_LOOKUP_MAX_AGE = 60*60 # How long (in seconds) clients may reuse a key lookup response before revalidating it with its ETag
+USERS_KEY_CACHE_SIZE = 10_000 # Max number of users' public keys kept in memory of each worker
+USERS_KEY_CACHE_TIMEOUT = 60*60*24 # How long public keys are kept in Redis (entries are invalidated when keys change anyway)
+USERS_KEY_LOCAL_CACHE_TIMEOUT = 10 # How long public keys are kept in worker's memory - bounds how long other workers may serve a replaced key
+USERS_STATE_CACHE_SIZE = 10_000 # Max number of users whose active state (not deleted, not deactivated) is kept in memory of each worker
+USERS_STATE_CACHE_TIMEOUT = 60*60 # How long active state of users is kept in Redis (entries are invalidated when users change anyway)
+USERS_STATE_LOCAL_CACHE_TIMEOUT = 10 # How long active state is kept in worker's memory - bounds how long a deleted or deactivated user can still use their access token
+USERS_KEY_ROTATION_BATCH_SIZE = 1000 # Max number of re-wrapped note keys sent (or listed) in one request during key rotation
+USERS_KEY_ROTATION_CHUNK_SIZE = 250 # Number of staged keys written per transaction - keeps locks on NoteItems short
+
+NOTES_PAGE_SIZE = 50 # Default number of notes per page of /notes/notes/me/ when client asks for pagination
+NOTES_MAX_PAGE_SIZE = 500 # Upper bound for the `page_size` query param
+NOTES_STREAM_CHUNK_SIZE = 200 # Number of rows fetched per round trip from server-side cursor when streaming notes
+NOTES_MAX_BODY_SIZE = 10*1024*1024 # Max size (in bytes) of note body uploaded as application/octet-stream
+NOTES_BODY_COMPRESSION_THRESHOLD = 1024 # Plaintext note bodies of at least this many bytes are stored compressed
+NOTES_BODY_COMPRESSION_LEVEL = 6 # zlib compression level (1 - fastest, 9 - smallest)
+NOTES_BODY_CHUNKING_THRESHOLD = 64*1024 # Bodies of at least this many bytes are stored as deduplicated content-defined chunks instead of in the note's row
+NOTES_BODY_CHUNK_SIZE = 1024*1024 # Size of parts of chunked uploads - every part of a multi-part body is kept as one (deduplicated) chunk
+NOTES_UPLOAD_EXPIRY = 60*60*24 # Unfinished chunked uploads older than this (in seconds) are deleted
+NOTES_REVISION_KEYFRAME_INTERVAL = 10 # Every n-th revision of plaintext note is stored in full, others as deltas - bounds how many deltas are applied to read a revision
+NOTES_REVISIONS_MAX = 50 # Number of latest revisions kept per note by the compaction task
+NOTES_REVISIONS_COMPACT_INTERVAL = 25 # Compaction of note's revisions is scheduled every n changes of the note
+NOTES_SEARCH_CONFIG = 'simple' # Postgres text search configuration - `simple` doesn't stem, so it works the same for notes in any language
+NOTES_SEARCH_MAX_TEXT_LENGTH = 256*1024 # Only this many characters of note's body are indexed (size of Postgres tsvector is limited)
+NOTES_SEARCH_MAX_TOKENS = 10_000 # Max number of blind index tokens of one note (one per distinct word)
+NOTES_ACL_CACHE_SIZE = 10_000 # Max number of (user, note) -> permission entries kept in memory of each worker
+NOTES_ACL_CACHE_TIMEOUT = 60*60 # How long permissions are kept in Redis (entries are invalidated on change anyway)
+NOTES_ACL_LOCAL_CACHE_TIMEOUT = 2 # How long permissions are kept in worker's memory - bounds how long other workers may see an invalidated permission
+NOTES_EVENTS_REDIS_URL = environ.get('REDIS_EVENTS_URL', 'redis://localhost:6379/3') # Redis used as pub/sub for pushing note changes to connected clients
+NOTES_EVENTS_KEEPALIVE = 15 # Seconds between keep-alive comments sent over idle event streams
+
 
 SESSION_COOKIE_SECURE = True
 CSRF_COOKIE_SECURE = False
@@ -217,6 +252,19 @@ DEFAULT_FROM_EMAIL = environ['DEFAULT_FROM_EMAIL']
 SERVER_EMAIL = environ['SERVER_EMAIL']
 
 
+# Caches:
+# `default` is kept in memory, `shared` lives in Redis (same instance as celery broker, separate db) and is used for data that all workers must agree on.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': environ.get('REDIS_CACHE_URL', 'redis://localhost:6379/2'),
+    },
+}
+
+
 # Celery stuff:
 # Here `1` means the name of the database - by convention should be 1
 # Moreover if celery is redis docker and celery are run in the same environment localhost is appropriate
@@ -14,10 +14,13 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 from django.urls import path, include
 import debug_toolbar
 from drf_spectacular.views import SpectacularAPIView, SpectacularRedocView, SpectacularSwaggerView
 
+from .views import cache_stats
+
 # admin.site.site_header = ''
 # admin.site.index_title = ''
 
@@ -25,8 +28,11 @@ urlpatterns = [
     path('users/', include('accounts.urls')),
     path('notes/', include('notes.urls')),
     path('__debug__/', include(debug_toolbar.urls)),
+    path('__debug__/cache-stats/', cache_stats, name='cache-stats'),
     # Api endpoints schema:
     path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
     path('api/schema/swagger-ui/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
     path('api/schema/redoc/', SpectacularRedocView.as_view(url_name='schema'), name='redoc'),
 ]
+
+urlpatterns += staticfiles_urlpatterns() # runserver used to serve static files (swagger, debug toolbar) - uvicorn doesn't
@@ -0,0 +1,14 @@
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+
+from accounts.key_cache import public_key_cache
+from accounts.user_state import user_state_cache
+from notes.acl import acl_cache
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def cache_stats(request):
+    """Hit/miss counters of the process-local caches of the worker that serves the request (every worker counts on its own)."""
+    return Response({cache.prefix: cache.stats() for cache in (acl_cache, public_key_cache, user_state_cache)})
@@ -1,5 +1,5 @@
 #!/bin/bash
 python manage.py makemigrations
 python manage.py migrate
-python manage.py runserver 0.0.0.0:8000
+uvicorn app.asgi:application --host 0.0.0.0 --port 8000 --reload # ASGI server is required for streaming note events
 exec "$@"
\ No newline at end of file
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.db import transaction
+
+from app.caching import TwoLevelCache, MISSING
+
+
+NO_ACCESS = '' # Cached marker for "user has no NoteItem for this note" (so that repeated denied requests don't hit db either)
+
+acl_cache = TwoLevelCache(
+    prefix='acl',
+    maxsize=settings.NOTES_ACL_CACHE_SIZE,
+    timeout=settings.NOTES_ACL_CACHE_TIMEOUT,
+    local_timeout=settings.NOTES_ACL_LOCAL_CACHE_TIMEOUT,
+)
+
+
+def get_cached_permission(user_id, note_id):
+    """Return cached permission of user to the note, None if user is known to have no access or MISSING if not cached."""
+    permission = acl_cache.get(acl_cache.make_key(note_id, user_id))
+    if permission is MISSING:
+        return MISSING
+    return permission or None
+
+
+def cache_permission(user_id, note_id, permission):
+    acl_cache.set(acl_cache.make_key(note_id, user_id), permission or NO_ACCESS)
+
+
+def invalidate_permissions(user_note_pairs):
+    """Drop cached permissions for given (user_id, note_id) pairs. Must be called whenever a NoteItem is created, changed or deleted."""
+    keys = [acl_cache.make_key(note_id, user_id) for user_id, note_id in user_note_pairs]
+    if not keys:
+        return
+    acl_cache.delete_many(keys)
+    transaction.on_commit(lambda: acl_cache.delete_many(keys)) # Drop again after commit - concurrent request could have cached the old permission in the meantime
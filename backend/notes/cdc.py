@@ -0,0 +1,65 @@
+import hashlib
+
+import numpy as np
+
+
+# Content-defined chunking (gear rolling hash, as in FastCDC). Chunk boundaries depend only on the bytes around them,
+# so inserting or removing text changes just the chunk(s) around the edit and all other chunks keep their hashes.
+# Changing these constants is safe (old chunks stay readable) but new writes won't deduplicate against old chunks.
+MIN_CHUNK_SIZE = 2 * 1024
+MAX_CHUNK_SIZE = 64 * 1024
+BOUNDARY_MASK = ((1 << 13) - 1) << 51 # 13 bits - boundary every ~8 KiB on average (plus MIN_CHUNK_SIZE)
+GEAR = [int.from_bytes(hashlib.sha256(bytes([value])).digest()[:8], 'little') for value in range(256)] # Fixed pseudo-random value for every byte
+UINT64 = (1 << 64) - 1
+WINDOW = 64 # Every byte is shifted out of the 64-bit fingerprint after 64 more bytes, so a fingerprint depends on the last 64 bytes only
+BLOCK_SIZE = 64 * 1024 # Fingerprints are computed block by block - small blocks stay in CPU cache and bound memory (8 bytes per byte of data)
+
+_GEAR = np.array(GEAR, dtype=np.uint64)
+_BOUNDARY_MASK = np.uint64(BOUNDARY_MASK)
+
+
+def _boundary_candidates(data):
+    """
+    Positions at which fingerprint of the preceding WINDOW bytes matches BOUNDARY_MASK - fingerprints of all positions are computed
+    with a few vectorized passes (window is doubled every pass) instead of a python loop over every byte.
+    """
+    candidates = []
+    for block_start in range(0, len(data), BLOCK_SIZE):
+        context = min(block_start, WINDOW - 1)
+        fingerprints = _GEAR[data[block_start - context:block_start + BLOCK_SIZE]]
+        width = 1
+        while width < WINDOW: # fingerprints[p] = sum(GEAR[data[p - i]] << i for i < 2 * width) after each pass, overflow wraps as in the loop
+            fingerprints[width:] += fingerprints[:-width] << np.uint64(width)
+            width *= 2
+        candidates.append(np.flatnonzero((fingerprints[context:] & _BOUNDARY_MASK) == 0) + block_start)
+    return np.concatenate(candidates) if candidates else np.empty(0, dtype=np.intp)
+
+
+def split(data):
+    """Split data into content-defined chunks. Returned chunks are memoryviews of data (nothing is copied)."""
+    view = memoryview(data)
+    array = np.frombuffer(view, dtype=np.uint8)
+    candidates = _boundary_candidates(array)
+    chunks = []
+    start = 0
+    while start < len(view):
+        end = min(start + MAX_CHUNK_SIZE, len(view))
+        cut = end
+        fingerprint = 0
+        hashed_from = start + MIN_CHUNK_SIZE # No boundary can be closer than MIN_CHUNK_SIZE thus these bytes are not even hashed
+        for position in range(hashed_from, min(hashed_from + WINDOW - 1, end)): # Fingerprint covers fewer than WINDOW bytes here - it differs from the precomputed one
+            fingerprint = ((fingerprint << 1) + GEAR[view[position]]) & UINT64
+            if not fingerprint & BOUNDARY_MASK:
+                cut = position + 1
+                break
+        else:
+            index = np.searchsorted(candidates, hashed_from + WINDOW - 1)
+            if index < len(candidates) and candidates[index] < end:
+                cut = int(candidates[index]) + 1
+        chunks.append(view[start:cut])
+        start = cut
+    return chunks
+
+
+def digest(chunk):
+    return hashlib.sha256(chunk).hexdigest()
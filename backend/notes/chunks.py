@@ -0,0 +1,59 @@
+import hashlib
+import re
+
+from .compression import decompress_chunk
+
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class EditOutOfRange(Exception):
+    pass
+
+
+def parse_range(header, size):
+    """
+    Parse single range `Range` header into inclusive (start, end) byte offsets.
+    Returns None if there is no header or it can be ignored (other unit, multiple ranges, malformed) - whole body is sent then.
+    """
+    match = RANGE_RE.match(header or '')
+    if not match or size == 0:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start: # Suffix range - last `end` bytes
+        return max(size - int(end), 0), size - 1
+    start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+def apply_edits(body, edits):
+    """
+    Apply edits - (offset, length, data) tuples sorted by offset and not overlapping, offsets point into the original body - to the body.
+    Each edit replaces `length` bytes at `offset` with `data` (so it inserts if length is 0 and deletes if data is empty).
+    """
+    body = memoryview(body)
+    parts = []
+    position = 0
+    for offset, length, data in edits:
+        if offset + length > len(body):
+            raise EditOutOfRange()
+        parts += [body[position:offset], data]
+        position = offset + length
+    parts.append(body[position:])
+    return b''.join(parts)
+
+
+def upload_sha256(upload):
+    """SHA-256 of uploaded parts in order, computed chunk by chunk."""
+    digest = hashlib.sha256()
+    for data, is_compressed in upload.chunks.order_by('index').values_list('blob__data', 'blob__is_compressed').iterator(chunk_size=1):
+        digest.update(decompress_chunk(data, is_compressed))
+    return digest.hexdigest()
@@ -0,0 +1,42 @@
+import zlib
+
+from django.conf import settings
+
+
+# Compressed bodies start with a codec tag byte. Bytes 0xF8-0xFF can never start valid UTF-8 text,
+# so a text body is either stored verbatim or starts with one of these tags - no extra column is needed.
+ZLIB_TAG = 0xFF
+
+
+def pack_body(body, is_encrypted):
+    """
+    Return the bytes to store for a text body. Plaintext bodies above `NOTES_BODY_COMPRESSION_THRESHOLD` are compressed
+    (if it actually makes them smaller), ciphertext is stored untouched as it doesn't compress anyway.
+    """
+    if is_encrypted or len(body) < settings.NOTES_BODY_COMPRESSION_THRESHOLD:
+        return body
+    compressed = bytes([ZLIB_TAG]) + zlib.compress(body, settings.NOTES_BODY_COMPRESSION_LEVEL)
+    return compressed if len(compressed) < len(body) else body
+
+
+def unpack_body(stored):
+    """Return text body as it was written (stored value may be a memoryview - it is not copied unless it's compressed)."""
+    if is_packed(stored):
+        return zlib.decompress(memoryview(stored)[1:])
+    return stored
+
+
+def is_packed(stored):
+    return bytes(stored[:1]) == bytes([ZLIB_TAG]) # Postgres gives memoryview of format 'c' - indexing it yields bytes, not int
+
+
+def compress_chunk(chunk):
+    """Compress chunk of plaintext body kept in the chunk store. Returns (data, is_compressed)."""
+    compressed = zlib.compress(chunk, settings.NOTES_BODY_COMPRESSION_LEVEL)
+    if len(compressed) < len(chunk):
+        return compressed, True
+    return bytes(chunk), False
+
+
+def decompress_chunk(data, is_compressed):
+    return zlib.decompress(data) if is_compressed else data
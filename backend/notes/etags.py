@@ -0,0 +1,28 @@
+from hashlib import sha256
+
+from django.utils.http import parse_etags
+
+
+def _make_etag(*parts):
+    return '"%s"' % sha256(':'.join(str(part) for part in parts).encode()).hexdigest()[:32]
+
+
+def note_etag(note):
+    """Strong ETag of note's detail representation - changes with note's version or set of users having access to the note."""
+    note_item_ids = sorted(str(note_item_id) for note_item_id in note.noteitem.values_list('id', flat=True))
+    return _make_etag(note.pk, note.version, *note_item_ids)
+
+
+def note_list_etag(request, note_items):
+    """
+    Strong ETag of user's notes list computed from versions, permissions and access changes of listed notes
+    (one light query without bodies). Full path is included as query params (e.g. `fields`, `cursor`) change the representation.
+    """
+    rows = note_items.order_by().values_list('note_id', 'note__version', 'permission', 'change_seq', 'note__owner__username')
+    return _make_etag(request.get_full_path(), *sorted(':'.join(str(value) for value in row) for row in rows))
+
+
+def etag_matches(header, etag):
+    """Check if value of If-Match/If-None-Match header matches the ETag."""
+    etags = parse_etags(header or '')
+    return '*' in etags or etag in etags
@@ -0,0 +1,117 @@
+import json
+import logging
+import time
+
+import redis
+import redis.asyncio
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework import status
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from accounts.authentication import ClaimsJWTAuthentication
+
+
+logger = logging.getLogger(__name__)
+
+NOTE_CHANGED = 'note.changed'
+NOTE_SHARED = 'note.shared'
+NOTE_UNSHARED = 'note.unshared'
+
+_redis_client = None
+
+
+def get_redis():
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(settings.NOTES_EVENTS_REDIS_URL)
+    return _redis_client
+
+
+def user_channel(user_id):
+    return f'notes:user:{user_id}'
+
+
+def publish_note_event(event, note_id, user_ids):
+    """Publish event about the note to every given user once the current transaction commits (nothing is sent if it rolls back)."""
+    message = json.dumps({'event': event, 'note_id': str(note_id)})
+    user_ids = [user_id for user_id in user_ids if user_id]
+
+    def publish():
+        try:
+            pipeline = get_redis().pipeline(transaction=False)
+            for user_id in user_ids:
+                pipeline.publish(user_channel(user_id), message)
+            pipeline.execute()
+        except redis.RedisError:
+            logger.warning('Could not publish %s of note %s', event, note_id, exc_info=True)
+
+    if user_ids:
+        transaction.on_commit(publish)
+
+
+def publish_notes_changed(note_ids):
+    """Publish `note.changed` to every user holding a NoteItem for any of the notes (recipients are resolved with one query)."""
+    NoteItem = apps.get_model('notes', 'NoteItem')
+    recipients = {}
+    for note_id, user_id in NoteItem.objects.filter(note__in=note_ids).values_list('note', 'user_key__user'):
+        recipients.setdefault(note_id, []).append(user_id)
+    for note_id, user_ids in recipients.items():
+        publish_note_event(NOTE_CHANGED, note_id, user_ids)
+
+
+def _get_access_token(request):
+    """Read access token from `Authorization: Bearer <token>` header or `token` query param (browser's EventSource cannot set headers)."""
+    header = request.headers.get('Authorization', '')
+    for header_type in jwt_settings.AUTH_HEADER_TYPES:
+        if header.startswith(f'{header_type} '):
+            return header.split(' ', 1)[1]
+    return request.GET.get('token')
+
+
+async def note_events(request):
+    """
+    Server-Sent Events stream of changes of notes the user has access to (`note.changed`, `note.shared`, `note.unshared`).
+    Authenticated with the same access token as the REST API. The stream ends when the token expires, client is expected to reconnect with a new one.
+    Requires the app to be served via ASGI.
+    """
+    raw_token = _get_access_token(request)
+    if not raw_token: # AccessToken(None) would create a brand new token instead of failing
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=status.HTTP_401_UNAUTHORIZED)
+    authentication = ClaimsJWTAuthentication() # Same checks as the REST API (token type, user id claim, deleted or inactive user)
+    try:
+        token = authentication.get_validated_token(raw_token)
+        user = await sync_to_async(authentication.get_user)(token)
+    except AuthenticationFailed as exc: # Also InvalidToken
+        detail = exc.detail if isinstance(exc.detail, dict) else {'detail': exc.detail}
+        return JsonResponse(detail, status=status.HTTP_401_UNAUTHORIZED)
+
+    user_id = user.id
+    expires_at = token['exp']
+
+    async def stream():
+        client = redis.asyncio.Redis.from_url(settings.NOTES_EVENTS_REDIS_URL)
+        pubsub = client.pubsub()
+        await pubsub.subscribe(user_channel(user_id))
+        try:
+            yield 'retry: 1000\n\n'
+            while (time_left := expires_at - time.time()) > 0:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=min(settings.NOTES_EVENTS_KEEPALIVE, time_left))
+                if message is None:
+                    yield ': keep-alive\n\n' # Comment line keeps proxies from closing idle connection
+                    continue
+                data = message['data'].decode(settings.DEFAULT_ENCODING)
+                yield f'event: {json.loads(data)["event"]}\ndata: {data}\n\n'
+        finally: # Also runs when client disconnects
+            await pubsub.unsubscribe()
+            await pubsub.aclose()
+            await client.aclose()
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no' # Don't let nginx buffer the stream
+    return response
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, OuterRef
+
+from notes.models import NoteBodyBlob, NoteBodyChunk
+
+
+class Command(BaseCommand):
+    help = 'Delete blobs of the note body chunk store that are no longer referenced by any note or upload.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of blobs deleted per transaction')
+
+    def handle(self, *args, **options):
+        unused_blobs = NoteBodyBlob.objects.filter(~Exists(NoteBodyChunk.objects.filter(blob=OuterRef('pk')))).values_list('digest', flat=True)
+
+        deleted = 0
+        skipped = set()
+        while digests := list(unused_blobs.exclude(digest__in=skipped)[:options['batch_size']]):
+            try:
+                with transaction.atomic():
+                    deleted += NoteBodyBlob.objects.filter(digest__in=digests).filter(~Exists(NoteBodyChunk.objects.filter(blob=OuterRef('pk')))).delete()[0]
+            except IntegrityError: # Concurrent write started using one of the blobs - leave this batch for the next run
+                skipped.update(digests)
+
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} unused blobs.'))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from notes.compression import pack_body, unpack_body
+from notes.models import Note
+
+
+class Command(BaseCommand):
+    help = 'Compress (or with --decompress restore) bodies of existing plaintext notes kept in note rows in batches (chunked bodies are compressed chunk by chunk on write), e.g. after changing compression settings.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of notes processed (and locked) per transaction')
+        parser.add_argument('--decompress', action='store_true', help='Store all plaintext bodies uncompressed')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        notes = Note.objects.filter(is_encrypted=False, body_format=Note.TEXT_BODY, body_size__isnull=True).only('id', 'body', 'is_encrypted', 'body_format').order_by('id')
+
+        processed = changed = 0
+        last_id = None
+        while True:
+            with transaction.atomic(): # Rows are locked only for the duration of a batch, so concurrent edits are neither blocked for long nor overwritten
+                batch = notes.select_for_update()
+                if last_id:
+                    batch = batch.filter(id__gt=last_id)
+                batch = list(batch[:batch_size])
+                if not batch:
+                    break
+
+                notes_to_update = []
+                for note in batch:
+                    body = bytes(unpack_body(note.body))
+                    stored = body if options['decompress'] else pack_body(body, note.is_encrypted)
+                    if stored != bytes(note.body): # Postgres gives memoryview, which never equals bytes
+                        note.body = stored
+                        notes_to_update.append(note)
+                Note.objects.bulk_update(notes_to_update, ['body']) # Body content doesn't change thus neither version nor change_seq is bumped
+
+            processed += len(batch)
+            changed += len(notes_to_update)
+            last_id = batch[-1].id
+
+        self.stdout.write(self.style.SUCCESS(f'Processed {processed} notes, rewrote {changed} bodies.'))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from notes.models import Note, write_search_vectors
+
+
+class Command(BaseCommand):
+    help = 'Rebuild full-text search vectors of all notes in batches, e.g. for notes written before search existed or after changing NOTES_SEARCH_CONFIG.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of notes processed (and locked) per transaction')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        notes = Note.objects.only('id', 'title', 'body', 'body_format', 'body_size', 'is_encrypted').order_by('id')
+
+        processed = 0
+        last_id = None
+        while True:
+            with transaction.atomic(): # Rows are locked only for the duration of a batch, so concurrent edits are neither blocked for long nor overwritten
+                batch = notes.select_for_update()
+                if last_id:
+                    batch = batch.filter(id__gt=last_id)
+                batch = list(batch[:batch_size])
+                if not batch:
+                    break
+                write_search_vectors(batch) # Content doesn't change thus neither version nor change_seq is bumped
+
+            processed += len(batch)
+            last_id = batch[-1].id
+
+        self.stdout.write(self.style.SUCCESS(f'Updated search vectors of {processed} notes.'))
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.5 on 2026-10-17 18:08
+
+import notes.models
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0012_remove_note_updated_at_remove_note_version'),
+        migrations.swappable_dependency(settings.AUTH_USER_KEY_MODEL),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql='CREATE SEQUENCE notes_change_seq',
+            reverse_sql='DROP SEQUENCE notes_change_seq',
+        ),
+        migrations.CreateModel(
+            name='NoteTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('note_id', models.UUIDField()),
+                ('user_key_id', models.UUIDField()),
+                ('change_seq', models.BigIntegerField(db_default=notes.models.NextChangeSeq(), editable=False)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='note',
+            name='change_seq',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='noteitem',
+            name='change_seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='noteitem',
+            index=models.Index(fields=['user_key', 'change_seq'], name='notes_notei_user_ke_ae3260_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notetombstone',
+            index=models.Index(fields=['user_key_id', 'change_seq'], name='notes_notet_user_ke_e1b8bc_idx'),
+        ),
+    ]
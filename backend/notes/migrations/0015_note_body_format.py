@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-17 18:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0014_note_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='body_format',
+            field=models.CharField(choices=[('text', 'Text'), ('binary', 'Binary')], default='text', max_length=6),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.2.5 on 2026-10-17 18:17
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0015_note_body_format'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='body_chunk_size',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='note',
+            name='body_size',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='note',
+            name='body_format',
+            field=models.CharField(choices=[('text', 'Text'), ('binary', 'Binary'), ('chunked', 'Chunked')], default='text', max_length=7),
+        ),
+        migrations.CreateModel(
+            name='NoteUpload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('base_version', models.PositiveIntegerField()),
+                ('chunk_size', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('note', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='uploads', to='notes.note')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='note_uploads', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='NoteBodyChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('note', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='notes.note')),
+                ('upload', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='notes.noteupload')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(condition=models.Q(('upload__isnull', True)), fields=('note', 'index'), name='unique_note_body_chunk'), models.UniqueConstraint(condition=models.Q(('upload__isnull', False)), fields=('upload', 'index'), name='unique_note_upload_chunk')],
+            },
+        ),
+    ]
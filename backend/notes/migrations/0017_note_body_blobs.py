@@ -0,0 +1,60 @@
+import hashlib
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def move_chunk_data_to_blobs(apps, schema_editor):
+    NoteBodyBlob = apps.get_model('notes', 'NoteBodyBlob')
+    NoteBodyChunk = apps.get_model('notes', 'NoteBodyChunk')
+    for chunk in NoteBodyChunk.objects.select_related('note', 'upload').iterator(chunk_size=1):
+        data = bytes(chunk.data)
+        digest = hashlib.sha256(data).hexdigest()
+        NoteBodyBlob.objects.get_or_create(digest=digest, defaults={'data': data, 'size': len(data)})
+        chunk.blob_id = digest
+        chunk.offset = chunk.index * (chunk.upload.chunk_size if chunk.upload else chunk.note.body_chunk_size)
+        chunk.save(update_fields=['blob', 'offset'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0016_note_body_chunks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NoteBodyBlob',
+            fields=[
+                ('digest', models.CharField(editable=False, max_length=64, primary_key=True, serialize=False)),
+                ('data', models.BinaryField()),
+                ('size', models.PositiveIntegerField()),
+                ('is_compressed', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='notebodychunk',
+            name='blob',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='chunks', to='notes.notebodyblob'),
+        ),
+        migrations.AddField(
+            model_name='notebodychunk',
+            name='offset',
+            field=models.BigIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.RunPython(move_chunk_data_to_blobs, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='notebodychunk',
+            name='data',
+        ),
+        migrations.RemoveField(
+            model_name='note',
+            name='body_chunk_size',
+        ),
+        migrations.AlterField(
+            model_name='notebodychunk',
+            name='blob',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='chunks', to='notes.notebodyblob'),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.2.5 on 2026-10-17 18:23
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0017_note_body_blobs'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NoteRevision',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('version', models.PositiveIntegerField()),
+                ('title', models.CharField(max_length=255)),
+                ('is_encrypted', models.BooleanField()),
+                ('body_format', models.CharField(choices=[('text', 'Text'), ('binary', 'Binary'), ('chunked', 'Chunked')], max_length=7)),
+                ('body_size', models.BigIntegerField(blank=True, null=True)),
+                ('kind', models.CharField(choices=[('K', 'Keyframe'), ('D', 'Delta')], max_length=1)),
+                ('data', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.RemoveConstraint(
+            model_name='notebodychunk',
+            name='unique_note_body_chunk',
+        ),
+        migrations.AddField(
+            model_name='noterevision',
+            name='author',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='note_revisions', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='noterevision',
+            name='note',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='revisions', to='notes.note'),
+        ),
+        migrations.AddField(
+            model_name='notebodychunk',
+            name='revision',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='notes.noterevision'),
+        ),
+        migrations.AddConstraint(
+            model_name='notebodychunk',
+            constraint=models.UniqueConstraint(condition=models.Q(('revision__isnull', True), ('upload__isnull', True)), fields=('note', 'index'), name='unique_note_body_chunk'),
+        ),
+        migrations.AddConstraint(
+            model_name='notebodychunk',
+            constraint=models.UniqueConstraint(condition=models.Q(('revision__isnull', False)), fields=('revision', 'index'), name='unique_note_revision_chunk'),
+        ),
+        migrations.AddConstraint(
+            model_name='noterevision',
+            constraint=models.UniqueConstraint(fields=('note', 'version'), name='unique_note_revision'),
+        ),
+    ]
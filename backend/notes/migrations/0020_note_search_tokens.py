@@ -0,0 +1,28 @@
+# Generated by Django 5.2.5 on 2026-10-17 18:36
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0019_note_search_vector'),
+        migrations.swappable_dependency(settings.AUTH_USER_KEY_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NoteSearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.BinaryField(max_length=64)),
+                ('note_item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_tokens', to='notes.noteitem')),
+                ('user_key', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_KEY_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user_key', 'token', 'note_item'), name='unique_note_search_token')],
+            },
+        ),
+    ]
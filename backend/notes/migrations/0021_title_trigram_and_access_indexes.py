@@ -0,0 +1,40 @@
+# Generated by Django 5.2.5 on 2026-10-17 18:38
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+import django.db.models.functions.text
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0020_note_search_tokens'),
+        migrations.swappable_dependency(settings.AUTH_USER_KEY_MODEL),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AlterModelOptions(
+            name='note',
+            options={},
+        ),
+        migrations.AlterModelOptions(
+            name='noteitem',
+            options={},
+        ),
+        migrations.AddIndex(
+            model_name='note',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('title'), name='gin_trgm_ops'), name='note_title_trgm_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='note',
+            index=models.Index(fields=['owner', 'title'], name='note_owner_title_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='noteitem',
+            index=models.Index(fields=['user_key', 'permission'], name='noteitem_user_key_perm_idx'),
+        ),
+    ]
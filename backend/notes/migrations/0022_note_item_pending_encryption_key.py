@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-17 18:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0021_title_trigram_and_access_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='noteitem',
+            name='pending_encryption_key',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
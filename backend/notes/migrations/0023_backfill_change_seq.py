@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """Rows existing before change_seq was added got 0, so delta sync (change_seq > since) never returned them - give them real positions."""
+
+    dependencies = [
+        ('notes', '0022_note_item_pending_encryption_key'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[
+                "UPDATE notes_note SET change_seq = nextval('notes_change_seq') WHERE change_seq = 0",
+                "UPDATE notes_noteitem SET change_seq = nextval('notes_change_seq') WHERE change_seq = 0",
+            ],
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    change_seq holds id of the writing transaction instead of a sequence value, so that delta sync can keep its cursor below transactions
+    still in flight. Existing rows get id of this transaction. Cursors handed out before were sequence values and may be above it - clients
+    have to sync from 0 again.
+    """
+
+    dependencies = [
+        ('notes', '0023_backfill_change_seq'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[
+                'ALTER TABLE notes_notetombstone ALTER COLUMN change_seq SET DEFAULT pg_current_xact_id()::text::bigint',
+                'UPDATE notes_note SET change_seq = pg_current_xact_id()::text::bigint',
+                'UPDATE notes_noteitem SET change_seq = pg_current_xact_id()::text::bigint',
+                'UPDATE notes_notetombstone SET change_seq = pg_current_xact_id()::text::bigint',
+            ],
+            reverse_sql=[
+                "ALTER TABLE notes_notetombstone ALTER COLUMN change_seq SET DEFAULT nextval('notes_change_seq')",
+            ],
+        ),
+    ]
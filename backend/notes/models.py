@@ -1,25 +1,149 @@
-from django.db import models
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchVectorField
+from django.db import connection, models, transaction
+from django.db.models import Case, F, Func, When
+from django.db.models.functions import Cast, Coalesce, Upper
 
 from django.conf import settings
 
+from .cdc import split, digest
+from .compression import pack_body, unpack_body, compress_chunk, decompress_chunk
+from .search import extract_text, search_vector
+
 from uuid import uuid4
 
+class NextChangeSeq(Func):
+    """
+    Position of a change in the order of all changes of notes and their NoteItems (used by delta sync) - id of the writing transaction.
+    Unlike values of a sequence (allocated at write time, in a different order than transactions commit) transaction ids let delta sync tell
+    which changes may still be in flight, see `settled_change_seq()`.
+    Being an SQL expression it can be assigned to `change_seq` before save(), update() or bulk operations without an extra query.
+    """
+    template = 'pg_current_xact_id()::text::bigint'
+    output_field = models.BigIntegerField()
+
+
+def settled_change_seq():
+    """
+    Highest change_seq below every transaction that is still in flight - all changes up to it are committed (or rolled back), so queries
+    started afterwards see them. Delta sync cursor must not pass it, in-flight transaction would commit a lower change_seq behind the cursor.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint - 1')
+        return cursor.fetchone()[0]
+
+
 class Note(models.Model):
+    TEXT_BODY = 'text'
+    BINARY_BODY = 'binary'
+    CHUNKED_BODY = 'chunked'
+    BODY_FORMAT_CHOICES = [
+        (TEXT_BODY, 'Text'), # UTF-8 text sent as JSON string
+        (BINARY_BODY, 'Binary'), # Raw bytes (e.g. ciphertext) uploaded as application/octet-stream
+        (CHUNKED_BODY, 'Chunked'), # Raw bytes uploaded in parts - not included in JSON responses, download via body endpoint only
+    ]
     id = models.UUIDField(primary_key=True, default=uuid4, editable=False)
     #! If owner_id on_delete is different than SET_NULL than change the null=False
     title = models.CharField(max_length=255)
     body = models.BinaryField()
+    body_format = models.CharField(max_length=7, choices=BODY_FORMAT_CHOICES, default=TEXT_BODY) # Tells how the body is represented in JSON responses
+    body_size = models.BigIntegerField(null=True, blank=True, editable=False) # Size of body kept in the chunk store (`body` is empty then), null if body is stored in the row
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, on_delete=models.SET_NULL, related_name='note') # Maybe change this to make it set to the last user that has permissions to this note???
     is_encrypted = models.BooleanField(default=False)
     created_at = models.DateField(auto_now_add=True)
     # updated_at = models.DateTimeField(auto_now=True) # Track modifications
-    # version = models.IntegerField(default=1) # Track version for conflict resolution
+    version = models.PositiveIntegerField(default=1, editable=False) # Incremented on every change of title, body or encryption - used for optimistic concurrency and ETags
+    change_seq = models.BigIntegerField(default=0, db_index=True, editable=False) # Position of the last change of this note in the global change order
+    search_vector = SearchVectorField(null=True, editable=False) # Full-text index of title and body of unencrypted text notes, null for other notes
 
     def __str__(self) -> str:
         return self.title
 
+    def save(self, *args, **kwargs):
+        self.change_seq = NextChangeSeq()
+        if (update_fields := kwargs.get('update_fields')) is not None:
+            kwargs['update_fields'] = {*update_fields, 'change_seq', *(['body_size'] if 'body' in update_fields else [])}
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            write_body_chunks([self])
+            if update_fields is None or SEARCHED_FIELDS.intersection(update_fields):
+                write_search_vectors([self])
+
+    def set_body(self, body, body_format):
+        """
+        Set body (bytes as written by the client) - set `is_encrypted` first. Bodies of at least `NOTES_BODY_CHUNKING_THRESHOLD` bytes
+        are split into content-defined chunks which are written to the chunk store when the note is saved, smaller ones stay in the row.
+        Plaintext text bodies (or their chunks) are compressed.
+        """
+        compress = body_format == Note.TEXT_BODY and not self.is_encrypted
+        if len(body) >= settings.NOTES_BODY_CHUNKING_THRESHOLD:
+            self._new_chunks = split(body), compress
+            self.body = b''
+            self.body_size = len(body)
+        else:
+            self._new_chunks = [], False # Chunks of the previous body (if any) are dropped on save
+            self.body = pack_body(body, self.is_encrypted) if body_format == Note.TEXT_BODY else body
+            self.body_size = None
+        self.body_format = body_format
+
+    def set_text_body(self, body):
+        """Set body written as text (encoded to bytes)."""
+        self.set_body(body, Note.TEXT_BODY)
+
+    def get_body(self):
+        """Return body as it was written (decompressed and/or assembled from chunks here, lazily - only when the body is actually read)."""
+        if self.body_size is not None:
+            return b''.join(self.iter_body(0, self.body_size - 1))
+        if self.body_format == Note.TEXT_BODY:
+            return unpack_body(self.body)
+        return self.body
+
+    def get_search_text(self):
+        """Text of the body that is indexed for full-text search, None if the body can't be searched (ciphertext, binary)."""
+        if self.is_encrypted or self.body_format != Note.TEXT_BODY:
+            return None
+        return extract_text(self.get_body())
+
+    def get_snippet_text(self):
+        """Text search result snippets are made of - like get_search_text() but body kept in the chunk store is not read (empty text instead)."""
+        if self.body_size is not None:
+            return ''
+        return self.get_search_text() or ''
+
+    def iter_body(self, start, end):
+        """Yield bytes start..end (inclusive) of body kept in the chunk store."""
+        return iter_manifest(NoteBodyChunk.of_bodies([self]), start, end)
+
+    def compare_and_swap(self, fields):
+        """
+        Save given fields only if note's version in db is still the one this instance was loaded with, and increment it.
+        Returns False (and writes nothing) if somebody else changed the note in the meantime.
+        """
+        if 'body' in fields:
+            fields = {*fields, 'body_size'}
+        with transaction.atomic():
+            updated = Note.objects.filter(pk=self.pk, version=self.version).update(
+                **{field: getattr(self, field) for field in fields},
+                version=models.F('version') + 1,
+                change_seq=NextChangeSeq()
+            )
+            if updated:
+                write_body_chunks([self])
+                if SEARCHED_FIELDS.intersection(fields):
+                    write_search_vectors([self])
+        if updated:
+            self.version += 1
+        return bool(updated)
+
     class Meta:
-        ordering = ['title']
+        indexes = [
+            GinIndex(fields=['search_vector'], name='note_search_vector_idx'),
+            GinIndex(OpClass(Upper('title'), name='gin_trgm_ops'), name='note_title_trgm_idx'), # Fuzzy and substring title search (pg_trgm), matches `upper_title` alias
+            models.Index(fields=['owner', 'title'], name='note_owner_title_idx'),
+        ]
+
+
+SEARCHED_FIELDS = {'title', 'body', 'body_format', 'is_encrypted'} # Changes of these fields update note's search vector
 
 class NoteItem(models.Model):
     READ_PERMISSION = 'R'
@@ -37,7 +161,205 @@ class NoteItem(models.Model):
     user_key = models.ForeignKey(settings.AUTH_USER_KEY_MODEL, on_delete=models.CASCADE, related_name='noteitem')
     encryption_key = models.BinaryField(null=True, blank=True, db_column='encrypted_symmetric_key')
     permission = models.CharField(max_length=1, choices=PERMISSIONS_CHOICES, default=READ_PERMISSION, blank=False)
+    change_seq = models.BigIntegerField(default=0, editable=False) # Position of the last change of user's access to the note (sharing, permission or key change)
+    pending_encryption_key = models.BinaryField(null=True, blank=True, editable=False) # Key re-wrapped for user's new UserKey, staged until their key rotation is committed
+
+    def save(self, *args, **kwargs):
+        self.change_seq = NextChangeSeq()
+        if (update_fields := kwargs.get('update_fields')) is not None:
+            kwargs['update_fields'] = {*update_fields, 'change_seq'}
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def move_to_key(cls, old_key, new_key):
+        """
+        Move all NoteItems (with their search tokens and tombstones) of user's old key to the new one, swapping in staged re-wrapped keys.
+        Every table is updated with a single statement - to be called in the transaction committing the key rotation.
+        """
+        moved = cls.objects.filter(user_key=old_key).update(
+            user_key=new_key,
+            encryption_key=Coalesce('pending_encryption_key', 'encryption_key'), # Plaintext notes have nothing staged and keep no key
+            pending_encryption_key=None,
+            change_seq=NextChangeSeq(), # User's other devices pick up the new keys with delta sync
+        )
+        NoteSearchToken.objects.filter(user_key=old_key).update(user_key=new_key)
+        NoteTombstone.objects.filter(user_key_id=old_key.pk).update(user_key_id=new_key.pk)
+        return moved
 
     class Meta:
         unique_together = ("note", "user_key")
-        ordering = ['permission']
+        indexes = [
+            models.Index(fields=['user_key', 'change_seq']),
+            models.Index(fields=['user_key', 'permission'], name='noteitem_user_key_perm_idx'),
+        ]
+
+
+class NoteTombstone(models.Model):
+    """Record of user losing access to a note (note deleted or unshared) so that delta sync can tell clients to drop it."""
+    note_id = models.UUIDField() # Plain UUIDs instead of FKs as both note and UserKey may already be deleted
+    user_key_id = models.UUIDField()
+    change_seq = models.BigIntegerField(db_default=NextChangeSeq(), editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_key_id', 'change_seq']),
+        ]
+
+
+class NoteSearchToken(models.Model):
+    """
+    Blind index of encrypted notes - keyed HMAC of a word of the note, computed on the client with a key only the user has.
+    Every user indexes their notes with their own key, so tokens belong to NoteItem. The server only matches tokens for equality, it never sees the words.
+    """
+    note_item = models.ForeignKey(NoteItem, on_delete=models.CASCADE, related_name='search_tokens')
+    user_key = models.ForeignKey(settings.AUTH_USER_KEY_MODEL, on_delete=models.CASCADE, related_name='+') # Copy of note_item.user_key - search is a single (user_key, token) index lookup without joins
+    token = models.BinaryField(max_length=64)
+
+    @classmethod
+    def replace(cls, note_item, tokens):
+        """Replace tokens of the NoteItem with given ones (duplicates are dropped)."""
+        cls.objects.filter(note_item=note_item).delete()
+        cls.objects.bulk_create([cls(note_item=note_item, user_key_id=note_item.user_key_id, token=token) for token in set(tokens)])
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_key', 'token', 'note_item'], name='unique_note_search_token'),
+        ]
+
+
+class NoteUpload(models.Model):
+    """Chunked upload of note's body in progress. Its parts are NoteBodyChunks pointing to the upload until it is committed."""
+    id = models.UUIDField(primary_key=True, default=uuid4, editable=False)
+    note = models.ForeignKey(Note, on_delete=models.CASCADE, related_name='uploads')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='note_uploads')
+    base_version = models.PositiveIntegerField() # Version of the note the upload replaces - commit fails if the note changed meanwhile
+    chunk_size = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class NoteBodyBlob(models.Model):
+    """Content-addressed piece of note bodies - stored once and shared by all notes (and their versions) containing the same bytes."""
+    digest = models.CharField(primary_key=True, max_length=64, editable=False) # SHA-256 of uncompressed data
+    data = models.BinaryField()
+    size = models.PositiveIntegerField() # Size of uncompressed data
+    is_compressed = models.BooleanField(default=False)
+
+    @classmethod
+    def from_chunk(cls, chunk_digest, chunk, compress):
+        data, is_compressed = compress_chunk(chunk) if compress else (bytes(chunk), False)
+        return cls(digest=chunk_digest, data=data, size=len(chunk), is_compressed=is_compressed)
+
+
+class NoteRevision(models.Model):
+    """
+    State of the note after one of its changes. Plaintext text bodies are stored as line deltas against the previous revision with a full
+    keyframe every `NOTES_REVISION_KEYFRAME_INTERVAL` revisions, other bodies (ciphertext, binary) as full snapshots - large ones share
+    chunks with the note in the chunk store. See revisions.py.
+    """
+    KEYFRAME = 'K'
+    DELTA = 'D'
+    KIND_CHOICES = [
+        (KEYFRAME, 'Keyframe'), # `data` holds the body as stored in note's row (or body is in the chunk store if `body_size` is set)
+        (DELTA, 'Delta'), # `data` holds delta against the previous revision
+    ]
+    id = models.UUIDField(primary_key=True, default=uuid4, editable=False)
+    note = models.ForeignKey(Note, on_delete=models.CASCADE, related_name='revisions')
+    version = models.PositiveIntegerField()
+    title = models.CharField(max_length=255)
+    is_encrypted = models.BooleanField()
+    body_format = models.CharField(max_length=7, choices=Note.BODY_FORMAT_CHOICES)
+    body_size = models.BigIntegerField(null=True, blank=True)
+    kind = models.CharField(max_length=1, choices=KIND_CHOICES)
+    data = models.BinaryField()
+    author = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, on_delete=models.SET_NULL, related_name='note_revisions')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def get_keyframe_body(self):
+        """Body of keyframe revision as it was written."""
+        if self.body_size is not None:
+            return b''.join(iter_manifest(self.chunks.all(), 0, self.body_size - 1))
+        if self.body_format == Note.TEXT_BODY:
+            return unpack_body(self.data)
+        return self.data
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['note', 'version'], name='unique_note_revision'),
+        ]
+
+
+class NoteBodyChunk(models.Model):
+    """
+    Entry of a body manifest - uploaded part (`upload` is set), part of revision's body (`revision` is set) or part of the note's body (neither is set).
+    Body is the blobs ordered by index. Unused blobs are removed by `delete_unused_note_blobs` command.
+    """
+    note = models.ForeignKey(Note, on_delete=models.CASCADE, related_name='chunks')
+    upload = models.ForeignKey(NoteUpload, null=True, on_delete=models.CASCADE, related_name='chunks')
+    revision = models.ForeignKey(NoteRevision, null=True, on_delete=models.CASCADE, related_name='chunks')
+    index = models.PositiveIntegerField()
+    offset = models.BigIntegerField() # Position of the chunk in the body - lets ranged downloads fetch only the chunks they need
+    blob = models.ForeignKey(NoteBodyBlob, on_delete=models.PROTECT, related_name='chunks')
+
+    @classmethod
+    def of_bodies(cls, notes):
+        """Manifest entries of current bodies of given notes."""
+        return cls.objects.filter(note__in=notes, upload=None, revision=None)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['note', 'index'], condition=models.Q(upload__isnull=True, revision__isnull=True), name='unique_note_body_chunk'),
+            models.UniqueConstraint(fields=['upload', 'index'], condition=models.Q(upload__isnull=False), name='unique_note_upload_chunk'),
+            models.UniqueConstraint(fields=['revision', 'index'], condition=models.Q(revision__isnull=False), name='unique_note_revision_chunk'),
+        ]
+
+
+def iter_manifest(manifest, start, end):
+    """Yield bytes start..end (inclusive) of body described by manifest queryset. Only chunks overlapping the range are fetched, one by one."""
+    chunks = manifest.filter(offset__lte=end, offset__gt=start - F('blob__size')) \
+        .order_by('index') \
+        .values_list('offset', 'blob__data', 'blob__is_compressed') \
+        .iterator(chunk_size=1)
+    for offset, data, is_compressed in chunks:
+        data = memoryview(decompress_chunk(data, is_compressed))
+        yield bytes(data[max(start - offset, 0):end - offset + 1])
+
+
+def write_search_vectors(notes):
+    """Update search vectors of given (already saved, with body chunks written) notes with one query."""
+    if not notes:
+        return
+    vectors = []
+    for note in notes:
+        text = note.get_search_text()
+        vectors.append(When(pk=note.pk, then=search_vector(note.title, text) if text is not None else Cast(None, SearchVectorField()))) # Typed NULL - untyped one would make CASE text
+    Note.objects.filter(pk__in=[note.pk for note in notes]).update(search_vector=Case(*vectors, output_field=SearchVectorField()))
+
+
+def write_body_chunks(notes):
+    """
+    Replace body manifests of given (already saved) notes with chunks prepared by Note.set_body().
+    Only chunks missing in the store are sent to db, so editing a long note writes just the chunks around the edit (and the small manifest).
+    """
+    notes = [note for note in notes if '_new_chunks' in note.__dict__]
+    if not notes:
+        return
+
+    blobs = {}
+    manifest = []
+    for note in notes:
+        chunks, compress = note.__dict__.pop('_new_chunks')
+        offset = 0
+        for index, chunk in enumerate(chunks):
+            chunk_digest = digest(chunk)
+            blobs.setdefault(chunk_digest, (chunk, compress))
+            manifest.append(NoteBodyChunk(note=note, index=index, offset=offset, blob_id=chunk_digest))
+            offset += len(chunk)
+
+    NoteBodyChunk.of_bodies(notes).delete()
+    if not manifest:
+        return
+    stored_digests = set(NoteBodyBlob.objects.filter(digest__in=blobs).values_list('digest', flat=True))
+    NoteBodyBlob.objects.bulk_create([
+        NoteBodyBlob.from_chunk(chunk_digest, chunk, compress) for chunk_digest, (chunk, compress) in blobs.items() if chunk_digest not in stored_digests
+    ], ignore_conflicts=True) # Another writer may store the same chunk concurrently
+    NoteBodyChunk.objects.bulk_create(manifest)
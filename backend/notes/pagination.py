@@ -0,0 +1,121 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from uuid import UUID
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class NoteKeysetPagination(BasePagination):
+    """
+    Keyset (seek) pagination over NoteItems ordered by (note title, note id).
+    Unlike offset pagination every page is a single indexed range scan no matter how deep the client is,
+    and the cursor stays valid when notes are added or removed between requests.
+    Pagination is opt-in: without `cursor` or `page_size` query params the whole queryset is returned (keeps old clients working).
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    ordering = ('note__title', 'note__id')
+    invalid_cursor_message = 'Invalid cursor'
+    is_optional = True
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.is_optional and self.cursor_query_param not in request.query_params and self.page_size_query_param not in request.query_params:
+            return None # Client didn't ask for pagination
+
+        self.request = request
+        self.page_size = self.get_page_size(request)
+
+        queryset = queryset.order_by(*self.ordering)
+        if cursor := self.decode_cursor(request):
+            queryset = queryset.filter(self.seek(*cursor)) # Seek past the last row of the previous page
+
+        page = list(queryset[:self.page_size + 1]) # Fetch one extra row to know if there is a next page without running COUNT(*)
+        self.has_next = len(page) > self.page_size
+        self.page = page[:self.page_size]
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(request.query_params[self.page_size_query_param], strict=True, cutoff=settings.NOTES_MAX_PAGE_SIZE)
+        except (KeyError, ValueError):
+            return settings.NOTES_PAGE_SIZE
+
+    def seek(self, title, note_id):
+        """Condition selecting rows after given position in `ordering`."""
+        return Q(note__title__gt=title) | Q(note__title=title, note__id__gt=note_id)
+
+    def get_position(self, note_item):
+        return [note_item.note.title, str(note_item.note.id)]
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            position = json.loads(urlsafe_b64decode(encoded.encode('ascii')))
+        except (TypeError, ValueError, BinasciiError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        try:
+            return self.validate_position(*position) # Values end up in the query - malformed ones must not reach the db
+        except (TypeError, ValueError, AttributeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def validate_position(self, title, note_id):
+        if not isinstance(title, str):
+            raise TypeError('title must be a string')
+        return [title, UUID(note_id)]
+
+    def encode_cursor(self, note_item):
+        position = json.dumps(self.get_position(note_item))
+        return urlsafe_b64encode(position.encode(settings.DEFAULT_ENCODING)).decode('ascii')
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.page_size_query_param, self.page_size)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class NoteSearchPagination(NoteKeysetPagination):
+    """
+    Keyset pagination of search results ordered by rank (best first) - expects NoteItems annotated with `rank`. Always paginated.
+    `rank` must be cast to float8 (ts_rank returns float4) - the cursor carries a double and tied rows would be skipped otherwise.
+    """
+    ordering = ('-rank', 'note__id')
+    is_optional = False
+
+    def seek(self, rank, note_id):
+        return Q(rank__lt=rank) | Q(rank=rank, note__id__gt=note_id)
+
+    def get_position(self, note_item):
+        return [note_item.rank, str(note_item.note.id)]
+
+    def validate_position(self, rank, note_id):
+        if isinstance(rank, bool) or not isinstance(rank, (int, float)):
+            raise TypeError('rank must be a number')
+        return [rank, UUID(note_id)]
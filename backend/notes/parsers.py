@@ -0,0 +1,16 @@
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+
+class RawBytesParser(BaseParser):
+    """Parse `application/octet-stream` request into raw bytes, so that binary bodies (e.g. ciphertext) are stored as they are without any transcoding."""
+    media_type = 'application/octet-stream'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if stream is None: # Empty request
+            return b''
+        data = stream.read(settings.NOTES_MAX_BODY_SIZE + 1)
+        if len(data) > settings.NOTES_MAX_BODY_SIZE:
+            raise ParseError(f'Body cannot be larger than {settings.NOTES_MAX_BODY_SIZE} bytes.')
+        return data
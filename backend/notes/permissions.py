@@ -1,47 +1,84 @@
 from rest_framework.permissions import BasePermission
 from django.apps import apps
 from django.conf import settings
+from django.db.models import OuterRef, Subquery
+from app.caching import MISSING
+from .acl import get_cached_permission, cache_permission
 from .models import NoteItem
 
 
+def get_request_user_key(request):
+    """
+    Return active UserKey of the user making the request (None if user has no UserKey). The result is memoized on the request.
+    Key is always read from db - key id in token claims may be stale (rotated, deleted or created on another device) and NoteItems written with it would be orphaned.
+    """
+    if not hasattr(request, '_user_key'):
+        UserKey = apps.get_model(settings.AUTH_USER_KEY_MODEL)
+        request._user_key = UserKey.objects.active().filter(user=request.user.id).first()
+    return request._user_key
+
+
+def get_note_permission(request, note):
+    """
+    Return permission ('R', 'W', 'S', 'O') of the user making the request to the note or None if user has no access.
+    Permission is looked up in the shared ACL cache first. On cache miss both user's UserKey and their NoteItem permission
+    are loaded in one query. Result is memoized on the request so that permission classes, serializers and the view don't look it up again.
+    """
+    if not hasattr(request, '_note_permissions'):
+        request._note_permissions = {}
+    permissions = request._note_permissions
+    if note.pk in permissions:
+        return permissions[note.pk]
+
+    permission = get_cached_permission(request.user.id, note.pk) # Shared ACL cache is checked before going to db
+    if permission is not MISSING:
+        permissions[note.pk] = permission
+        return permission
+
+    if hasattr(request, '_user_key'): # UserKey already resolved during this request - only NoteItem is left to fetch
+        user_key = get_request_user_key(request)
+        permission = NoteItem.objects.filter(note=note.pk, user_key=user_key).values_list('permission', flat=True).first() if user_key else None
+    else:
+        UserKey = apps.get_model(settings.AUTH_USER_KEY_MODEL)
+        note_permission = NoteItem.objects.filter(note=note.pk, user_key=OuterRef('pk')).values('permission')[:1]
+        user_key = UserKey.objects.active().filter(user=request.user.id).annotate(note_permission=Subquery(note_permission)).first()
+        request._user_key = user_key
+        permission = user_key.note_permission if user_key else None
+
+    cache_permission(request.user.id, note.pk, permission)
+    permissions[note.pk] = permission
+    return permission
+
+
 class HasAccessToNote(BasePermission):
 
     def has_permission(self, request, view):
         """Check if user has general permission to access the endpoint"""
         return bool(request.user and request.user.is_authenticated)
 
-    def check_note_permission(self, user, note, required_permissions):
-        if note.owner == user:
+    def check_note_permission(self, request, note, required_permissions):
+        if note.owner_id == request.user.id: # Compare ids in order not to load the owner from db
             return True
 
-        try:
-            UserKey = apps.get_model(settings.AUTH_USER_KEY_MODEL) # Get UserKey Model as UserKey has relation with NoteItem (and we want NoteItem as NoteItem has info about permission of current user to the note)
-            user_key = UserKey.objects.get(user=user) # Query for user's UserKey
-            note_item = NoteItem.objects.get(note=note, user_key=user_key) # Query for NoteItem
-            return note_item.permission in required_permissions # Check if user's permission is in the list of required permissions for a given action
-        except (UserKey.DoesNotExist, NoteItem.DoesNotExist):
-            return False
-        except Exception:
-            raise
+        return get_note_permission(request, note) in required_permissions # Check if user's permission is in the list of required permissions for a given action
 
 
 class CanReadNote(HasAccessToNote):
     def has_object_permission(self, request, view, obj):
-        return self.check_note_permission(request.user, obj, ['R', 'W', 'S', 'O'])
+        return self.check_note_permission(request, obj, ['R', 'W', 'S', 'O'])
 
 class CanWriteNote(HasAccessToNote):
     def has_object_permission(self, request, view, obj):
-        return self.check_note_permission(request.user, obj, ['W', 'S', 'O'])
+        return self.check_note_permission(request, obj, ['W', 'S', 'O'])
 
 class CanShareNote(HasAccessToNote):
     def has_object_permission(self, request, view, obj):
-        return self.check_note_permission(request.user, obj, ['S', 'O'])
+        return self.check_note_permission(request, obj, ['S', 'O'])
 
 class CanDeleteNote(HasAccessToNote):
     def has_object_permission(self, request, view, obj):
-        return self.check_note_permission(request.user, obj, ['O'])
+        return self.check_note_permission(request, obj, ['O'])
 
 class CanChangeEncryption(HasAccessToNote):
     def has_object_permission(self, request, view, obj):
-        return self.check_note_permission(request.user, obj, ['O'])
-
+        return self.check_note_permission(request, obj, ['O'])
@@ -0,0 +1,123 @@
+import json
+import logging
+import zlib
+from difflib import SequenceMatcher
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+
+from .compression import pack_body
+from .models import Note, NoteRevision, NoteBodyChunk
+
+
+logger = logging.getLogger(__name__)
+
+
+def encode_delta(base, target):
+    """
+    Line based delta turning base text into target - list of [start, end] (copy lines start..end of base) and strings (inserted text),
+    JSON encoded and compressed. Unchanged lines cost a few bytes no matter how long they are.
+    """
+    base_lines = str(base, settings.DEFAULT_ENCODING).splitlines(keepends=True)
+    target_lines = str(target, settings.DEFAULT_ENCODING).splitlines(keepends=True)
+    operations = []
+    for tag, base_start, base_end, target_start, target_end in SequenceMatcher(None, base_lines, target_lines, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            operations.append([base_start, base_end])
+        elif target_end > target_start: # Replaced or inserted lines (deleted ones are just not copied)
+            operations.append(''.join(target_lines[target_start:target_end]))
+    return zlib.compress(json.dumps(operations, separators=(',', ':')).encode(), settings.NOTES_BODY_COMPRESSION_LEVEL)
+
+
+def apply_delta(base, delta):
+    base_lines = str(base, settings.DEFAULT_ENCODING).splitlines(keepends=True)
+    operations = json.loads(zlib.decompress(delta))
+    return ''.join(operation if isinstance(operation, str) else ''.join(base_lines[operation[0]:operation[1]]) for operation in operations).encode(settings.DEFAULT_ENCODING)
+
+
+def _can_delta(revision_or_note):
+    return not revision_or_note.is_encrypted and revision_or_note.body_format == Note.TEXT_BODY and revision_or_note.body_size is None
+
+
+def _chains(note_ids, up_to_version=None):
+    """Load revisions from the last keyframe onwards (up to given version) of every note - one query. Returns {note_id: [revision, ...]}."""
+    keyframes = NoteRevision.objects.filter(note=OuterRef('note'), kind=NoteRevision.KEYFRAME)
+    revisions = NoteRevision.objects.filter(note__in=note_ids)
+    if up_to_version is not None:
+        keyframes = keyframes.filter(version__lte=up_to_version)
+        revisions = revisions.filter(version__lte=up_to_version)
+    last_keyframe = keyframes.order_by('-version').values('version')[:1]
+
+    chains = {}
+    for revision in revisions.filter(version__gte=Subquery(last_keyframe)).order_by('note', 'version'):
+        chains.setdefault(revision.note_id, []).append(revision)
+    return chains
+
+
+def _reconstruct(chain):
+    body = chain[0].get_keyframe_body()
+    for revision in chain[1:]:
+        body = apply_delta(body, revision.data)
+    return body
+
+
+def get_revision_body(revision):
+    """Return body of the revision as it was written (deltas are applied to the preceding keyframe)."""
+    if revision.kind == NoteRevision.KEYFRAME:
+        return revision.get_keyframe_body()
+    return _reconstruct(_chains([revision.note_id], up_to_version=revision.version)[revision.note_id])
+
+
+def record_revisions(notes, author_id):
+    """
+    Record current state of given (just saved) notes as their revisions - call within the transaction that changed the notes.
+    Bodies of large notes are not copied, revisions reference the same chunks in the chunk store.
+    """
+    chains = _chains([note.pk for note in notes if _can_delta(note)])
+    revisions = []
+    for note in notes:
+        revision = NoteRevision(note=note, version=note.version, title=note.title, is_encrypted=note.is_encrypted, body_format=note.body_format,
+                                body_size=note.body_size, author_id=author_id, kind=NoteRevision.KEYFRAME, data=note.body)
+        chain = chains.get(note.pk)
+        if chain and _can_delta(chain[0]) and len(chain) < settings.NOTES_REVISION_KEYFRAME_INTERVAL: # Keyframe now and then bounds the cost of reading a revision
+            delta = encode_delta(_reconstruct(chain), note.get_body())
+            if len(delta) < len(note.body):
+                revision.kind = NoteRevision.DELTA
+                revision.data = delta
+        revisions.append(revision)
+    NoteRevision.objects.bulk_create(revisions)
+
+    revisions_by_note = {revision.note_id: revision for revision in revisions if revision.body_size is not None}
+    NoteBodyChunk.objects.bulk_create([
+        NoteBodyChunk(note_id=note_id, revision=revisions_by_note[note_id], index=index, offset=offset, blob_id=blob_id)
+        for note_id, index, offset, blob_id in NoteBodyChunk.of_bodies(revisions_by_note).values_list('note', 'index', 'offset', 'blob')
+    ])
+
+    for note in notes:
+        if note.version % settings.NOTES_REVISIONS_COMPACT_INTERVAL == 0:
+            transaction.on_commit(lambda note_id=note.pk: _schedule_compaction(note_id))
+
+
+def _schedule_compaction(note_id):
+    from .tasks import compact_note_revisions
+    try:
+        compact_note_revisions.delay(note_id)
+    except Exception: # Change is saved already - compaction will be scheduled again by one of the next changes
+        logger.warning('Could not schedule compaction of revisions of note %s', note_id, exc_info=True)
+
+
+def compact_revisions(note_id):
+    """Keep only `NOTES_REVISIONS_MAX` latest revisions of the note - the oldest kept one becomes a keyframe if it's a delta. Returns number of deleted revisions."""
+    oldest_kept_version = NoteRevision.objects.filter(note=note_id).order_by('-version').values_list('version', flat=True)[settings.NOTES_REVISIONS_MAX - 1:settings.NOTES_REVISIONS_MAX]
+    if not oldest_kept_version:
+        return 0
+
+    with transaction.atomic():
+        oldest_kept = NoteRevision.objects.select_for_update().get(note=note_id, version=oldest_kept_version[0])
+        if oldest_kept.kind == NoteRevision.DELTA: # Deltas are plaintext text bodies only
+            oldest_kept.data = pack_body(get_revision_body(oldest_kept), oldest_kept.is_encrypted)
+            oldest_kept.kind = NoteRevision.KEYFRAME
+            oldest_kept.save(update_fields=['data', 'kind'])
+        deleted, deleted_by_model = NoteRevision.objects.filter(note=note_id, version__lt=oldest_kept.version).delete()
+    return deleted_by_model.get(NoteRevision._meta.label, 0)
@@ -0,0 +1,40 @@
+import html
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchVector
+from django.db import connection
+from django.db.models import Value
+from django.utils.html import strip_tags
+
+
+HEADLINE_OPTIONS = 'StartSel=<mark>, StopSel=</mark>, MaxWords=35, MinWords=15'
+
+
+def extract_text(body):
+    """Plain text of the (editor's HTML) body that is indexed - tags are stripped and length is capped as tsvector size is limited."""
+    text = html.unescape(strip_tags(str(body, settings.DEFAULT_ENCODING, errors='replace')))
+    return text.replace('\x00', '')[:settings.NOTES_SEARCH_MAX_TEXT_LENGTH] # Postgres text can't hold NUL
+
+
+def search_vector(title, text):
+    """Expression computing search vector of a note - matches in the title rank above matches in the body."""
+    config = settings.NOTES_SEARCH_CONFIG
+    return SearchVector(Value(title), weight='A', config=config) + SearchVector(Value(text), weight='B', config=config)
+
+
+def search_query(query):
+    """Query in web search syntax (`"quoted phrase"`, `or`, `-excluded`) - never fails on user's input."""
+    return SearchQuery(query, search_type='websearch', config=settings.NOTES_SEARCH_CONFIG)
+
+
+def headlines(texts, query):
+    """Snippets of given texts with matches of the query wrapped in <mark> - one query for all of them. Texts are HTML escaped first."""
+    if not texts:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT ts_headline(%s::regconfig, text, websearch_to_tsquery(%s::regconfig, %s), %s) '
+            'FROM unnest(%s::text[]) WITH ORDINALITY AS texts(text, position) ORDER BY position',
+            [settings.NOTES_SEARCH_CONFIG, settings.NOTES_SEARCH_CONFIG, query, HEADLINE_OPTIONS, [html.escape(text) for text in texts]]
+        )
+        return [headline for headline, in cursor.fetchall()]
@@ -1,8 +1,15 @@
+import base64
+import binascii
+
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
+from django.db import transaction
 from rest_framework import serializers
 
-from .models import Note, NoteItem
+from .models import Note, NoteItem, NoteSearchToken, NoteUpload, NoteRevision
+from .permissions import get_request_user_key
+from .exceptions import PreconditionFailed
+from .revisions import record_revisions, get_revision_body
 
 
 
@@ -13,61 +20,115 @@ class NoteItemSerializer(serializers.ModelSerializer):
         fields = ['id', 'note', 'user_key', 'encryption_key', 'permission']
 
 
-class BaseNoteSerializer(serializers.ModelSerializer):
-    body = serializers.CharField(required=True, allow_blank=True)
+def decode_binary(value):
+    """Decode BinaryField value to str. str() decodes memoryview returned by postgres directly - without copying it to bytes first."""
+    return str(value, settings.DEFAULT_ENCODING)
 
-    def validate_body(self, value):
-        # if not value:
-            # raise serializers.ValidationError("Body is required.")
-        return value.encode(settings.DEFAULT_ENCODING)
 
-    def to_representation(self, instance):
-        data = super().to_representation(instance) # Get data
-        if instance.body:
-            body_bytes = bytes(instance.body) # convert body from the request to binary (cuz postgres returns memoryview object which doesn't have decode method)
-            decoded_body = body_bytes.decode(settings.DEFAULT_ENCODING) # now decode the body to in order to print readable result in the JSON response
-            data['body'] = decoded_body if decoded_body else ''
-        else:
-            data['body'] = ''
+def represent_body(body, body_format):
+    """JSON representation of body as it was written - text as str, binary as base64 and chunked as null."""
+    if body_format == Note.CHUNKED_BODY:
+        return None
+    if body_format == Note.BINARY_BODY:
+        return base64.b64encode(body).decode('ascii')
+    return decode_binary(body)
+
+
+class NoteBodyField(serializers.Field):
+    """
+    Note's body together with its format (reads the whole note - `source='*'` by default).
+    JSON writes are always text. Text bodies are returned as str and binary ones (uploaded as application/octet-stream) as base64.
+    Chunked bodies are returned as null - they can be downloaded (also by ranges) via `body` endpoint only.
+    With `read_chunks=False` (listings) bodies kept in the chunk store (`body_size` is set) are returned as null as well - reading them
+    would cost a query and the whole body in memory per listed note. Clients fetch them via `bodies` or `body` endpoint.
+    """
+    default_error_messages = {
+        'invalid': 'Not a valid string.',
+    }
+
+    def __init__(self, read_chunks=True, **kwargs):
+        self.read_chunks = read_chunks
+        kwargs.setdefault('source', '*')
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        if not isinstance(data, str):
+            self.fail('invalid')
+        return {'body': data.encode(settings.DEFAULT_ENCODING), 'body_format': Note.TEXT_BODY}
+
+    def to_representation(self, note):
+        if note.body_format == Note.CHUNKED_BODY or (note.body_size is not None and not self.read_chunks):
+            return None
+        return represent_body(note.get_body(), note.body_format)
+
+
+class SearchTokenField(serializers.Field):
+    """Blind index token - base64 encoded keyed HMAC (16 to 64 bytes) of a word of the note."""
+    default_error_messages = {
+        'invalid': 'Token must be base64 encoded 16 to 64 bytes.',
+    }
+
+    def to_internal_value(self, data):
+        try:
+            token = base64.b64decode(data, validate=True)
+        except (TypeError, binascii.Error):
+            self.fail('invalid')
+        if not 16 <= len(token) <= 64:
+            self.fail('invalid')
+        return token
+
+    def to_representation(self, value):
+        return base64.b64encode(value).decode('ascii')
+
+
+def search_tokens_field(**kwargs):
+    return serializers.ListField(child=SearchTokenField(), max_length=settings.NOTES_SEARCH_MAX_TOKENS, **kwargs)
 
-        return data
+
+class BaseNoteSerializer(serializers.ModelSerializer):
+    body = NoteBodyField(required=True)
 
 
 class NotesSerializer(BaseNoteSerializer):
     noteitem = NoteItemSerializer(many=True, required=False)
     encryption_key = serializers.CharField(write_only=True, required=False)
-    body = serializers.CharField(required=True, allow_blank=True)
+    search_tokens = search_tokens_field(write_only=True, required=False) # Blind index of the (encrypted) body for current user
 
     class Meta:
         model = Note
-        fields = ['id', 'title', 'body', 'owner', 'is_encrypted', 'created_at', 'encryption_key', 'noteitem']
-        read_only_fields = ['owner', 'noteitem']
+        fields = ['id', 'title', 'body', 'body_format', 'body_size', 'owner', 'is_encrypted', 'created_at', 'version', 'encryption_key', 'search_tokens', 'noteitem']
+        read_only_fields = ['owner', 'body_format', 'body_size', 'version', 'noteitem']
 
     def create(self, validated_data):
         request = self.context.get('request', None)
         is_encrypted = validated_data.get('is_encrypted', False)
         encryption_key = validated_data.pop('encryption_key', None)
+        search_tokens = validated_data.pop('search_tokens', None)
 
         if not hasattr(request, 'user') or isinstance(request.user, AnonymousUser): # If request doesn't have attribute user or user if the instance of AnonymousUser
             raise serializers.ValidationError({'detail': 'No User matches the given query.'})
 
-        # If request and hasattr(request, 'user'): 
-        validated_data['owner'] = request.user # Get currently logged in user and save it as a note owner
-        note = Note.objects.create(**validated_data) # create Note object
+        user_key = get_request_user_key(request) # User without public_key cannot encrypt/decrypt the note thus UserKey record for a user is required (resolved once per request)
+        if not user_key: # Checked before the note is saved so that no note without NoteItem is left behind
+            raise serializers.ValidationError({'non_field_errors': ['Public key is required for encrypted notes.']})
 
-        get_user_key = self.context.get('get_user_key') # This is a function created in a NotesViewSet to verify if the user has associated UserKey object - as user without public_key cannot encrypt/decrypt the note thus UserKey record for a user is required
-        if get_user_key:
-            user_key = get_user_key([request.user.id])
-            if not user_key:
-                raise serializers.ValidationError({'non_field_errors': ['Public key is required for encrypted notes.']})
+        # If request and hasattr(request, 'user'): 
+        validated_data['owner_id'] = request.user.id # Get currently logged in user and save it as a note owner (by id - request.user may be built from token claims)
+        note = Note(**validated_data)
+        note.set_text_body(validated_data['body']) # Compresses plaintext bodies
+        with transaction.atomic():
+            note.save() # create Note object
+            record_revisions([note], request.user.id)
 
         # If note is not encrypted than don't create encryption key for this NoteItem as it's not necessary
         if request and is_encrypted == False:
-            NoteItem.objects.create(
+            note_item = NoteItem.objects.create(
                 note=note,
                 user_key=user_key,
                 permission='O'
             )
+            if search_tokens is not None:
+                NoteSearchToken.replace(note_item, search_tokens)
             return note
 
         # If the reuqest has is_encrypted=True but encryption_key is not provided return a response
@@ -75,12 +136,14 @@ class NotesSerializer(BaseNoteSerializer):
             raise serializers.ValidationError({'detail': ['\'encryption_key\' field is required for encrypted notes']})
 
         if request and encryption_key: # If encryption_key exists and is_encrypted == True create NoteItem object with encryption key for current user
-            NoteItem.objects.create(
+            note_item = NoteItem.objects.create(
                 note=note,
                 user_key=user_key,
                 encryption_key=encryption_key.encode(settings.DEFAULT_ENCODING), # Convert string to bytes for BinaryField
                 permission='O'
             )
+            if search_tokens is not None:
+                NoteSearchToken.replace(note_item, search_tokens)
 
         return note
 
@@ -88,21 +151,18 @@ class NotesSerializer(BaseNoteSerializer):
 class NoteMeSerializer(serializers.ModelSerializer):
     id = serializers.CharField(source='note.id')
     title = serializers.CharField(source='note.title')
-    body = serializers.SerializerMethodField(method_name='get_body')
+    body = NoteBodyField(source='note', read_chunks=False) # Null for bodies in the chunk store (see `body_size`) - keeps listings at a constant number of queries
+    body_format = serializers.CharField(source='note.body_format')
+    body_size = serializers.IntegerField(source='note.body_size')
     owner = serializers.SerializerMethodField()
     is_encrypted = serializers.BooleanField(source='note.is_encrypted')
     created_at = serializers.DateField(source='note.created_at')
+    version = serializers.IntegerField(source='note.version')
     encryption_key = serializers.SerializerMethodField()
 
     class Meta:
         model = NoteItem
-        fields = ['id', 'title', 'body', 'owner', 'is_encrypted', 'created_at', 'encryption_key', 'permission']
-
-    def get_body(self, obj):
-        if obj.note.body:
-            body_bytes = bytes(obj.note.body)
-            return body_bytes.decode(settings.DEFAULT_ENCODING)
-        return ""
+        fields = ['id', 'title', 'body', 'body_format', 'body_size', 'owner', 'is_encrypted', 'created_at', 'version', 'encryption_key', 'permission']
 
     def get_owner(self, obj):
         if obj.note.owner:
@@ -111,17 +171,124 @@ class NoteMeSerializer(serializers.ModelSerializer):
 
     def get_encryption_key(self, obj):
         if obj.encryption_key:
-            return bytes(obj.encryption_key).decode(settings.DEFAULT_ENCODING) # Get encryption key if it exists (this field is empty if notes are not encrypted)
+            return decode_binary(obj.encryption_key) # Get encryption key if it exists (this field is empty if notes are not encrypted)
         return None
 
 
+class NoteSummarySerializer(NoteMeSerializer):
+    """NoteMeSerializer without the body - used for listing notes when the body is fetched lazily (and deferred on the ORM level)."""
+    body = None
+
+    class Meta(NoteMeSerializer.Meta):
+        fields = ['id', 'title', 'body_format', 'body_size', 'owner', 'is_encrypted', 'created_at', 'version', 'encryption_key', 'permission']
+
+
+class NoteSearchResultSerializer(NoteSummarySerializer):
+    """Note found by full-text search - `snippet` holds HTML escaped fragments of the body with matches wrapped in <mark>."""
+    rank = serializers.FloatField()
+    snippet = serializers.CharField()
+
+    class Meta(NoteSummarySerializer.Meta):
+        fields = NoteSummarySerializer.Meta.fields + ['rank', 'snippet']
+
+
+class NoteTitleSearchResultSerializer(NoteSummarySerializer):
+    similarity = serializers.FloatField()
+
+    class Meta(NoteSummarySerializer.Meta):
+        fields = NoteSummarySerializer.Meta.fields + ['similarity']
+
+
+class NoteBodySerializer(BaseNoteSerializer):
+    class Meta:
+        model = Note
+        fields = ['id', 'body', 'body_format', 'body_size']
+        read_only_fields = ['body_format', 'body_size']
+
+
+class NoteBodyEditSerializer(serializers.Serializer):
+    offset = serializers.IntegerField(min_value=0)
+    length = serializers.IntegerField(min_value=0, default=0)
+    data = serializers.CharField(allow_blank=True, trim_whitespace=False, default='') # Text for text bodies, base64 for other ones
+
+
+class NoteBodyPatchSerializer(serializers.Serializer):
+    """Diff of note's body against `base_version` - byte offsets refer to body as it was written (see `body` endpoint). Expects `note` in context."""
+    base_version = serializers.IntegerField(min_value=0)
+    edits = NoteBodyEditSerializer(many=True, allow_empty=False)
+
+    def validate_edits(self, edits):
+        for previous, edit in zip(edits, edits[1:]):
+            if edit['offset'] < previous['offset'] + previous['length']:
+                raise serializers.ValidationError('Edits must be sorted by offset and must not overlap.')
+
+        if self.context['note'].body_format == Note.TEXT_BODY:
+            return [(edit['offset'], edit['length'], edit['data'].encode(settings.DEFAULT_ENCODING)) for edit in edits]
+        try:
+            return [(edit['offset'], edit['length'], base64.b64decode(edit['data'], validate=True)) for edit in edits]
+        except binascii.Error:
+            raise serializers.ValidationError('Data of binary body edits must be base64 encoded.')
+
+
+class NoteRevisionSerializer(serializers.ModelSerializer):
+    author = serializers.CharField(source='author.username', read_only=True, default=None)
+
+    class Meta:
+        model = NoteRevision
+        fields = ['id', 'version', 'title', 'is_encrypted', 'body_format', 'body_size', 'author', 'created_at']
+
+
+class NoteRevisionDetailSerializer(NoteRevisionSerializer):
+    body = serializers.SerializerMethodField()
+
+    class Meta(NoteRevisionSerializer.Meta):
+        fields = NoteRevisionSerializer.Meta.fields + ['body']
+
+    def get_body(self, revision):
+        if revision.body_format == Note.CHUNKED_BODY:
+            return None
+        return represent_body(get_revision_body(revision), revision.body_format)
+
+
+class NoteUploadSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = NoteUpload
+        fields = ['id', 'base_version', 'chunk_size', 'created_at']
+
+
+class NoteUploadCommitSerializer(serializers.Serializer):
+    parts = serializers.IntegerField(min_value=1, required=True)
+    sha256 = serializers.RegexField(r'^[0-9a-fA-F]{64}$', required=True) # Hex digest of the whole body
+
+
+class NoteBodiesRequestSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.UUIDField(), allow_empty=False, max_length=settings.NOTES_MAX_PAGE_SIZE)
+
+
 class NotesDetailSerializer(BaseNoteSerializer):
     encryption_key = serializers.CharField(write_only=True, required=False)
-    body = serializers.CharField(required=True, allow_blank=True)
+    search_tokens = search_tokens_field(write_only=True, required=False) # Blind index of the new body for current user
     class Meta:
         model = Note
-        fields = ['id', 'title', 'body', 'is_encrypted', 'created_at', 'encryption_key', 'noteitem']
-        read_only_fields = ['id', 'is_encrypted', 'created_at', 'noteitem']
+        fields = ['id', 'title', 'body', 'body_format', 'is_encrypted', 'created_at', 'version', 'encryption_key', 'search_tokens', 'noteitem']
+        read_only_fields = ['id', 'body_format', 'is_encrypted', 'created_at', 'version', 'noteitem']
+
+    def update(self, instance, validated_data):
+        """Save changes only if nobody changed the note since it was loaded (compare-and-swap on version), otherwise respond with 412."""
+        request = self.context['request']
+        validated_data.pop('encryption_key', None)
+        search_tokens = validated_data.pop('search_tokens', None)
+        for field, value in validated_data.items():
+            setattr(instance, field, value)
+        if 'body' in validated_data:
+            instance.set_text_body(validated_data['body']) # Compresses plaintext bodies
+        with transaction.atomic():
+            if not instance.compare_and_swap(list(validated_data)):
+                raise PreconditionFailed()
+            record_revisions([instance], request.user.id)
+            if search_tokens is not None and (note_item := NoteItem.objects.filter(note=instance, user_key=get_request_user_key(request)).first()):
+                NoteSearchToken.replace(note_item, search_tokens) # Written together with the body so the index never describes another version
+        return instance
 
 
 class UserKeyInfoSerializer(serializers.Serializer):
@@ -139,7 +306,7 @@ class UserKeyInfoSerializer(serializers.Serializer):
 
     def get_key(self, obj):
         if key := obj.user_key.public_key: # If user has assiciated user_key record (although always should have one) return readable representation of this key
-            return bytes(key).decode(settings.DEFAULT_ENCODING)
+            return decode_binary(key)
         return None
 
 
@@ -198,6 +365,94 @@ class ShareEncryptedNoteSerializer(serializers.Serializer):
         fields = ['id', 'user', 'encryption_key', 'permission']
 
 
+class BulkShareEntrySerializer(serializers.Serializer):
+    user = serializers.UUIDField(required=True)
+    permission = serializers.ChoiceField(choices=NoteItem.PERMISSIONS_CHOICES, required=True, allow_blank=False)
+    encryption_key = serializers.CharField(write_only=True, required=False, allow_blank=False)
+
+    def validate(self, attrs):
+        note = self.context.get('note')
+        if note and note.is_encrypted and not attrs.get('encryption_key'):
+            raise serializers.ValidationError({'encryption_key': ['This field is required for encrypted notes.']})
+        return attrs
+
+
+class BulkShareNoteSerializer(serializers.Serializer):
+    shares = BulkShareEntrySerializer(many=True, allow_empty=False, max_length=settings.NOTES_MAX_PAGE_SIZE)
+
+    def validate_shares(self, value):
+        user_ids = [share['user'] for share in value]
+        if len(user_ids) != len(set(user_ids)):
+            raise serializers.ValidationError('Each user can be listed only once.')
+        return value
+
+
+class NoteBatchOperationSerializer(serializers.Serializer):
+    CREATE = 'create'
+    UPDATE = 'update'
+    DELETE = 'delete'
+    OPERATIONS_CHOICES = [CREATE, UPDATE, DELETE]
+
+    op = serializers.ChoiceField(choices=OPERATIONS_CHOICES, required=True)
+    id = serializers.UUIDField(required=False)
+    title = serializers.CharField(max_length=255, required=False)
+    body = serializers.CharField(required=False, allow_blank=True)
+    is_encrypted = serializers.BooleanField(required=False, default=False)
+    encryption_key = serializers.CharField(write_only=True, required=False, allow_blank=False)
+    version = serializers.IntegerField(required=False, min_value=1) # Optional for update - if given, note is updated only if it's still at this version
+
+    def validate(self, attrs):
+        op = attrs['op']
+        required_fields = {
+            self.CREATE: ['title', 'body'],
+            self.UPDATE: ['id', 'title', 'body'],
+            self.DELETE: ['id'],
+        }[op]
+        if op == self.CREATE and attrs.get('is_encrypted'):
+            required_fields = required_fields + ['encryption_key']
+
+        errors = {field: [f'This field is required for \'{op}\' operation.'] for field in required_fields if field not in attrs}
+        if errors:
+            raise serializers.ValidationError(errors)
+
+        if 'body' in attrs:
+            attrs['body'] = attrs['body'].encode(settings.DEFAULT_ENCODING)
+        return attrs
+
+
+class NoteBatchSerializer(serializers.Serializer):
+    operations = NoteBatchOperationSerializer(many=True, allow_empty=False, max_length=settings.NOTES_MAX_PAGE_SIZE)
+
+    def validate_operations(self, value):
+        note_ids = [operation['id'] for operation in value if operation['op'] != NoteBatchOperationSerializer.CREATE]
+        if len(note_ids) != len(set(note_ids)):
+            raise serializers.ValidationError('Each note can be updated or deleted only once per batch.')
+        return value
+
+
+class NoteChangesQuerySerializer(serializers.Serializer):
+    since = serializers.IntegerField(min_value=0, required=False, default=0)
+
+
+class NoteSearchQuerySerializer(serializers.Serializer):
+    q = serializers.CharField(max_length=256)
+
+
+class NoteTitleSearchQuerySerializer(NoteSearchQuerySerializer):
+    limit = serializers.IntegerField(min_value=1, max_value=settings.NOTES_MAX_PAGE_SIZE, default=settings.NOTES_PAGE_SIZE)
+
+
+class NoteSearchTokensSerializer(serializers.Serializer):
+    tokens = search_tokens_field()
+
+
+class BlindSearchSerializer(serializers.Serializer):
+    ALL = 'all'
+    ANY = 'any'
+    tokens = serializers.ListField(child=SearchTokenField(), min_length=1, max_length=64)
+    match = serializers.ChoiceField(choices=[ALL, ANY], default=ALL) # Notes containing all the words or any of them
+
+
 class GetPublicKeySerializer(serializers.Serializer):
     id = serializers.CharField()
     keys = UserKeyInfoSerializer(many=True, include_permissions=True)
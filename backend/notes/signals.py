@@ -0,0 +1,71 @@
+import threading
+import weakref
+
+from django.apps import apps
+from django.conf import settings
+from django.db.models.signals import post_save, pre_delete, post_delete
+from django.dispatch import receiver
+
+from .acl import invalidate_permissions
+from .events import publish_note_event, NOTE_CHANGED, NOTE_SHARED, NOTE_UNSHARED
+from .models import NoteItem, NoteTombstone
+
+
+_deleting = threading.local() # NoteItems collected for deletion, by origin of the deletion (note, user, queryset...)
+
+
+def _get_user_ids(note_items):
+    """Return {user_key_id: user_id} of given NoteItems - keys that are not cached on the items are resolved with one query."""
+    user_ids = {note_item.user_key_id: note_item.user_key.user_id for note_item in note_items if NoteItem.user_key.is_cached(note_item)}
+    missing = {note_item.user_key_id for note_item in note_items} - user_ids.keys()
+    if missing:
+        UserKey = apps.get_model(settings.AUTH_USER_KEY_MODEL)
+        user_ids.update(UserKey.objects.filter(pk__in=missing).values_list('pk', 'user'))
+    return user_ids
+
+
+def _get_deleting(origin):
+    if not hasattr(_deleting, 'note_items'):
+        _deleting.note_items = weakref.WeakKeyDictionary() # Entries of deletions that failed go away with their origin
+    return _deleting.note_items.setdefault(origin, [])
+
+
+def _pop_deleting(origin):
+    return getattr(_deleting, 'note_items', {}).pop(origin, None)
+
+
+@receiver(post_save, sender=NoteItem)
+def note_item_saved(sender, instance, created, **kwargs):
+    """Keep ACL cache in sync with NoteItems and notify the user that note was shared with them (or their access changed)."""
+    user_id = _get_user_ids([instance]).get(instance.user_key_id)
+    invalidate_permissions([(user_id, instance.note_id)])
+    publish_note_event(NOTE_SHARED if created else NOTE_CHANGED, instance.note_id, [user_id])
+
+
+@receiver(pre_delete, sender=NoteItem)
+def note_item_deleting(sender, instance, origin=None, **kwargs):
+    """Collect every NoteItem of the deletion before any of them is deleted (related UserKeys are still there at that point)."""
+    if origin is not None:
+        _get_deleting(origin).append(instance)
+
+
+@receiver(post_delete, sender=NoteItem)
+def note_item_deleted(sender, instance, origin=None, **kwargs):
+    """
+    Handle users losing access to the note - covers removing access and cascades of note and user deletion:
+    invalidate ACL cache, remember it for delta sync and notify the users.
+    All NoteItems of the deletion are handled in one pass on the first call, the rest of the calls are no-ops.
+    """
+    note_items = [instance] if origin is None else _pop_deleting(origin)
+    if not note_items:
+        return
+
+    user_ids = _get_user_ids(note_items)
+    invalidate_permissions([(user_ids.get(note_item.user_key_id), note_item.note_id) for note_item in note_items])
+    NoteTombstone.objects.bulk_create([NoteTombstone(note_id=note_item.note_id, user_key_id=note_item.user_key_id) for note_item in note_items])
+
+    recipients = {}
+    for note_item in note_items:
+        recipients.setdefault(note_item.note_id, []).append(user_ids.get(note_item.user_key_id))
+    for note_id, recipient_ids in recipients.items():
+        publish_note_event(NOTE_UNSHARED, note_id, recipient_ids)
@@ -0,0 +1,27 @@
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+
+
+def streaming_response(request, content, batch_size=1, **kwargs):
+    """
+    StreamingHttpResponse that streams under both WSGI and ASGI.
+    Django's ASGI handler consumes a sync iterator whole (`sync_to_async(list)`) before sending the first byte, so under ASGI
+    the iterator is advanced in the request's sync thread (same db connection) `batch_size` items at a time instead.
+    """
+    if isinstance(getattr(request, '_request', request), ASGIRequest): # DRF Request wraps django's
+        content = _iterate_async(iter(content), batch_size)
+    return StreamingHttpResponse(content, **kwargs)
+
+
+async def _iterate_async(iterator, batch_size):
+    next_batch = sync_to_async(lambda: list(islice(iterator, batch_size)), thread_sensitive=True)
+    try:
+        while batch := await next_batch():
+            for item in batch:
+                yield item
+    finally: # Client disconnected or streaming finished - release the iterator (server-side cursor) in its thread
+        if close := getattr(iterator, 'close', None):
+            await sync_to_async(close, thread_sensitive=True)()
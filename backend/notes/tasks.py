@@ -0,0 +1,8 @@
+from celery import shared_task
+
+from .revisions import compact_revisions
+
+
+@shared_task
+def compact_note_revisions(note_id):
+    compact_revisions(note_id)
@@ -1,3 +1,5 @@
+import json
+
 import pytest
 from django.apps import apps
 from django.conf import settings
@@ -61,7 +63,7 @@ def make_note():
     def do_make_note(api_client, user=None, is_encrypted=False):
         if not user:
             user, user_key = create_authenticated_user_and_user_key(api_client)
-        return baker.make(Note, owner=user, is_encrypted=is_encrypted)
+        return baker.make(Note, owner=user, body=b'aa', is_encrypted=is_encrypted)
     return do_make_note
 
 
@@ -116,4 +118,39 @@ def make_user_with_permission():
 
         baker.make(NoteItem, **note_item_data)
         return user, user_key
-    return do_make_user_with_permission
\ No newline at end of file
+    return do_make_user_with_permission
+
+
+
+@pytest.fixture
+def make_user_notes():
+    def do_make_user_notes(api_client, count=1, is_encrypted=False):
+        user, user_key = create_authenticated_user_and_user_key(api_client)
+        notes = [baker.make(Note, owner=user, title=f'note {index}', body=b'aa', is_encrypted=is_encrypted) for index in range(count)] # Predictable titles make ordering easy to assert
+        for note in notes:
+            baker.make(NoteItem, note=note, user_key=user_key, permission='O')
+        return user, user_key, notes
+    return do_make_user_notes
+
+
+
+
+class FakeRedis:
+    """Records messages published to Redis pub/sub channels instead of sending them."""
+    def __init__(self):
+        self.published = []
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def publish(self, channel, message):
+        self.published.append((channel, json.loads(message)))
+
+    def execute(self):
+        pass
+
+@pytest.fixture
+def published_events(monkeypatch):
+    fake_redis = FakeRedis()
+    monkeypatch.setattr('notes.events.get_redis', lambda: fake_redis)
+    return fake_redis.published
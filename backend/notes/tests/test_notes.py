@@ -1,9 +1,32 @@
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import threading
+
 import pytest
-from rest_framework.test import APIClient
+from django.apps import apps
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import AsyncRequestFactory
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient, APIRequestFactory
 from rest_framework import status
+from rest_framework_simplejwt.tokens import AccessToken
 from model_bakery import baker
 
-from notes.models import Note, NoteItem
+from accounts.authentication import ClaimsUser
+from app.caching import TwoLevelCache
+from accounts.tokens import UserClaimsRefreshToken
+from notes import cdc
+from notes.compression import is_packed
+from notes.events import user_channel, NOTE_CHANGED, NOTE_SHARED, NOTE_UNSHARED
+from notes.models import NextChangeSeq, Note, NoteItem, NoteRevision, NoteBodyBlob, NoteBodyChunk, NoteTombstone
+from notes.revisions import compact_revisions
+from notes.streaming import streaming_response
+from notes.permissions import get_note_permission, get_request_user_key
 
 
 @pytest.mark.django_db
@@ -37,6 +60,30 @@ class TestCreateNotes:
         assert False == response.data.get('is_encrypted')
 
 
+    def test_create_note_authenticated_with_token_claims_returns_201(self, api_client, make_authenticated_user_and_user_key):
+        user, user_key = make_authenticated_user_and_user_key(api_client)
+        api_client.force_authenticate(user=None)
+        api_client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserClaimsRefreshToken.for_user(user).access_token}') # request.user is ClaimsUser
+
+        response = api_client.post('/notes/notes/', {'title': 'aa', 'body': 'aa', 'is_encrypted': False})
+
+        assert status.HTTP_201_CREATED == response.status_code
+        assert response.data['owner'] == user.id
+        assert NoteItem.objects.get(note=response.data['id']).user_key_id == user_key.id
+
+
+    def test_create_note_with_deleted_key_in_token_claims_returns_400(self, api_client, make_authenticated_user_and_user_key):
+        user, user_key = make_authenticated_user_and_user_key(api_client)
+        api_client.force_authenticate(user=None)
+        api_client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserClaimsRefreshToken.for_user(user).access_token}')
+        user_key.delete() # Deleted on another device - token still carries the key
+
+        response = api_client.post('/notes/notes/', {'title': 'aa', 'body': 'aa', 'is_encrypted': False})
+
+        assert status.HTTP_400_BAD_REQUEST == response.status_code
+        assert not Note.objects.filter(owner=user).exists() # Nothing is saved without a key to attach it to
+
+
     def test_create_encrypted_note_returns_201(self, api_client, make_authenticated_user_and_user_key):
         user, user_key = make_authenticated_user_and_user_key(api_client) # This line is neccessary as the endpoint should expect authenticated users only, and requires users to have UserKey created
 
@@ -169,6 +216,45 @@ class TestChangeEncryptionNotes:
         assert len(response.data.get('users')) == 2
 
 
+    def test_change_encryption_to_true_but_key_is_missing_for_some_users_does_not_change_note_returns_400(self, api_client, make_shared_note):
+        note, owner, shared_user, shared_user_key = make_shared_note(api_client, is_encrypted=False)
+
+        body = {
+            "new_body": "encrypted",
+            "is_encrypted": True,
+            "keys": [{"user_id": str(owner.id), "key": "aa"}]
+        }
+        response = api_client.put(f'/notes/notes/{note.id}/change_encryption/', data=body, format='json')
+
+        note.refresh_from_db()
+        assert status.HTTP_400_BAD_REQUEST == response.status_code
+        assert [str(shared_user.id)] == response.data.get('missing_users')
+        assert False == note.is_encrypted
+        assert b'encrypted' != bytes(note.body)
+
+
+    def test_change_encryption_number_of_queries_does_not_depend_on_number_of_users(self, api_client, make_note, make_user_with_permission):
+        note = make_note(api_client)
+        owner = note.owner
+
+        def change_encryption(collaborators_count):
+            for _ in range(collaborators_count):
+                make_user_with_permission(APIClient(), note, permission='R')
+            user_ids = NoteItem.objects.filter(note=note).values_list('user_key__user', flat=True)
+            body = {
+                "new_body": "aa",
+                "is_encrypted": True,
+                "keys": [{"user_id": str(user_id), "key": "bb"} for user_id in user_ids] + [{"user_id": str(owner.id), "key": "bb"}]
+            }
+            with CaptureQueriesContext(connection) as queries:
+                response = api_client.put(f'/notes/notes/{note.id}/change_encryption/', data=body, format='json')
+            assert status.HTTP_200_OK == response.status_code
+            assert all(bytes(key) == b'bb' for key in NoteItem.objects.filter(note=note).values_list('encryption_key', flat=True))
+            return len(queries)
+
+        assert change_encryption(2) == change_encryption(10)
+
+
 
 
 
@@ -203,6 +289,19 @@ class TestShareNotes:
         assert 'Note shared' in response.data.get('detail')
 
 
+    def test_share_note_with_user_having_retired_keys_uses_active_key(self, api_client, make_note, make_authenticated_user_and_user_key):
+        target_user, target_user_key = make_authenticated_user_and_user_key(api_client)
+        UserKey = apps.get_model(settings.AUTH_USER_KEY_MODEL)
+        baker.make(UserKey, user=target_user, is_active=False) # Retained previous key
+        new_client = APIClient()
+        note = make_note(new_client, is_encrypted=False)
+
+        response = new_client.post(f'/notes/notes/{note.id}/share/', data={'user': str(target_user.id), 'permission': 'R'}, format='json')
+
+        assert status.HTTP_201_CREATED == response.status_code
+        assert NoteItem.objects.get(note=note, user_key__user=target_user).user_key_id == target_user_key.id
+
+
     def test_share_encrypted_note_returns_201(self, api_client, make_note, make_authenticated_user_and_user_key):
         target_user, target_user_key = make_authenticated_user_and_user_key(api_client)
         new_client = APIClient()
@@ -274,5 +373,1332 @@ class TestShareNotes:
         assert status.HTTP_403_FORBIDDEN == response.status_code
 
 
+    def test_bulk_share_encrypted_note_returns_200(self, api_client, make_shared_note, make_user, make_authenticated_user_and_user_key):
+        note, owner, shared_user, shared_user_key = make_shared_note(api_client, is_encrypted=True, share_permission='R')
+        target_user, target_user_key = make_authenticated_user_and_user_key(APIClient())
+        user_without_key = make_user()
+
+        body = {
+            'shares': [
+                {'user': str(shared_user.id), 'permission': 'W', 'encryption_key': 'aa'},
+                {'user': str(target_user.id), 'permission': 'R', 'encryption_key': 'aa'},
+                {'user': str(owner.id), 'permission': 'R', 'encryption_key': 'aa'},
+                {'user': str(user_without_key.id), 'permission': 'R', 'encryption_key': 'aa'},
+            ]
+        }
+        response = api_client.post(f'/notes/notes/{note.id}/bulk_share/', data=body, format='json')
+
+        assert status.HTTP_200_OK == response.status_code
+        assert [result.get('status') for result in response.data.get('results')] == ['updated', 'created', 'unchanged', 'failed']
+        assert NoteItem.objects.get(note=note, user_key=shared_user_key).permission == 'W'
+        assert bytes(NoteItem.objects.get(note=note, user_key=target_user_key).encryption_key) == b'aa'
+        assert NoteItem.objects.get(note=note, user_key__user=owner).permission == 'O'
+
+
+    def test_bulk_share_encrypted_note_without_encryption_key_returns_400(self, api_client, make_note, make_authenticated_user_and_user_key):
+        target_user, target_user_key = make_authenticated_user_and_user_key(APIClient())
+        note = make_note(api_client, is_encrypted=True)
+
+        body = {'shares': [{'user': str(target_user.id), 'permission': 'R'}]}
+        response = api_client.post(f'/notes/notes/{note.id}/bulk_share/', data=body, format='json')
+
+        assert status.HTTP_400_BAD_REQUEST == response.status_code
+
+
+    def test_bulk_share_number_of_queries_does_not_depend_on_number_of_users(self, api_client, make_note, make_authenticated_user_and_user_key):
+        note = make_note(api_client)
+
+        def bulk_share(count):
+            users = [make_authenticated_user_and_user_key(APIClient())[0] for _ in range(count)]
+            body = {'shares': [{'user': str(user.id), 'permission': 'R'} for user in users]}
+            with CaptureQueriesContext(connection) as queries:
+                response = api_client.post(f'/notes/notes/{note.id}/bulk_share/', data=body, format='json')
+            assert status.HTTP_200_OK == response.status_code
+            return len(queries)
+
+        assert bulk_share(2) == bulk_share(10)
+
+
+
+
+@pytest.mark.django_db
+class TestConditionalRequestsNotes:
+
+    def test_retrieve_note_with_current_etag_returns_304(self, api_client, make_note):
+        note = make_note(api_client)
+        etag = api_client.get(f'/notes/notes/{note.id}/').headers.get('ETag')
+
+        response = api_client.get(f'/notes/notes/{note.id}/', HTTP_IF_NONE_MATCH=etag)
+
+        assert etag
+        assert status.HTTP_304_NOT_MODIFIED == response.status_code
+        assert not response.content
+
+
+    def test_update_note_with_current_etag_returns_200(self, api_client, make_note):
+        note = make_note(api_client)
+        etag = api_client.get(f'/notes/notes/{note.id}/').headers.get('ETag')
+
+        response = api_client.put(f'/notes/notes/{note.id}/', data={'title': 'aa', 'body': 'bb'}, format='json', HTTP_IF_MATCH=etag)
+
+        note.refresh_from_db()
+        assert status.HTTP_200_OK == response.status_code
+        assert response.data.get('version') == 2
+        assert note.version == 2
+        assert response.headers.get('ETag') != etag
+
+
+    def test_update_note_with_outdated_etag_returns_412(self, api_client, make_note):
+        note = make_note(api_client)
+        etag = api_client.get(f'/notes/notes/{note.id}/').headers.get('ETag')
+        api_client.put(f'/notes/notes/{note.id}/', data={'title': 'aa', 'body': 'first'}, format='json', HTTP_IF_MATCH=etag)
+
+        response = api_client.put(f'/notes/notes/{note.id}/', data={'title': 'aa', 'body': 'second'}, format='json', HTTP_IF_MATCH=etag)
+
+        note.refresh_from_db()
+        assert status.HTTP_412_PRECONDITION_FAILED == response.status_code
+        assert bytes(note.body) == b'first'
+
+
+    def test_update_note_changed_concurrently_returns_412(self, api_client, make_note):
+        note = make_note(api_client)
+        stale_note = Note.objects.get(id=note.id)
+        Note.objects.filter(id=note.id).update(version=5) # Somebody else saved the note in the meantime
+
+        stale_note.title = 'aa'
+        assert False == stale_note.compare_and_swap(['title'])
+
+
+    def test_get_my_notes_with_current_etag_returns_304(self, api_client, make_user_notes):
+        user, user_key, notes = make_user_notes(api_client, count=2)
+        etag = api_client.get('/notes/notes/me/').headers.get('ETag')
+
+        response = api_client.get('/notes/notes/me/', HTTP_IF_NONE_MATCH=etag)
+
+        assert status.HTTP_304_NOT_MODIFIED == response.status_code
+
+        api_client.put(f'/notes/notes/{notes[0].id}/', data={'title': 'aa', 'body': 'bb'}, format='json')
+        response = api_client.get('/notes/notes/me/', HTTP_IF_NONE_MATCH=etag)
+
+        assert status.HTTP_200_OK == response.status_code
+        assert response.headers.get('ETag') != etag
+
+
+
+
+@pytest.mark.django_db
+class TestBatchNotes:
+
+    def test_batch_create_update_and_delete_notes_returns_200(self, api_client, make_user_notes):
+        user, user_key, notes = make_user_notes(api_client, count=2)
+
+        body = {
+            'operations': [
+                {'op': 'create', 'title': 'created', 'body': 'aa', 'is_encrypted': False},
+                {'op': 'create', 'title': 'created encrypted', 'body': 'aa', 'is_encrypted': True, 'encryption_key': 'aa'},
+                {'op': 'update', 'id': str(notes[0].id), 'title': 'updated', 'body': 'bb'},
+                {'op': 'delete', 'id': str(notes[1].id)},
+            ]
+        }
+        response = api_client.post('/notes/notes/batch/', data=body, format='json')
+
+        assert status.HTTP_200_OK == response.status_code
+        assert [result.get('status') for result in response.data.get('results')] == [201, 201, 200, 204]
+        created_ids = [result.get('id') for result in response.data.get('results')[:2]]
+        assert NoteItem.objects.filter(note__in=created_ids, user_key=user_key, permission='O').count() == 2
+        notes[0].refresh_from_db()
+        assert notes[0].title == 'updated'
+        assert bytes(notes[0].body) == b'bb'
+        assert not Note.objects.filter(id=notes[1].id).exists()
+
+
+    def test_batch_update_locks_notes_before_checking_version(self, api_client, make_user_notes):
+        user, user_key, notes = make_user_notes(api_client, count=1)
+        body = {'operations': [{'op': 'update', 'id': str(notes[0].id), 'title': 'updated', 'body': 'bb', 'version': notes[0].version}]}
+
+        with CaptureQueriesContext(connection) as queries:
+            response = api_client.post('/notes/notes/batch/', data=body, format='json')
+
+        assert [result.get('status') for result in response.data.get('results')] == [200]
+        note_reads = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('SELECT') and 'FROM "notes_note"' in query['sql']]
+        assert 'FOR UPDATE' in note_reads[0] # Concurrent batch waits for the lock and then sees the new version (412) instead of overwriting it
+
+        response = api_client.post('/notes/notes/batch/', data=body, format='json')
+        assert [result.get('status') for result in response.data.get('results')] == [412]
+
+
+    def test_batch_without_permissions_skips_operations_returns_200(self, api_client, make_note, make_user_with_permission):
+        note = make_note(api_client)
+        reader_client = APIClient()
+        make_user_with_permission(reader_client, note, permission='R')
+
+        body = {
+            'operations': [
+                {'op': 'update', 'id': str(note.id), 'title': 'updated', 'body': 'bb'},
+                {'op': 'delete', 'id': str(note.id)},
+            ]
+        }
+        response = reader_client.post('/notes/notes/batch/', data=body, format='json')
+
+        assert status.HTTP_400_BAD_REQUEST == response.status_code # Same note twice in one batch
+
+        response = reader_client.post('/notes/notes/batch/', data={'operations': body['operations'][:1]}, format='json')
+
+        note.refresh_from_db()
+        assert status.HTTP_200_OK == response.status_code
+        assert [result.get('status') for result in response.data.get('results')] == [403]
+        assert note.title != 'updated'
+
+
+    def test_batch_create_encrypted_note_without_encryption_key_returns_400(self, api_client, make_authenticated_user_and_user_key):
+        make_authenticated_user_and_user_key(api_client)
+
+        body = {'operations': [{'op': 'create', 'title': 'aa', 'body': 'aa', 'is_encrypted': True}]}
+        response = api_client.post('/notes/notes/batch/', data=body, format='json')
+
+        assert status.HTTP_400_BAD_REQUEST == response.status_code
+
+
+
+
+@pytest.mark.django_db
+class TestMeNotes:
+
+    def test_get_my_notes_returns_200(self, api_client, make_user_notes):
+        user, user_key, notes = make_user_notes(api_client, count=3)
+
+        response = api_client.get('/notes/notes/me/')
+
+        assert status.HTTP_200_OK == response.status_code
+        assert [note.get('title') for note in response.data] == sorted(note.title for note in notes)
+
+
+    def test_get_my_notes_number_of_queries_does_not_depend_on_number_of_notes(self, api_client, make_user_notes, make_user):
+        user, user_key, notes = make_user_notes(api_client, count=1)
+        with CaptureQueriesContext(connection) as single_note_queries:
+            api_client.get('/notes/notes/me/')
+
+        for _ in range(5): # Add notes owned by other users so that every note has a different owner
+            note = baker.make(Note, owner=make_user(), body=b'aa')
+            baker.make(NoteItem, note=note, user_key=user_key, permission='R')
+        with CaptureQueriesContext(connection) as many_notes_queries:
+            response = api_client.get('/notes/notes/me/')
+
+        assert len(response.data) == 6
+        assert len(single_note_queries) == len(many_notes_queries)
+
+
+    def test_get_my_notes_paginated_follows_cursor_returns_200(self, api_client, make_user_notes):
+        user, user_key, notes = make_user_notes(api_client, count=5)
+
+        first_page = api_client.get('/notes/notes/me/', {'page_size': 2})
+        second_page = api_client.get(first_page.data.get('next'))
+        third_page = api_client.get(second_page.data.get('next'))
+
+        assert status.HTTP_200_OK == first_page.status_code
+        assert len(first_page.data.get('results')) == 2
+        assert len(second_page.data.get('results')) == 2
+        assert len(third_page.data.get('results')) == 1
+        assert third_page.data.get('next') is None
+        titles = [note.get('title') for page in [first_page, second_page, third_page] for note in page.data.get('results')]
+        assert titles == sorted(note.title for note in notes) # Every note is returned exactly once and in order
+
+
+    def test_get_my_notes_with_invalid_cursor_returns_404(self, api_client, make_user_notes):
+        make_user_notes(api_client, count=1)
+
+        response = api_client.get('/notes/notes/me/', {'cursor': 'not-a-cursor'})
+
+        assert status.HTTP_404_NOT_FOUND == response.status_code
+
+
+    @pytest.mark.parametrize('position', [['title', 'not-a-uuid'], ['title', 1], [1, '00000000-0000-0000-0000-000000000000']])
+    def test_get_my_notes_with_malformed_cursor_position_returns_404(self, api_client, make_user_notes, position):
+        make_user_notes(api_client, count=1)
+        cursor = base64.urlsafe_b64encode(json.dumps(position).encode()).decode('ascii')
+
+        response = api_client.get('/notes/notes/me/', {'cursor': cursor})
+
+        assert status.HTTP_404_NOT_FOUND == response.status_code
+
+
+    def test_get_my_notes_streamed_returns_200(self, api_client, make_user_notes):
+        user, user_key, notes = make_user_notes(api_client, count=3)
+
+        response = api_client.get('/notes/notes/me/', {'stream': 'true'})
+
+        assert status.HTTP_200_OK == response.status_code
+        data = json.loads(b''.join(response.streaming_content))
+        assert [note.get('title') for note in data] == sorted(note.title for note in notes)
+
+
+    def test_get_my_notes_summary_does_not_return_body_returns_200(self, api_client, make_user_notes):
+        make_user_notes(api_client, count=2)
+
+        response = api_client.get('/notes/notes/me/', {'fields': 'summary'})
+
+        assert status.HTTP_200_OK == response.status_code
+        for note in response.data:
+            assert 'body' not in note
+            for field in ['id', 'title', 'owner', 'is_encrypted', 'created_at', 'encryption_key', 'permission']:
+                assert field in note
+
+
+    def test_get_bodies_of_my_notes_returns_200(self, api_client, make_user_notes, make_note):
+        user, user_key, notes = make_user_notes(api_client, count=2)
+        other_users_note = make_note(APIClient()) # Note of another user - should not be returned
+
+        body = {'ids': [str(note.id) for note in notes] + [str(other_users_note.id)]}
+        response = api_client.post('/notes/notes/bodies/', data=body, format='json')
+
+        assert status.HTTP_200_OK == response.status_code
+        assert {note.get('id') for note in response.data} == {str(note.id) for note in notes}
+        assert all(note.get('body') == 'aa' for note in response.data)
+
+
+    def test_get_bodies_without_user_key_returns_no_notes(self, api_client, make_authenticated_user):
+        make_authenticated_user(api_client)
+        orphan_note = baker.make(Note, body=b'aa') # Note without any NoteItem
+
+        response = api_client.post('/notes/notes/bodies/', data={'ids': [str(orphan_note.id)]}, format='json')
+
+        assert status.HTTP_200_OK == response.status_code
+        assert response.data == []
+
+
+
+
+@pytest.mark.django_db(transaction=True) # Delta sync cursor depends on transactions being committed
+class TestNoteChanges:
+
+    def test_get_changes_since_beginning_returns_all_notes_returns_200(self, api_client, make_user_notes):
+        user, user_key, notes = make_user_notes(api_client, count=3)
+
+        response = api_client.get('/notes/notes/me/changes/')
+
+        assert status.HTTP_200_OK == response.status_code
+        assert {note.get('id') for note in response.data.get('changed')} == {str(note.id) for note in notes}
+        assert response.data.get('deleted') == []
+        assert response.data.get('cursor') > 0
+
+
+    def test_get_changes_returns_only_notes_changed_after_cursor_returns_200(self, api_client, make_user_notes):
+        user, user_key, notes = make_user_notes(api_client, count=3)
+        cursor = api_client.get('/notes/notes/me/changes/').data.get('cursor')
+
+        api_client.put(f'/notes/notes/{notes[0].id}/', data={'title': 'updated', 'body': 'bb'}, format='json')
+        api_client.delete(f'/notes/notes/{notes[1].id}/')
+        response = api_client.get('/notes/notes/me/changes/', {'since': cursor})
+
+        assert status.HTTP_200_OK == response.status_code
+        assert [note.get('id') for note in response.data.get('changed')] == [str(notes[0].id)]
+        assert response.data.get('deleted') == [str(notes[1].id)]
+        assert response.data.get('cursor') > cursor
+
+        response = api_client.get('/notes/notes/me/changes/', {'since': response.data.get('cursor')})
+
+        assert response.data.get('changed') == []
+        assert response.data.get('deleted') == []
+
+
+    def test_get_changes_after_note_is_shared_and_unshared_returns_200(self, api_client, make_note, make_authenticated_user_and_user_key):
+        target_client = APIClient()
+        target_user, target_user_key = make_authenticated_user_and_user_key(target_client)
+        note = make_note(api_client)
+        cursor = target_client.get('/notes/notes/me/changes/').data.get('cursor')
+
+        api_client.post(f'/notes/notes/{note.id}/share/', data={'user': str(target_user.id), 'permission': 'R'}, format='json')
+        response = target_client.get('/notes/notes/me/changes/', {'since': cursor})
+
+        assert [note.get('id') for note in response.data.get('changed')] == [str(note.id)]
+        cursor = response.data.get('cursor')
+
+        api_client.delete('/notes/notes/remove_access/', data={'note': str(note.id), 'user': str(target_user.id)}, format='json')
+        response = target_client.get('/notes/notes/me/changes/', {'since': cursor})
+
+        assert response.data.get('changed') == []
+        assert response.data.get('deleted') == [str(note.id)]
+
+
+    def test_get_changes_cursor_stays_below_transaction_in_flight(self, api_client, make_user_notes):
+        user, user_key, notes = make_user_notes(api_client, count=2)
+        cursor = api_client.get('/notes/notes/me/changes/').data.get('cursor')
+        written, committing = threading.Event(), threading.Event()
+
+        def update_in_other_transaction():
+            with transaction.atomic():
+                Note.objects.filter(id=notes[0].id).update(title='in flight', change_seq=NextChangeSeq())
+                written.set()
+                committing.wait(timeout=10)
+            connection.close()
+
+        thread = threading.Thread(target=update_in_other_transaction)
+        thread.start()
+        written.wait(timeout=10)
+        api_client.put(f'/notes/notes/{notes[1].id}/', data={'title': 'committed', 'body': 'bb'}, format='json') # Committed after the one in flight started
+        response = api_client.get('/notes/notes/me/changes/', {'since': cursor})
+        committing.set()
+        thread.join()
+
+        assert [note.get('title') for note in response.data.get('changed')] == ['committed']
+        response = api_client.get('/notes/notes/me/changes/', {'since': response.data.get('cursor')})
+        assert 'in flight' in [note.get('title') for note in response.data.get('changed')]
+
+
+
+
+@pytest.mark.django_db
+class TestNotePermissions:
+
+    def test_note_permission_and_user_key_are_resolved_in_one_query_per_request(self, api_client, make_shared_note, django_assert_num_queries):
+        note, owner, shared_user, shared_user_key = make_shared_note(api_client, share_permission='W')
+        request = APIRequestFactory().get('/')
+        request.user = shared_user
+
+        with django_assert_num_queries(1):
+            assert get_note_permission(request, note) == 'W'
+            assert get_note_permission(request, note) == 'W' # Memoized on the request
+            assert get_request_user_key(request) == shared_user_key
+
+
+    def test_note_permission_of_claims_user_ignores_stale_key_claim(self, api_client, make_shared_note, django_assert_num_queries):
+        note, owner, shared_user, shared_user_key = make_shared_note(api_client, share_permission='W')
+        request = APIRequestFactory().get('/')
+        request.user = ClaimsUser(UserClaimsRefreshToken.for_user(shared_user).access_token)
+        UserKey = apps.get_model(settings.AUTH_USER_KEY_MODEL)
+        new_key = baker.make(UserKey, user=shared_user, is_active=False)
+        NoteItem.move_to_key(shared_user_key, new_key) # Key rotated on another device - token still carries the old key
+        UserKey.objects.filter(pk=shared_user_key.pk).update(is_active=False)
+        UserKey.objects.filter(pk=new_key.pk).update(is_active=True)
+
+        with django_assert_num_queries(1): # UserKey and NoteItem permission in one query
+            assert get_note_permission(request, note) == 'W'
+            assert get_request_user_key(request).pk == new_key.pk
+
+
+    def test_request_user_key_is_users_active_key(self, api_client, make_shared_note):
+        note, owner, shared_user, shared_user_key = make_shared_note(api_client)
+        UserKey = apps.get_model(settings.AUTH_USER_KEY_MODEL)
+        baker.make(UserKey, user=shared_user, is_active=False)
+        request = APIRequestFactory().get('/')
+        request.user = shared_user
+
+        assert get_request_user_key(request) == shared_user_key
+
+
+    def test_note_permission_is_served_from_acl_cache_on_next_request(self, api_client, make_shared_note, django_assert_num_queries):
+        note, owner, shared_user, shared_user_key = make_shared_note(api_client, share_permission='W')
+        first_request = APIRequestFactory().get('/')
+        first_request.user = shared_user
+        get_note_permission(first_request, note)
+
+        next_request = APIRequestFactory().get('/')
+        next_request.user = shared_user
+        with django_assert_num_queries(0):
+            assert get_note_permission(next_request, note) == 'W'
+
+
+    def test_acl_cache_is_invalidated_when_permission_changes_and_access_is_removed(self, api_client, make_shared_note):
+        note, owner, shared_user, shared_user_key = make_shared_note(api_client, share_permission='W') # api_client is authenticated as the owner
+
+        def resolve_permission():
+            request = APIRequestFactory().get('/')
+            request.user = shared_user
+            return get_note_permission(request, note)
+
+        assert resolve_permission() == 'W'
+
+        api_client.post(f'/notes/notes/{note.id}/share/', data={'user': str(shared_user.id), 'permission': 'R'}, format='json')
+        assert resolve_permission() == 'R'
+
+        api_client.delete('/notes/notes/remove_access/', data={'note': str(note.id), 'user': str(shared_user.id)}, format='json')
+        assert resolve_permission() is None
+
+
+    def test_retrieve_note_with_read_permission_returns_200(self, api_client, make_note, make_user_with_permission):
+        note = make_note(api_client)
+        new_client = APIClient()
+        user, user_key = make_user_with_permission(new_client, note, permission='R')
+
+        response = new_client.get(f'/notes/notes/{note.id}/')
+
+        assert status.HTTP_200_OK == response.status_code
+
+
+    def test_update_note_with_read_permission_returns_403(self, api_client, make_note, make_user_with_permission):
+        note = make_note(api_client)
+        new_client = APIClient()
+        user, user_key = make_user_with_permission(new_client, note, permission='R')
+
+        response = new_client.put(f'/notes/notes/{note.id}/', data={'title': 'aa', 'body': 'aa'}, format='json')
+
+        assert status.HTTP_403_FORBIDDEN == response.status_code
+
+
+
+
+@pytest.mark.django_db
+class TestNoteEvents:
+
+    def test_update_note_publishes_change_to_every_user_with_access(self, api_client, make_shared_note, published_events, django_capture_on_commit_callbacks):
+        note, owner, shared_user, shared_user_key = make_shared_note(api_client)
+
+        with django_capture_on_commit_callbacks(execute=True):
+            response = api_client.put(f'/notes/notes/{note.id}/', data={'title': 'bb', 'body': 'bb'}, format='json')
+
+        assert status.HTTP_200_OK == response.status_code
+        assert sorted(published_events, key=lambda event: event[0]) == sorted([
+            (user_channel(owner.id), {'event': NOTE_CHANGED, 'note_id': str(note.id)}),
+            (user_channel(shared_user.id), {'event': NOTE_CHANGED, 'note_id': str(note.id)}),
+        ], key=lambda event: event[0])
+
+
+    def test_share_and_remove_access_publish_events_to_target_user(self, api_client, make_note, make_user, published_events, django_capture_on_commit_callbacks):
+        note = make_note(api_client)
+        target_user = make_user()
+        baker.make(apps.get_model(settings.AUTH_USER_KEY_MODEL), user=target_user)
+
+        with django_capture_on_commit_callbacks(execute=True):
+            api_client.post(f'/notes/notes/{note.id}/share/', data={'user': str(target_user.id), 'permission': 'R'}, format='json')
+        with django_capture_on_commit_callbacks(execute=True):
+            api_client.delete('/notes/notes/remove_access/', data={'note': str(note.id), 'user': str(target_user.id)}, format='json')
+
+        assert published_events == [
+            (user_channel(target_user.id), {'event': NOTE_SHARED, 'note_id': str(note.id)}),
+            (user_channel(target_user.id), {'event': NOTE_UNSHARED, 'note_id': str(note.id)}),
+        ]
+
+
+    def test_delete_shared_note_handles_all_note_items_in_one_pass(self, api_client, make_note, make_user, published_events, django_capture_on_commit_callbacks):
+        note = make_note(api_client)
+        UserKey = apps.get_model(settings.AUTH_USER_KEY_MODEL)
+        targets = [make_user() for _ in range(3)]
+        for target_user in targets:
+            baker.make(NoteItem, note=note, user_key=baker.make(UserKey, user=target_user), permission='R')
+
+        with django_capture_on_commit_callbacks(execute=True), CaptureQueriesContext(connection) as queries:
+            Note.objects.filter(id=note.id).delete()
+
+        key_reads = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('SELECT') and 'FROM "accounts_userkey"' in query['sql']]
+        assert len(key_reads) == 1
+        assert NoteTombstone.objects.filter(note_id=note.id).count() == 3
+        assert sorted(published_events, key=lambda event: event[0]) == sorted([
+            (user_channel(target_user.id), {'event': NOTE_UNSHARED, 'note_id': str(note.id)}) for target_user in targets
+        ], key=lambda event: event[0])
 
 
+    def test_nothing_is_published_when_transaction_rolls_back(self, api_client, make_note, published_events, django_capture_on_commit_callbacks):
+        note = make_note(api_client)
+
+        with django_capture_on_commit_callbacks(execute=True):
+            response = api_client.put(f'/notes/notes/{note.id}/', data={'title': 'bb', 'body': 'bb'}, format='json', HTTP_IF_MATCH='"outdated"')
+
+        assert status.HTTP_412_PRECONDITION_FAILED == response.status_code
+        assert published_events == []
+
+
+    def test_event_stream_without_token_returns_401(self, api_client):
+        response = api_client.get('/notes/events/')
+
+        assert status.HTTP_401_UNAUTHORIZED == response.status_code
+
+
+    def test_event_stream_with_invalid_token_returns_401(self, api_client):
+        response = api_client.get('/notes/events/', HTTP_AUTHORIZATION='Bearer invalid')
+
+        assert status.HTTP_401_UNAUTHORIZED == response.status_code
+
+
+    def test_event_stream_with_token_without_user_claim_returns_401(self, api_client):
+        response = api_client.get('/notes/events/', HTTP_AUTHORIZATION=f'Bearer {AccessToken()}')
+
+        assert status.HTTP_401_UNAUTHORIZED == response.status_code
+
+
+    def test_event_stream_of_inactive_user_returns_401(self, api_client, make_user):
+        user = make_user()
+        token = UserClaimsRefreshToken.for_user(user).access_token
+        user.is_active = False
+        user.save()
+
+        response = api_client.get('/notes/events/', HTTP_AUTHORIZATION=f'Bearer {token}')
+
+        assert status.HTTP_401_UNAUTHORIZED == response.status_code
+        assert response.json()['detail'] == 'User is inactive'
+
+
+
+
+@pytest.mark.django_db
+class TestRawNoteBody:
+
+    def test_upload_and_download_raw_body_returns_same_bytes(self, api_client, make_note):
+        note = make_note(api_client, is_encrypted=True)
+        ciphertext = bytes(range(256)) # Not valid UTF-8
+
+        response = api_client.put(f'/notes/notes/{note.id}/body/', data=ciphertext, content_type='application/octet-stream')
+        assert status.HTTP_204_NO_CONTENT == response.status_code
+
+        response = api_client.get(f'/notes/notes/{note.id}/body/')
+        assert status.HTTP_200_OK == response.status_code
+        assert response['Content-Type'] == 'application/octet-stream'
+        assert response.content == ciphertext
+
+        note.refresh_from_db()
+        assert bytes(note.body) == ciphertext # Stored as raw bytes (not as base64 text)
+        assert note.version == 2
+
+
+    def test_upload_raw_body_as_json_returns_415_and_keeps_body(self, api_client, make_note):
+        note = make_note(api_client)
+
+        response = api_client.put(f'/notes/notes/{note.id}/body/', data={'body': 'aa'}, format='json')
+
+        assert status.HTTP_415_UNSUPPORTED_MEDIA_TYPE == response.status_code
+        note.refresh_from_db()
+        assert bytes(note.body) == b'aa'
+        assert note.version == 1
+
+
+    def test_upload_empty_raw_body_empties_body(self, api_client, make_note):
+        note = make_note(api_client)
+
+        response = api_client.put(f'/notes/notes/{note.id}/body/')
+
+        assert status.HTTP_204_NO_CONTENT == response.status_code
+        assert api_client.get(f'/notes/notes/{note.id}/body/').content == b''
+
+
+    def test_binary_body_is_returned_as_base64_in_json(self, api_client, make_note):
+        note = make_note(api_client, is_encrypted=True)
+        ciphertext = b'\xff\x00\xfe'
+        api_client.put(f'/notes/notes/{note.id}/body/', data=ciphertext, content_type='application/octet-stream')
+
+        response = api_client.get(f'/notes/notes/{note.id}/')
+
+        assert status.HTTP_200_OK == response.status_code
+        assert response.data['body_format'] == Note.BINARY_BODY
+        assert response.data['body'] == '/wD+'
+
+
+    def test_text_body_written_via_json_is_text_again(self, api_client, make_note):
+        note = make_note(api_client)
+        api_client.put(f'/notes/notes/{note.id}/body/', data=b'\xff', content_type='application/octet-stream')
+
+        response = api_client.put(f'/notes/notes/{note.id}/', data={'title': 'aa', 'body': 'zażółć'}, format='json')
+
+        assert status.HTTP_200_OK == response.status_code
+        assert response.data['body'] == 'zażółć'
+        assert response.data['body_format'] == Note.TEXT_BODY
+
+
+    def test_upload_raw_body_with_read_permission_returns_403(self, api_client, make_note, make_user_with_permission):
+        note = make_note(api_client)
+        new_client = APIClient()
+        make_user_with_permission(new_client, note, permission='R')
+
+        assert status.HTTP_200_OK == new_client.get(f'/notes/notes/{note.id}/body/').status_code
+        response = new_client.put(f'/notes/notes/{note.id}/body/', data=b'aa', content_type='application/octet-stream')
+
+        assert status.HTTP_403_FORBIDDEN == response.status_code
+
+
+    def test_download_raw_encryption_key_returns_200(self, api_client, make_note, make_user_with_permission):
+        note = make_note(api_client, is_encrypted=True)
+        new_client = APIClient()
+        make_user_with_permission(new_client, note, permission='R') # Gets b'aa' as the wrapped key
+
+        response = new_client.get(f'/notes/notes/{note.id}/key/')
+
+        assert status.HTTP_200_OK == response.status_code
+        assert response.content == b'aa'
+
+
+
+
+@pytest.mark.django_db
+class TestNoteBodyCompression:
+
+    def test_large_plaintext_body_is_stored_compressed_and_returned_as_written(self, api_client, make_authenticated_user_and_user_key):
+        make_authenticated_user_and_user_key(api_client)
+        body = '<p>zażółć gęślą jaźń</p>' * 200
+
+        response = api_client.post('/notes/notes/', data={'title': 'aa', 'body': body, 'is_encrypted': False}, format='json')
+
+        assert status.HTTP_201_CREATED == response.status_code
+        assert response.data['body'] == body
+        note = Note.objects.get(id=response.data['id'])
+        assert is_packed(note.body)
+        assert len(note.body) < len(body.encode())
+        assert api_client.get('/notes/notes/me/').data[0]['body'] == body
+        assert api_client.get(f'/notes/notes/{note.id}/body/').content == body.encode()
+
+
+    def test_encrypted_and_small_bodies_are_stored_verbatim(self, api_client, make_note):
+        encrypted_note = make_note(api_client, is_encrypted=True)
+        plaintext_note = make_note(api_client, user=encrypted_note.owner)
+
+        api_client.put(f'/notes/notes/{encrypted_note.id}/', data={'title': 'aa', 'body': 'a' * 5000}, format='json')
+        api_client.put(f'/notes/notes/{plaintext_note.id}/', data={'title': 'aa', 'body': 'a' * 10}, format='json')
+
+        encrypted_note.refresh_from_db()
+        plaintext_note.refresh_from_db()
+        assert bytes(encrypted_note.body) == b'a' * 5000
+        assert bytes(plaintext_note.body) == b'a' * 10
+
+
+    def test_recompress_notes_command_compresses_and_decompresses_existing_bodies(self, api_client, make_note):
+        body = b'<p>aa</p>' * 500
+        plaintext_note = make_note(api_client)
+        encrypted_note = make_note(api_client, is_encrypted=True)
+        Note.objects.filter(id__in=[plaintext_note.id, encrypted_note.id]).update(body=body) # Rows written before compression existed
+
+        call_command('recompress_notes', batch_size=1, stdout=io.StringIO())
+        plaintext_note.refresh_from_db()
+        encrypted_note.refresh_from_db()
+        assert is_packed(plaintext_note.body)
+        assert plaintext_note.get_body() == body
+        assert bytes(encrypted_note.body) == body
+
+        output = io.StringIO()
+        call_command('recompress_notes', stdout=output)
+        assert 'rewrote 0 bodies' in output.getvalue() # Already packed bodies are left alone
+
+        call_command('recompress_notes', decompress=True, stdout=io.StringIO())
+        plaintext_note.refresh_from_db()
+        assert bytes(plaintext_note.body) == body
+
+
+
+
+@pytest.mark.django_db
+class TestChunkedNoteBody:
+
+    def upload_body(self, api_client, note, body, parts=None):
+        upload = api_client.post(f'/notes/notes/{note.id}/uploads/').data
+        chunk_size = upload['chunk_size']
+        chunks = [body[offset:offset + chunk_size] for offset in range(0, len(body), chunk_size)]
+        for index in reversed(range(len(chunks))): # Parts may arrive in any order
+            response = api_client.put(f'/notes/notes/{note.id}/uploads/{upload["id"]}/parts/{index}/', data=chunks[index], content_type='application/octet-stream')
+            assert status.HTTP_204_NO_CONTENT == response.status_code
+        return api_client.post(f'/notes/notes/{note.id}/uploads/{upload["id"]}/commit/', data={'parts': parts or len(chunks), 'sha256': hashlib.sha256(body).hexdigest()}, format='json')
+
+
+    def test_upload_large_body_in_parts_and_download_it_returns_200(self, api_client, make_note, settings):
+        settings.NOTES_BODY_CHUNK_SIZE = 4
+        note = make_note(api_client, is_encrypted=True)
+        body = bytes(range(10))
+
+        response = self.upload_body(api_client, note, body)
+
+        assert status.HTTP_200_OK == response.status_code
+        assert response.data == {'version': 2, 'size': 10}
+        assert NoteBodyChunk.of_bodies([note]).count() == 3
+        assert api_client.get(f'/notes/notes/{note.id}/').data['body'] is None
+        response = api_client.get(f'/notes/notes/{note.id}/body/')
+        assert status.HTTP_200_OK == response.status_code
+        assert b''.join(response.streaming_content) == body
+
+
+    def test_download_range_of_chunked_body_returns_206(self, api_client, make_note, settings):
+        settings.NOTES_BODY_CHUNK_SIZE = 4
+        note = make_note(api_client, is_encrypted=True)
+        body = bytes(range(10))
+        self.upload_body(api_client, note, body)
+
+        response = api_client.get(f'/notes/notes/{note.id}/body/', HTTP_RANGE='bytes=3-8')
+        assert status.HTTP_206_PARTIAL_CONTENT == response.status_code
+        assert response['Content-Range'] == 'bytes 3-8/10'
+        assert b''.join(response.streaming_content) == body[3:9]
+
+        response = api_client.get(f'/notes/notes/{note.id}/body/', HTTP_RANGE='bytes=-2')
+        assert b''.join(response.streaming_content) == body[-2:]
+
+        response = api_client.get(f'/notes/notes/{note.id}/body/', HTTP_RANGE='bytes=10-')
+        assert status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE == response.status_code
+
+
+    def test_download_range_of_inline_body_returns_206(self, api_client, make_note):
+        note = make_note(api_client)
+        api_client.put(f'/notes/notes/{note.id}/', data={'title': 'aa', 'body': 'abcdef'}, format='json')
+
+        response = api_client.get(f'/notes/notes/{note.id}/body/', HTTP_RANGE='bytes=2-3')
+
+        assert status.HTTP_206_PARTIAL_CONTENT == response.status_code
+        assert response.content == b'cd'
+
+
+    def test_commit_with_wrong_checksum_or_missing_parts_returns_400(self, api_client, make_note, settings):
+        settings.NOTES_BODY_CHUNK_SIZE = 4
+        note = make_note(api_client)
+        upload = api_client.post(f'/notes/notes/{note.id}/uploads/').data
+        api_client.put(f'/notes/notes/{note.id}/uploads/{upload["id"]}/parts/0/', data=b'abcd', content_type='application/octet-stream')
+        commit_url = f'/notes/notes/{note.id}/uploads/{upload["id"]}/commit/'
+
+        response = api_client.post(commit_url, data={'parts': 2, 'sha256': hashlib.sha256(b'abcdef').hexdigest()}, format='json')
+        assert status.HTTP_400_BAD_REQUEST == response.status_code
+        assert response.data['missing'] == [1]
+
+        response = api_client.post(commit_url, data={'parts': 1, 'sha256': hashlib.sha256(b'abcdef').hexdigest()}, format='json')
+        assert status.HTTP_400_BAD_REQUEST == response.status_code
+        assert 'sha256' in response.data
+
+        assert api_client.get(f'/notes/notes/{note.id}/uploads/{upload["id"]}/').data['parts'] == [{'index': 0, 'size': 4}]
+
+
+    def test_commit_after_note_changed_returns_412(self, api_client, make_note):
+        note = make_note(api_client)
+        upload = api_client.post(f'/notes/notes/{note.id}/uploads/').data
+        api_client.put(f'/notes/notes/{note.id}/uploads/{upload["id"]}/parts/0/', data=b'abcd', content_type='application/octet-stream')
+        api_client.put(f'/notes/notes/{note.id}/', data={'title': 'aa', 'body': 'bb'}, format='json')
+
+        response = api_client.post(f'/notes/notes/{note.id}/uploads/{upload["id"]}/commit/', data={'parts': 1, 'sha256': hashlib.sha256(b'abcd').hexdigest()}, format='json')
+
+        assert status.HTTP_412_PRECONDITION_FAILED == response.status_code
+
+
+    def test_small_body_is_stored_in_note_and_json_update_drops_chunks(self, api_client, make_note, settings):
+        settings.NOTES_BODY_CHUNK_SIZE = 4
+        note = make_note(api_client)
+        self.upload_body(api_client, note, b'abc')
+        note.refresh_from_db()
+        assert note.body_format == Note.BINARY_BODY
+        assert bytes(note.body) == b'abc'
+
+        self.upload_body(api_client, note, b'abcdefgh')
+        api_client.put(f'/notes/notes/{note.id}/', data={'title': 'aa', 'body': 'bb'}, format='json')
+
+        assert not NoteBodyChunk.of_bodies([note]).exists()
+
+
+    def test_upload_part_of_other_users_upload_returns_404(self, api_client, make_note, make_user_with_permission):
+        note = make_note(api_client)
+        upload = api_client.post(f'/notes/notes/{note.id}/uploads/').data
+        new_client = APIClient()
+        make_user_with_permission(new_client, note, permission='W')
+
+        response = new_client.put(f'/notes/notes/{note.id}/uploads/{upload["id"]}/parts/0/', data=b'abcd', content_type='application/octet-stream')
+
+        assert status.HTTP_404_NOT_FOUND == response.status_code
+
+
+
+
+@pytest.mark.django_db
+class TestNoteBodyChunkStore:
+
+    def make_body(self, size):
+        return b''.join(hashlib.sha256(str(index).encode()).digest() for index in range(size // 32)) # Incompressible, no repeating chunks
+
+
+    def test_large_body_is_stored_as_chunks_and_edit_writes_only_new_chunks(self, api_client, make_note):
+        note = make_note(api_client, is_encrypted=True)
+        body = self.make_body(256 * 1024)
+
+        api_client.put(f'/notes/notes/{note.id}/body/', data=body, content_type='application/octet-stream')
+        note.refresh_from_db()
+        assert note.body_size == len(body)
+        assert bytes(note.body) == b''
+        blobs_count = NoteBodyBlob.objects.count()
+        assert blobs_count > 1
+
+        edited_body = body[:100_000] + b'edit' + body[100_000:]
+        api_client.put(f'/notes/notes/{note.id}/body/', data=edited_body, content_type='application/octet-stream')
+
+        assert NoteBodyBlob.objects.count() - blobs_count <= 2 # Only chunk(s) around the edit are new
+        assert api_client.get(f'/notes/notes/{note.id}/body/').getvalue() == edited_body
+        response = api_client.get(f'/notes/notes/{note.id}/body/', HTTP_RANGE='bytes=99998-100005')
+        assert status.HTTP_206_PARTIAL_CONTENT == response.status_code
+        assert response.getvalue() == edited_body[99998:100006]
+
+
+    def test_identical_bodies_share_chunks_and_only_listing_returns_null_body(self, api_client, make_note, make_user_notes):
+        user, user_key, notes = make_user_notes(api_client, count=2)
+        body = self.make_body(128 * 1024).hex()[:128 * 1024] # Plaintext (chunks are compressed)
+
+        for note in notes:
+            response = api_client.put(f'/notes/notes/{note.id}/', data={'title': 'aa', 'body': body}, format='json')
+            assert status.HTTP_200_OK == response.status_code
+
+        assert NoteBodyChunk.of_bodies([notes[0]]).count() == NoteBodyChunk.of_bodies([notes[1]]).count() == NoteBodyBlob.objects.count()
+        assert NoteBodyBlob.objects.filter(is_compressed=True).exists()
+        with CaptureQueriesContext(connection) as queries:
+            listed = api_client.get('/notes/notes/me/').data
+        assert all(note['body'] is None and note['body_size'] == len(body) for note in listed) # Download via body endpoint
+        assert not any('notes_notebodychunk' in query['sql'] for query in queries.captured_queries) # Manifests are not read per listed note
+        assert api_client.get(f'/notes/notes/{notes[0].id}/body/').getvalue() == body.encode()
+        assert api_client.get(f'/notes/notes/{notes[0].id}/').data['body'] == body # Detail and `bodies` return the assembled body
+        response = api_client.post('/notes/notes/bodies/', {'ids': [str(note.id) for note in notes]}, format='json')
+        assert [note['body'] for note in response.data] == [body, body]
+
+
+    def test_split_matches_rolling_hash_over_every_byte(self):
+        body = self.make_body(512 * 1024) + b'a' * 100_000 + self.make_body(64 * 1024)
+        expected = []
+        start = 0
+        while start < len(body): # Reference implementation - fingerprint of every byte after MIN_CHUNK_SIZE
+            end = min(start + cdc.MAX_CHUNK_SIZE, len(body))
+            cut = end
+            fingerprint = 0
+            for position in range(start + cdc.MIN_CHUNK_SIZE, end):
+                fingerprint = ((fingerprint << 1) + cdc.GEAR[body[position]]) & cdc.UINT64
+                if not fingerprint & cdc.BOUNDARY_MASK:
+                    cut = position + 1
+                    break
+            expected.append(body[start:cut])
+            start = cut
+
+        assert [bytes(chunk) for chunk in cdc.split(body)] == expected
+
+
+    def test_delete_unused_note_blobs_command_keeps_used_blobs(self, api_client, make_note):
+        note = make_note(api_client, is_encrypted=True)
+        body = self.make_body(128 * 1024)
+        api_client.put(f'/notes/notes/{note.id}/body/', data=body, content_type='application/octet-stream')
+        api_client.put(f'/notes/notes/{note.id}/body/', data=body[:50_000], content_type='application/octet-stream') # Small body is stored in the row again
+        other_note = make_note(api_client, user=note.owner, is_encrypted=True)
+        api_client.put(f'/notes/notes/{other_note.id}/body/', data=body, content_type='application/octet-stream')
+        api_client.put(f'/notes/notes/{other_note.id}/body/', data=body[:-10], content_type='application/octet-stream')
+        used_blobs = set(NoteBodyChunk.objects.values_list('blob', flat=True))
+
+        call_command('delete_unused_note_blobs', stdout=io.StringIO())
+
+        assert set(NoteBodyBlob.objects.values_list('digest', flat=True)) == used_blobs
+        assert api_client.get(f'/notes/notes/{other_note.id}/body/').getvalue() == body[:-10]
+
+
+
+
+@pytest.mark.django_db
+class TestNoteRevisions:
+
+    def make_bodies(self, count):
+        lines = [f'<p>line {index}</p>\n' for index in range(200)]
+        bodies = []
+        for index in range(count):
+            lines[index * 7 % len(lines)] = f'<p>edit {index}</p>\n'
+            bodies.append(''.join(lines))
+        return bodies
+
+
+    def test_plaintext_changes_are_stored_as_deltas_with_periodic_keyframes(self, api_client, make_note, settings):
+        settings.NOTES_REVISION_KEYFRAME_INTERVAL = 4
+        note = make_note(api_client)
+        bodies = self.make_bodies(9)
+
+        for body in bodies:
+            response = api_client.put(f'/notes/notes/{note.id}/', data={'title': 'aa', 'body': body}, format='json')
+            assert status.HTTP_200_OK == response.status_code
+
+        revisions = list(NoteRevision.objects.filter(note=note).order_by('version'))
+        assert [revision.kind for revision in revisions] == ['K', 'D', 'D', 'D'] * 2 + ['K']
+        assert all(len(revision.data) < 200 for revision in revisions if revision.kind == NoteRevision.DELTA)
+        for version, body in enumerate(bodies, start=2):
+            response = api_client.get(f'/notes/notes/{note.id}/revisions/{version}/')
+            assert status.HTTP_200_OK == response.status_code
+            assert response.data['body'] == body
+
+
+    def test_encrypted_changes_are_stored_as_snapshots(self, api_client, make_note):
+        note = make_note(api_client, is_encrypted=True)
+
+        for body in self.make_bodies(3):
+            api_client.put(f'/notes/notes/{note.id}/', data={'title': 'aa', 'body': body}, format='json')
+
+        assert set(NoteRevision.objects.filter(note=note).values_list('kind', flat=True)) == {NoteRevision.KEYFRAME}
+
+
+    def test_revisions_list_newest_first_for_user_with_read_permission(self, api_client, make_note, make_user_with_permission):
+        note = make_note(api_client)
+        api_client.put(f'/notes/notes/{note.id}/', data={'title': 'first', 'body': 'aa'}, format='json')
+        api_client.put(f'/notes/notes/{note.id}/', data={'title': 'second', 'body': 'bb'}, format='json')
+        new_client = APIClient()
+        make_user_with_permission(new_client, note, permission='R')
+
+        response = new_client.get(f'/notes/notes/{note.id}/revisions/')
+
+        assert status.HTTP_200_OK == response.status_code
+        assert [revision['title'] for revision in response.data] == ['second', 'first']
+        assert response.data[0]['author'] == note.owner.username
+        assert 'body' not in response.data[0]
+
+
+    def test_revisions_of_note_without_access_are_forbidden(self, api_client, make_note, make_authenticated_user_and_user_key):
+        note = make_note(api_client)
+        new_client = APIClient()
+        make_authenticated_user_and_user_key(new_client)
+
+        response = new_client.get(f'/notes/notes/{note.id}/revisions/{note.version}/')
+
+        assert status.HTTP_403_FORBIDDEN == response.status_code
+
+
+    def test_compact_revisions_keeps_latest_and_turns_oldest_kept_delta_into_keyframe(self, api_client, make_note, settings):
+        settings.NOTES_REVISION_KEYFRAME_INTERVAL = 10
+        settings.NOTES_REVISIONS_MAX = 3
+        note = make_note(api_client)
+        bodies = self.make_bodies(6)
+        for body in bodies:
+            api_client.put(f'/notes/notes/{note.id}/', data={'title': 'aa', 'body': body}, format='json')
+
+        assert compact_revisions(note.id) == 3
+
+        revisions = list(NoteRevision.objects.filter(note=note).order_by('version'))
+        assert [revision.kind for revision in revisions] == ['K', 'D', 'D']
+        assert [api_client.get(f'/notes/notes/{note.id}/revisions/{revision.version}/').data['body'] for revision in revisions] == bodies[3:]
+
+
+    def test_large_body_revisions_share_chunks_with_note(self, api_client, make_note):
+        note = make_note(api_client, is_encrypted=True)
+        body = b''.join(hashlib.sha256(str(index).encode()).digest() for index in range(4096)) # 128 KiB, incompressible
+        api_client.put(f'/notes/notes/{note.id}/body/', data=body, content_type='application/octet-stream')
+        blobs_count = NoteBodyBlob.objects.count()
+        api_client.put(f'/notes/notes/{note.id}/body/', data=body[:10_000], content_type='application/octet-stream')
+
+        call_command('delete_unused_note_blobs', stdout=io.StringIO())
+
+        assert NoteBodyBlob.objects.count() == blobs_count # Blobs are still used by the first revision
+        note.refresh_from_db()
+        response = api_client.get(f'/notes/notes/{note.id}/revisions/{note.version - 1}/')
+        assert response.data['body_size'] == len(body)
+        assert base64.b64decode(response.data['body']) == body
+
+
+
+
+@pytest.mark.django_db
+class TestNoteBodyPatch:
+
+    def patch_body(self, api_client, note, base_version, edits):
+        return api_client.patch(f'/notes/notes/{note.id}/body/', data={'base_version': base_version, 'edits': edits}, format='json')
+
+
+    def test_patch_applies_edits_to_plaintext_body(self, api_client, make_note):
+        note = make_note(api_client)
+        api_client.put(f'/notes/notes/{note.id}/', data={'title': 'aa', 'body': '<p>zażółć</p><p>bb</p>'}, format='json')
+        note.refresh_from_db()
+
+        response = self.patch_body(api_client, note, note.version, [
+            {'offset': 3, 'length': 0, 'data': 'Hello '}, # Insert
+            {'offset': 20, 'length': 2, 'data': 'cc'}, # Replace (offsets are in bytes)
+            {'offset': 22, 'length': 4}, # Delete
+        ])
+
+        assert status.HTTP_200_OK == response.status_code
+        assert response.data['version'] == note.version + 1
+        assert api_client.get(f'/notes/notes/{note.id}/').data['body'] == '<p>Hello zażółć</p><p>cc'
+        assert NoteRevision.objects.filter(note=note, version=note.version + 1).exists()
+
+
+    def test_patch_replaces_chunk_of_encrypted_body(self, api_client, make_note):
+        note = make_note(api_client, is_encrypted=True)
+        body = bytes(range(256)) * 4
+        api_client.put(f'/notes/notes/{note.id}/body/', data=body, content_type='application/octet-stream')
+        note.refresh_from_db()
+
+        response = self.patch_body(api_client, note, note.version, [{'offset': 256, 'length': 256, 'data': base64.b64encode(b'\xff' * 256).decode()}])
+
+        assert status.HTTP_200_OK == response.status_code
+        assert api_client.get(f'/notes/notes/{note.id}/body/').getvalue() == body[:256] + b'\xff' * 256 + body[512:]
+
+
+    def test_patch_of_outdated_version_returns_412(self, api_client, make_note):
+        note = make_note(api_client)
+
+        response = self.patch_body(api_client, note, note.version + 1, [{'offset': 0, 'data': 'a'}])
+
+        assert status.HTTP_412_PRECONDITION_FAILED == response.status_code
+        note.refresh_from_db()
+        assert bytes(note.get_body()) == b'aa'
+
+
+    @pytest.mark.parametrize('edits', [
+        [{'offset': 1, 'length': 1, 'data': 'a'}, {'offset': 1, 'data': 'b'}], # Overlapping
+        [{'offset': 0, 'length': 3, 'data': 'a'}], # Out of range
+        [{'offset': 2, 'data': 'a'}, {'offset': 0, 'length': 1}], # Not sorted
+    ])
+    def test_patch_with_invalid_edits_returns_400(self, api_client, make_note, edits):
+        note = make_note(api_client)
+
+        response = self.patch_body(api_client, note, note.version, edits)
+
+        assert status.HTTP_400_BAD_REQUEST == response.status_code
+
+
+    def test_patch_with_read_permission_returns_403(self, api_client, make_note, make_user_with_permission):
+        note = make_note(api_client)
+        new_client = APIClient()
+        make_user_with_permission(new_client, note, permission='R')
+
+        response = self.patch_body(new_client, note, note.version, [{'offset': 0, 'data': 'a'}])
+
+        assert status.HTTP_403_FORBIDDEN == response.status_code
+
+
+
+
+@pytest.mark.django_db
+class TestNoteSearch:
+
+    def write_notes(self, api_client, notes, contents):
+        for note, (title, body) in zip(notes, contents):
+            response = api_client.put(f'/notes/notes/{note.id}/', data={'title': title, 'body': body}, format='json')
+            assert status.HTTP_200_OK == response.status_code
+
+
+    def test_search_returns_ranked_notes_with_snippets(self, api_client, make_user_notes):
+        user, user_key, notes = make_user_notes(api_client, count=3)
+        self.write_notes(api_client, notes, [
+            ('Shopping', '<p>Buy milk &amp; bread</p>'),
+            ('Recipes', '<p>Pancakes need <b>milk</b>, eggs and flour</p>'),
+            ('Milk', '<p>Remember the milk</p>'),
+        ])
+
+        response = api_client.get('/notes/notes/search/', {'q': 'milk'})
+
+        assert status.HTTP_200_OK == response.status_code
+        results = response.data['results']
+        assert len(results) == 3
+        assert results[0]['title'] == 'Milk' # Title matches rank higher
+        assert 'body' not in results[0]
+        snippets = {result['title']: result['snippet'] for result in results}
+        assert snippets['Shopping'] == 'Buy <mark>milk</mark> &amp; bread'
+        assert snippets['Recipes'] == 'Pancakes need <mark>milk</mark>, eggs and flour'
+
+
+    def test_search_does_not_read_bodies_kept_in_chunk_store(self, api_client, make_user_notes):
+        user, user_key, notes = make_user_notes(api_client, count=1)
+        self.write_notes(api_client, notes, [('aa', '<p>milk</p>\n<p>' + ' '.join(str(index) for index in range(20_000)))])
+
+        with CaptureQueriesContext(connection) as queries:
+            results = api_client.get('/notes/notes/search/', {'q': 'milk'}).data['results']
+
+        assert [result['snippet'] for result in results] == ['']
+        assert not any('notes_notebodychunk' in query['sql'] for query in queries.captured_queries)
+
+
+    def test_search_skips_encrypted_and_inaccessible_notes(self, api_client, make_user_notes):
+        user, user_key, notes = make_user_notes(api_client, count=1)
+        user, user_key, encrypted_notes = make_user_notes(api_client, count=1, is_encrypted=True)
+        self.write_notes(api_client, encrypted_notes, [('milk', 'milk')])
+        other_client = APIClient()
+        make_user_notes(other_client, count=1)
+        Note.objects.filter(id=notes[0].id).update(title='milk', body=b'milk')
+        call_command('update_search_vectors', stdout=io.StringIO())
+
+        assert api_client.get('/notes/notes/search/', {'q': 'milk'}).data['results'] == []
+        assert [result['id'] for result in other_client.get('/notes/notes/search/', {'q': 'milk'}).data['results']] == []
+        assert Note.objects.get(id=encrypted_notes[0].id).search_vector is None
+
+
+    def test_search_follows_note_changes(self, api_client, make_user_notes):
+        user, user_key, notes = make_user_notes(api_client, count=1)
+        self.write_notes(api_client, notes, [('aa', 'first draft')])
+        api_client.patch(f'/notes/notes/{notes[0].id}/body/', data={'base_version': notes[0].version + 1, 'edits': [{'offset': 0, 'length': 5, 'data': 'final'}]}, format='json')
+
+        assert api_client.get('/notes/notes/search/', {'q': 'first'}).data['results'] == []
+        assert len(api_client.get('/notes/notes/search/', {'q': 'final draft'}).data['results']) == 1
+
+
+    def test_search_update_search_vectors_command_indexes_existing_notes(self, api_client, make_user_notes):
+        user, user_key, notes = make_user_notes(api_client, count=2)
+        Note.objects.filter(id__in=[note.id for note in notes]).update(body=b'<p>old note</p>', search_vector=None) # Notes written before search existed
+
+        call_command('update_search_vectors', batch_size=1, stdout=io.StringIO())
+
+        assert len(api_client.get('/notes/notes/search/', {'q': 'old'}).data['results']) == 2
+
+
+    def test_search_is_paginated_by_rank(self, api_client, make_user_notes):
+        user, user_key, notes = make_user_notes(api_client, count=3)
+        self.write_notes(api_client, notes, [(f'note {index}', 'milk ' * (index + 1)) for index in range(3)])
+
+        titles = []
+        url = '/notes/notes/search/?q=milk&page_size=2'
+        while url:
+            response = api_client.get(url)
+            titles += [result['title'] for result in response.data['results']]
+            url = response.data['next']
+
+        assert titles == ['note 2', 'note 1', 'note 0']
+
+
+    def test_search_pages_through_notes_with_tied_rank(self, api_client, make_user_notes):
+        user, user_key, notes = make_user_notes(api_client, count=4)
+        self.write_notes(api_client, notes, [(f'note {index}', 'milk and bread') for index in range(4)])
+
+        ids = []
+        url = '/notes/notes/search/?q=milk&page_size=3'
+        while url:
+            response = api_client.get(url)
+            ids += [result['id'] for result in response.data['results']]
+            url = response.data['next']
+
+        assert ids == sorted(str(note.id) for note in notes) # Ties ordered by id, none skipped at the page boundary
+
+
+    def test_search_without_query_returns_400(self, api_client, make_user_notes):
+        make_user_notes(api_client, count=1)
+
+        response = api_client.get('/notes/notes/search/')
+
+        assert status.HTTP_400_BAD_REQUEST == response.status_code
+
+
+
+
+@pytest.mark.django_db
+class TestBlindIndexSearch:
+
+    def tokens(self, *words):
+        return [base64.b64encode(hashlib.sha256(word.encode()).digest()).decode() for word in words] # Stands for HMAC with user's key
+
+
+    def blind_search(self, api_client, words, match='all'):
+        response = api_client.post('/notes/notes/search/blind/', data={'tokens': self.tokens(*words), 'match': match}, format='json')
+        assert status.HTTP_200_OK == response.status_code
+        return sorted(response.data['ids'])
+
+
+    def test_tokens_sent_with_body_are_searchable(self, api_client, make_user_notes):
+        user, user_key, notes = make_user_notes(api_client, count=2, is_encrypted=True)
+        api_client.put(f'/notes/notes/{notes[0].id}/', data={'title': 'aa', 'body': 'ciphertext', 'search_tokens': self.tokens('milk', 'bread')}, format='json')
+        api_client.put(f'/notes/notes/{notes[1].id}/', data={'title': 'aa', 'body': 'ciphertext', 'search_tokens': self.tokens('milk', 'eggs')}, format='json')
+
+        assert self.blind_search(api_client, ['milk']) == sorted([str(notes[0].id), str(notes[1].id)])
+        assert self.blind_search(api_client, ['milk', 'bread']) == [str(notes[0].id)]
+        assert self.blind_search(api_client, ['bread', 'eggs'], match='any') == sorted([str(notes[0].id), str(notes[1].id)])
+        assert self.blind_search(api_client, ['flour']) == []
+
+
+    def test_create_with_tokens_and_update_replaces_them(self, api_client, make_authenticated_user_and_user_key):
+        make_authenticated_user_and_user_key(api_client)
+        response = api_client.post('/notes/notes/', data={'title': 'aa', 'body': 'ciphertext', 'is_encrypted': True, 'encryption_key': 'key', 'search_tokens': self.tokens('milk')}, format='json')
+        note_id = response.data['id']
+        assert self.blind_search(api_client, ['milk']) == [note_id]
+
+        api_client.put(f'/notes/notes/{note_id}/', data={'title': 'aa', 'body': 'ciphertext', 'search_tokens': self.tokens('eggs')}, format='json')
+
+        assert self.blind_search(api_client, ['milk']) == []
+        assert self.blind_search(api_client, ['eggs']) == [note_id]
+
+
+    def test_tokens_are_per_user(self, api_client, make_shared_note, make_user_with_permission):
+        note = make_shared_note(api_client, is_encrypted=True)[0]
+        reader_client = APIClient()
+        make_user_with_permission(reader_client, note, permission='R')
+
+        response = reader_client.put(f'/notes/notes/{note.id}/search_tokens/', data={'tokens': self.tokens('milk')}, format='json')
+
+        assert status.HTTP_204_NO_CONTENT == response.status_code
+        assert self.blind_search(reader_client, ['milk']) == [str(note.id)]
+        assert self.blind_search(api_client, ['milk']) == [] # Owner didn't index the note
+
+
+    def test_disabling_encryption_drops_tokens(self, api_client, make_user_notes):
+        user, user_key, notes = make_user_notes(api_client, count=1, is_encrypted=True)
+        api_client.put(f'/notes/notes/{notes[0].id}/search_tokens/', data={'tokens': self.tokens('milk')}, format='json')
+
+        api_client.put(f'/notes/notes/{notes[0].id}/change_encryption/', data={'is_encrypted': False, 'new_body': 'milk'}, format='json')
+
+        assert self.blind_search(api_client, ['milk']) == []
+
+
+    @pytest.mark.parametrize('tokens', [['not base64!'], [base64.b64encode(b'short').decode()]])
+    def test_invalid_tokens_return_400(self, api_client, make_user_notes, tokens):
+        user, user_key, notes = make_user_notes(api_client, count=1, is_encrypted=True)
+
+        response = api_client.put(f'/notes/notes/{notes[0].id}/search_tokens/', data={'tokens': tokens}, format='json')
+
+        assert status.HTTP_400_BAD_REQUEST == response.status_code
+
+
+
+
+@pytest.mark.django_db
+class TestNoteTitleSearch:
+
+    def search_titles(self, api_client, query, **params):
+        response = api_client.get('/notes/notes/search/titles/', {'q': query, **params})
+        assert status.HTTP_200_OK == response.status_code
+        return [note['title'] for note in response.data]
+
+
+    def test_search_titles_matches_substrings_and_typos_best_first(self, api_client, make_user_notes):
+        user, user_key, notes = make_user_notes(api_client, count=4, is_encrypted=True) # Titles are searchable even if bodies are encrypted
+        for note, title in zip(notes, ['Shopping list', 'Shop opening hours', 'Workshop notes', 'Holidays']):
+            Note.objects.filter(id=note.id).update(title=title)
+
+        assert self.search_titles(api_client, 'SHOP') == ['Shop opening hours', 'Shopping list', 'Workshop notes']
+        assert self.search_titles(api_client, 'hollidays') == ['Holidays']
+        assert self.search_titles(api_client, 'shop', limit=1) == ['Shop opening hours']
+
+
+    def test_search_titles_skips_notes_of_other_users(self, api_client, make_user_notes):
+        make_user_notes(api_client, count=1)
+        other_client = APIClient()
+        make_user_notes(other_client, count=1)
+
+        assert self.search_titles(api_client, 'note') == ['note 0']
+
+
+
+
+class TestStreamingResponse:
+
+    def test_asgi_request_streams_content_lazily_in_batches(self):
+        consumed = []
+        def content():
+            for part in (b'a', b'b', b'c'):
+                consumed.append(part)
+                yield part
+        request = AsyncRequestFactory().get('/notes/notes/me/')
+
+        response = streaming_response(request, content(), batch_size=2)
+
+        async def read_first():
+            async for part in response:
+                return part
+        assert response.is_async
+        assert consumed == []
+        assert asyncio.run(read_first()) == b'a'
+        assert consumed == [b'a', b'b']
+
+
+    def test_wsgi_request_keeps_sync_iterator(self):
+        response = streaming_response(APIRequestFactory().get('/notes/notes/me/'), iter([b'a', b'b']))
+
+        assert not response.is_async
+        assert b''.join(response) == b'ab'
+
+
+
+
+@pytest.mark.django_db
+class TestCacheStats:
+
+    def test_two_level_cache_counts_local_hits_shared_hits_and_misses(self):
+        cache = TwoLevelCache(prefix='test_stats', maxsize=10, timeout=60, local_timeout=60)
+        cache.delete_many(['test_stats:a', 'test_stats:b'])
+
+        cache.get('test_stats:a') # Miss
+        cache.set('test_stats:a', 1)
+        cache.get('test_stats:a') # Local hit
+        cache.clear_local()
+        cache.get_many(['test_stats:a', 'test_stats:b']) # Shared hit + miss
+
+        assert cache.stats() == {'local_hits': 1, 'shared_hits': 1, 'misses': 2, 'hit_ratio': 0.5, 'local_size': 1}
+
+
+    def test_cache_stats_endpoint_is_for_staff_only(self, api_client, make_authenticated_user):
+        user = make_authenticated_user(api_client)
+
+        response = api_client.get('/__debug__/cache-stats/')
+        assert status.HTTP_403_FORBIDDEN == response.status_code
+
+        user.is_staff = True
+        user.save()
+        response = api_client.get('/__debug__/cache-stats/')
+        assert status.HTTP_200_OK == response.status_code
+        assert set(response.json()) == {'acl', 'public_key', 'user_active'}
+        assert set(response.json()['acl']) == {'local_hits', 'shared_hits', 'misses', 'hit_ratio', 'local_size'}
@@ -1,9 +1,11 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 
-from . import views
+from . import views, events
 
 router = DefaultRouter()
 router.register('notes', views.NotesViewSet)
 
-urlpatterns = router.urls
+urlpatterns = [
+    path('events/', events.note_events, name='note-events'), # Server-Sent Events stream of note changes
+] + router.urls
@@ -1,34 +1,65 @@
+from datetime import timedelta
+
 from django.apps import apps
 from django.conf import settings
+from django.db import transaction
+from django.contrib.postgres.search import SearchRank, TrigramWordSimilarity
+from django.db.models import Count, F, FloatField, Q
+from django.db.models.functions import Cast, Upper
+from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.decorators import action
 from rest_framework.mixins import CreateModelMixin, RetrieveModelMixin, UpdateModelMixin, DestroyModelMixin
 from rest_framework.viewsets import GenericViewSet, ModelViewSet
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
-
-from .models import Note, NoteItem
-from .serializers import NotesSerializer, NoteMeSerializer, NotesDetailSerializer, UserKeyInfoSerializer, \
-            ChangeEncryptionSerializer, ShareNoteSerializer, ShareEncryptedNoteSerializer, GetPublicKeySerializer, RemoveAccessToNote
-from .permissions import CanReadNote, CanWriteNote, CanShareNote, CanDeleteNote, CanChangeEncryption
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.exceptions import NotFound, UnsupportedMediaType, ValidationError
+from rest_framework.parsers import JSONParser
+
+from .models import Note, NoteItem, NoteSearchToken, NoteTombstone, NoteUpload, NoteRevision, NoteBodyBlob, NoteBodyChunk, NextChangeSeq, settled_change_seq, write_body_chunks, write_search_vectors
+from .serializers import NotesSerializer, NoteMeSerializer, NoteSummarySerializer, NoteBodySerializer, NoteBodiesRequestSerializer, \
+            NotesDetailSerializer, UserKeyInfoSerializer, ChangeEncryptionSerializer, ShareNoteSerializer, ShareEncryptedNoteSerializer, \
+            BulkShareNoteSerializer, NoteBatchOperationSerializer, NoteBatchSerializer, NoteChangesQuerySerializer, NoteSearchQuerySerializer, NoteSearchResultSerializer, NoteTitleSearchQuerySerializer, NoteTitleSearchResultSerializer, NoteSearchTokensSerializer, BlindSearchSerializer, NoteUploadSerializer, \
+            NoteUploadCommitSerializer, NoteBodyPatchSerializer, NoteRevisionSerializer, NoteRevisionDetailSerializer, GetPublicKeySerializer, RemoveAccessToNote
+from .permissions import CanReadNote, CanWriteNote, CanShareNote, CanDeleteNote, CanChangeEncryption, get_request_user_key
+from .pagination import NoteKeysetPagination, NoteSearchPagination
+from .parsers import RawBytesParser
+from .chunks import parse_range, apply_edits, upload_sha256, RangeNotSatisfiable, EditOutOfRange
+from .cdc import digest
+from .compression import decompress_chunk
+from .acl import invalidate_permissions
+from .events import publish_note_event, publish_notes_changed, NOTE_CHANGED, NOTE_SHARED
+from .etags import note_etag, note_list_etag, etag_matches
+from .exceptions import PreconditionFailed
+from .search import search_query, headlines
+from .streaming import streaming_response
+from .revisions import record_revisions
+
+from accounts.rotation import lock_key_holders
+
+
+UPLOAD_URL = r'uploads/(?P<upload_id>[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})'
 
 
 class NotesViewSet(CreateModelMixin, RetrieveModelMixin, UpdateModelMixin, DestroyModelMixin, GenericViewSet): # This endpoint also supports the POST request
     queryset = Note.objects.all()
     serializer_class = NotesSerializer
+    me_fields = ['id', 'permission', 'encryption_key', 'change_seq', 'note', 'note__id', 'note__title', 'note__body', 'note__body_format', 'note__body_size', 'note__is_encrypted',
+                 'note__created_at', 'note__version', 'note__change_seq', 'note__owner', 'note__owner__username'] # Columns NoteMeSerializer (and delta sync) actually reads
 
     def _get_user_key(self, user_id_list):
-        """Utility method to get UserKey for a user from settings Returns UserKey instance or None if not found."""
-        #! CURRENTLY USER CAN HAVE MANY USERKEY RECORDS SO FILTER WILL RETURN A LIST OF OBJECTS
-        #TODO: DO SOMETHING WITH THIS ^^ - EITHER ADDITIONAL QUERY OR ENSURE THAT A USER CAN HAVE JUST ONE USERKEY OBJECT -- DUNNO YET
+        """Active UserKeys of given users resolved in one query. Returns UserKey instance for a single user, list for many or None if some user has no key."""
         try:
             UserKey = apps.get_model(settings.AUTH_USER_KEY_MODEL) # Get the UserKey model from the settings - this approach maintains the principle of loose coupling between apps (I think)
-            user_key_list = [UserKey.objects.get(user=user_id) for user_id in user_id_list]
+            user_keys = {str(user_key.user_id): user_key for user_key in UserKey.objects.active().filter(user__in=user_id_list)}
+            user_key_list = [user_keys[str(user_id)] for user_id in user_id_list]
             if 1 == len(user_key_list):
                 return user_key_list[0]
             return user_key_list
-        except UserKey.DoesNotExist:
+        except KeyError:
             return None
         except (LookupError, AttributeError):
             #TODO: Handle case where AUTH_USER_KEY_MODEL setting doesn't exist
@@ -39,11 +70,15 @@ class NotesViewSet(CreateModelMixin, RetrieveModelMixin, UpdateModelMixin, Destr
         """Apply different permissions based on action."""
         if self.action == 'retrieve':
             permission_classes = [CanReadNote]
-        elif self.action in ['update', 'partial_update']:
+        elif self.action == 'raw_body':
+            permission_classes = [CanWriteNote] if self.request.method in ['PUT', 'PATCH'] else [CanReadNote]
+        elif self.action in ['raw_key', 'revisions', 'revision', 'search_tokens']:
+            permission_classes = [CanReadNote]
+        elif self.action in ['update', 'partial_update', 'uploads', 'upload', 'upload_part', 'upload_commit']:
             permission_classes = [CanWriteNote]
         elif self.action == 'destroy':
             permission_classes = [CanDeleteNote]
-        elif self.action == 'share':
+        elif self.action in ['share', 'bulk_share']:
             permission_classes = [CanShareNote]
         elif self.action == 'change_encryption':
             permission_classes = [CanChangeEncryption]
@@ -66,20 +101,442 @@ class NotesViewSet(CreateModelMixin, RetrieveModelMixin, UpdateModelMixin, Destr
         """Return owner_id in the context in order to automatically set owner id during notes creation."""
         context = super().get_serializer_context()
         context['owner_id'] = self.request.user.id # Inserts owner_id into context to use it in the NotesSerializer
-        context['get_user_key'] = self._get_user_key # Pass the function to serializer so that it's reusable there :>
         return context
 
 
+    def _stream_notes(self, note_items, serializer_class):
+        """Stream notes as a JSON array row by row from a server-side cursor so memory usage doesn't grow with the number of notes."""
+        serializer = serializer_class() # One serializer instance is reused for every row
+        encoder = JSONEncoder()
+
+        def rows():
+            yield '['
+            for index, note_item in enumerate(note_items.iterator(chunk_size=settings.NOTES_STREAM_CHUNK_SIZE)):
+                yield (',' if index else '') + encoder.encode(serializer.to_representation(note_item))
+            yield ']'
+
+        return streaming_response(self.request, rows(), batch_size=settings.NOTES_STREAM_CHUNK_SIZE, content_type='application/json', status=status.HTTP_200_OK)
+
+
+    def _my_note_items(self, request):
+        """Return NoteItems of current user (with their notes) and serializer for them - shared by `me` and `me/changes`."""
+        user_key = get_request_user_key(request)
+        note_items = NoteItem.objects.filter(user_key=user_key) \
+            .select_related('note__owner') \
+            .only(*self.me_fields) \
+            .order_by('note__title', 'note__id') # Joining owner and loading only serialized columns keeps the number of queries constant regardless of number of notes
+
+        if request.query_params.get('fields') == 'summary':
+            return note_items.defer('note__body'), NoteSummarySerializer
+        return note_items, NoteMeSerializer
+
+
+    def _check_if_match(self, request, note):
+        """Reject the request with 412 if client sent If-Match header with ETag of an outdated version of the note."""
+        if_match = request.headers.get('If-Match')
+        if if_match and not etag_matches(if_match, note_etag(note)):
+            raise PreconditionFailed()
+
+
+    def _raw_request_data(self, request):
+        if isinstance(request.data, bytes):
+            return request.data
+        if request.stream is not None: # Non-empty request parsed by other than RawBytesParser (e.g. JSON sent to PUT)
+            raise UnsupportedMediaType(request.content_type)
+        return b'' # DRF gives empty dict instead of bytes for empty request
+
+
+    def _patch_body(self, request, note):
+        serializer = NoteBodyPatchSerializer(data=request.data, context={'note': note})
+        serializer.is_valid(raise_exception=True)
+        if serializer.validated_data['base_version'] != note.version:
+            raise PreconditionFailed()
+
+        try:
+            body = apply_edits(note.get_body(), serializer.validated_data['edits'])
+        except EditOutOfRange:
+            raise ValidationError({'edits': ['Edit is out of range of the body.']})
+        if len(body) > settings.NOTES_MAX_BODY_SIZE:
+            raise ValidationError({'edits': [f'Body cannot be larger than {settings.NOTES_MAX_BODY_SIZE} bytes.']})
+        if note.body_format == Note.TEXT_BODY:
+            try:
+                body.decode(settings.DEFAULT_ENCODING)
+            except UnicodeDecodeError:
+                raise ValidationError({'edits': ['Edits must not split multi-byte characters of text body.']})
+
+        note.set_body(body, note.body_format)
+        with transaction.atomic():
+            if not note.compare_and_swap(['body', 'body_format']):
+                raise PreconditionFailed()
+            record_revisions([note], request.user.id)
+            publish_notes_changed([note.pk])
+        return Response({'id': note.id, 'version': note.version, 'size': len(body)}, headers={'ETag': note_etag(note)})
+
+
+    def _serve_body(self, request, note, etag):
+        """Send note's raw body - whole or the byte range asked for in `Range` header. Bodies kept in the chunk store are streamed chunk by chunk."""
+        if note.body_size is not None:
+            size = note.body_size
+        else:
+            body = memoryview(note.get_body())
+            size = len(body)
+
+        try:
+            byte_range = parse_range(request.headers.get('Range'), size)
+        except RangeNotSatisfiable:
+            return HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers={'Content-Range': f'bytes */{size}'})
+
+        start, end = byte_range or (0, size - 1)
+        headers = {'ETag': etag, 'Accept-Ranges': 'bytes', 'Content-Length': str(end - start + 1)}
+        response_status = status.HTTP_200_OK
+        if byte_range:
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+            response_status = status.HTTP_206_PARTIAL_CONTENT
+
+        if note.body_size is not None:
+            return streaming_response(request, note.iter_body(start, end), content_type=RawBytesParser.media_type, status=response_status, headers=headers)
+        return HttpResponse(body[start:end + 1], content_type=RawBytesParser.media_type, status=response_status, headers=headers)
+
+
+    def _get_upload(self, request, note, upload_id):
+        return get_object_or_404(NoteUpload, id=upload_id, note=note, user=request.user.id) # Only the user who started the upload can continue it
+
+
+    def retrieve(self, request, *args, **kwargs):
+        """Get note. Response carries ETag - if client sends it back in If-None-Match and the note didn't change 304 is returned without the body."""
+        note = self.get_object()
+        etag = note_etag(note)
+        if etag_matches(request.headers.get('If-None-Match'), etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        serializer = self.get_serializer(note)
+        return Response(serializer.data, status=status.HTTP_200_OK, headers={'ETag': etag})
+
+
+    def update(self, request, *args, **kwargs):
+        """
+        Update note. Updates are compare-and-swap on note's version: if client sends If-Match header with ETag from previous response
+        and the note changed since then (or it changes concurrently) 412 is returned and nothing is written.
+        """
+        partial = kwargs.pop('partial', False)
+        note = self.get_object()
+        self._check_if_match(request, note)
+
+        serializer = self.get_serializer(note, data=request.data, partial=partial)
+        serializer.is_valid(raise_exception=True)
+        self.perform_update(serializer)
+        publish_notes_changed([note.pk])
+        return Response(serializer.data, status=status.HTTP_200_OK, headers={'ETag': note_etag(note)})
+
+
     @action(detail=False, methods=['GET'])
     def me(self, request):
-        """Get all notes that current user has access to"""
-        user_key = self._get_user_key([request.user.id])
-        note_items = NoteItem.objects.filter(user_key=user_key).select_related('note')
-        data = [NoteMeSerializer(note_item).data for note_item in note_items]
+        """
+        Get all notes that current user has access to.
+        Optional query params:
+        - `page_size`/`cursor` - keyset pagination ordered by (title, id), response is `{"next": <url>, "results": [...]}`
+        - `stream=true` - stream the whole list as JSON array without building it in memory
+        - `fields=summary` - return notes without bodies (bodies are not even loaded from db), fetch them later via `bodies` endpoint
+        Response carries ETag, if client sends it back in If-None-Match and nothing changed 304 is returned without loading any note.
+        """
+        note_items, serializer_class = self._my_note_items(request)
+        etag = note_list_etag(request, note_items)
+        if etag_matches(request.headers.get('If-None-Match'), etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        if request.query_params.get('stream') in ('1', 'true'):
+            response = self._stream_notes(note_items, serializer_class)
+            response['ETag'] = etag
+            return response
+
+        paginator = NoteKeysetPagination()
+        page = paginator.paginate_queryset(note_items, request, view=self)
+        if page is not None:
+            response = paginator.get_paginated_response(serializer_class(page, many=True).data)
+            response['ETag'] = etag
+            return response
+
+        data = serializer_class(note_items, many=True).data
+        return Response(data, status=status.HTTP_200_OK, headers={'ETag': etag})
+
+
+    @action(detail=False, methods=['GET'])
+    def search(self, request):
+        """
+        Full-text search in titles and bodies of unencrypted notes the user has access to (encrypted notes can only be searched on the client).
+        Query param `q` uses web search syntax (`"exact phrase"`, `or`, `-excluded`). Results are ordered by rank and paginated
+        (`page_size`/`cursor`, response is `{"next": <url>, "results": [...]}`), every result has `snippet` with highlighted matches.
+        """
+        serializer = NoteSearchQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        query = serializer.validated_data['q']
+
+        user_key = get_request_user_key(request)
+        search = search_query(query)
+        note_items = NoteItem.objects.filter(user_key=user_key, note__is_encrypted=False, note__search_vector=search) \
+            .annotate(rank=Cast(SearchRank(F('note__search_vector'), search), FloatField())) \
+            .select_related('note__owner') \
+            .only(*self.me_fields)
+
+        paginator = NoteSearchPagination()
+        page = paginator.paginate_queryset(note_items, request, view=self)
+        for note_item, snippet in zip(page, headlines([note_item.note.get_snippet_text() for note_item in page], query)):
+            note_item.snippet = snippet
+        return paginator.get_paginated_response(NoteSearchResultSerializer(page, many=True).data)
+
+
+    @action(detail=False, methods=['GET'], url_path='search/titles')
+    def search_titles(self, request):
+        """
+        Search titles of all notes the user has access to (titles of encrypted notes are not encrypted) - matches substrings (e.g. prefixes)
+        and similar words (typos), best matches first. Query params: `q`, `limit` (default NOTES_PAGE_SIZE). Served by trigram index.
+        """
+        serializer = NoteTitleSearchQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        query, limit = serializer.validated_data['q'], serializer.validated_data['limit']
+
+        note_items = NoteItem.objects.filter(user_key=get_request_user_key(request)) \
+            .alias(upper_title=Upper('note__title')) \
+            .filter(Q(upper_title__contains=query.upper()) | Q(upper_title__trigram_word_similar=query)) \
+            .annotate(similarity=TrigramWordSimilarity(query, 'note__title')) \
+            .select_related('note__owner') \
+            .only(*self.me_fields) \
+            .defer('note__body') \
+            .order_by('-similarity', 'note__title', 'note__id')
+        return Response(NoteTitleSearchResultSerializer(note_items[:limit], many=True).data, status=status.HTTP_200_OK)
+
+
+    @action(detail=False, methods=['POST'], url_path='search/blind')
+    def blind_search(self, request):
+        """
+        Search notes by blind index tokens (keyed HMACs of searched words computed the same way as tokens uploaded with notes).
+        Expects `{"tokens": [<base64>, ...], "match": "all"|"any"}`, returns `{"ids": [...]}` of current user's notes having all (or any) of the tokens.
+        """
+        serializer = BlindSearchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        tokens = set(serializer.validated_data['tokens'])
+
+        matches = NoteSearchToken.objects.filter(user_key=get_request_user_key(request), token__in=tokens).values('note_item__note')
+        if serializer.validated_data['match'] == BlindSearchSerializer.ALL:
+            matches = matches.annotate(matched=Count('token')).filter(matched=len(tokens)) # Tokens of a NoteItem are unique
+        note_ids = matches.order_by().distinct().values_list('note_item__note', flat=True)
+        return Response({'ids': [str(note_id) for note_id in note_ids]}, status=status.HTTP_200_OK)
+
+
+    @action(detail=False, methods=['GET'], url_path='me/changes')
+    def me_changes(self, request):
+        """
+        Delta sync - get notes of current user that changed after `since` cursor (value of `cursor` returned by the previous call, 0 for the first one).
+        `changed` holds notes that were created, updated or shared with user (or user's permission/key changed) and `deleted`
+        holds ids of notes that were deleted or unshared. Supports `fields=summary` same as `me`.
+        Returned cursor stays below transactions that are still in flight (they can commit changes older than the ones already visible),
+        so notes changed by transactions that committed meanwhile may be returned once more by the next call.
+        """
+        serializer = NoteChangesQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        since = serializer.validated_data['since']
+        settled = settled_change_seq() # Read before the changes - everything up to it is visible to the queries below
+
+        note_items, serializer_class = self._my_note_items(request)
+        note_items = list(note_items.filter(Q(change_seq__gt=since) | Q(note__change_seq__gt=since)))
+        user_key = get_request_user_key(request)
+        tombstones = NoteTombstone.objects.filter(user_key_id=user_key.pk, change_seq__gt=since).values_list('note_id', flat=True) if user_key else []
+
+        changed_note_ids = {note_item.note_id for note_item in note_items}
+        deleted_note_ids = {str(note_id) for note_id in tombstones if note_id not in changed_note_ids} # Note could have been unshared and shared again
 
+        return Response({
+            'cursor': max(since, settled),
+            'changed': serializer_class(note_items, many=True).data,
+            'deleted': list(deleted_note_ids),
+        }, status=status.HTTP_200_OK)
+
+
+    @action(detail=True, methods=['GET', 'PUT', 'PATCH'], url_path='body', parser_classes=[RawBytesParser, JSONParser])
+    def raw_body(self, request, pk=None):
+        """
+        Binary transport of note's body - raw bytes as `application/octet-stream` with no base64/UTF-8 round trips.
+        GET: Download the body as it was written (supports `Range` header and ETag/If-None-Match same as retrieve)
+        PUT: Replace the body with request's bytes (supports If-Match). Such body is marked as binary and returned as base64 by JSON endpoints
+        PATCH: Apply JSON diff `{"base_version": <version>, "edits": [{"offset", "length", "data"}, ...]}` to the body, so that only the edited
+               bytes are sent. Returns 412 if the note is no longer at base_version. Encrypted notes replace the changed encrypted chunks this way
+        """
+        note = self.get_object()
+
+        if request.method == 'PATCH':
+            return self._patch_body(request, note)
+
+        if request.method == 'GET':
+            etag = note_etag(note)
+            if etag_matches(request.headers.get('If-None-Match'), etag):
+                return HttpResponse(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+            return self._serve_body(request, note, etag)
+
+        self._check_if_match(request, note)
+        note.set_body(self._raw_request_data(request), Note.BINARY_BODY)
+        with transaction.atomic():
+            if not note.compare_and_swap(['body', 'body_format']):
+                raise PreconditionFailed()
+            record_revisions([note], request.user.id)
+            publish_notes_changed([note.pk])
+        return Response(status=status.HTTP_204_NO_CONTENT, headers={'ETag': note_etag(note)})
+
+
+    @action(detail=True, methods=['POST'])
+    def uploads(self, request, pk=None):
+        """
+        Start chunked (resumable) upload of note's body - for bodies too large to send in one request. The flow is:
+        1. POST `uploads/` (supports If-Match) - returns upload `id` and `chunk_size`
+        2. PUT `uploads/<id>/parts/<index>/` - raw bytes of every part (`chunk_size` bytes each but the last), in any order, retried parts are replaced
+        3. GET `uploads/<id>/` - list of received parts, to resume an interrupted upload
+        4. POST `uploads/<id>/commit/` with `{"parts": <number of parts>, "sha256": <hex digest of the whole body>}`
+        Body that fits in one part is stored as if it was sent to `body` endpoint, parts of larger ones become chunks of the body as they are
+        (so the body is never loaded to memory as a whole). Identical parts are stored only once.
+        """
+        note = self.get_object()
+        self._check_if_match(request, note)
+
+        NoteUpload.objects.filter(user=request.user.id, created_at__lt=timezone.now() - timedelta(seconds=settings.NOTES_UPLOAD_EXPIRY)).delete() # Abandoned uploads are cleaned up here
+        upload = NoteUpload.objects.create(note=note, user_id=request.user.id, base_version=note.version, chunk_size=settings.NOTES_BODY_CHUNK_SIZE)
+
+        return Response(NoteUploadSerializer(upload).data, status=status.HTTP_201_CREATED)
+
+
+    @action(detail=True, methods=['GET', 'DELETE'], url_path=UPLOAD_URL)
+    def upload(self, request, pk=None, upload_id=None):
+        """
+        GET: Get upload with list of received parts
+        DELETE: Abort the upload
+        """
+        note = self.get_object()
+        upload = self._get_upload(request, note, upload_id)
+
+        if request.method == 'DELETE':
+            upload.delete()
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
+        data = NoteUploadSerializer(upload).data
+        data['parts'] = [{'index': index, 'size': size} for index, size in upload.chunks.order_by('index').values_list('index', 'blob__size')]
         return Response(data, status=status.HTTP_200_OK)
 
 
+    @action(detail=True, methods=['PUT'], url_path=UPLOAD_URL + r'/parts/(?P<index>[0-9]+)', parser_classes=[RawBytesParser])
+    def upload_part(self, request, pk=None, upload_id=None, index=None):
+        """Upload one part of the body as raw bytes."""
+        note = self.get_object()
+        upload = self._get_upload(request, note, upload_id)
+
+        data = self._raw_request_data(request)
+        if len(data) > upload.chunk_size:
+            return Response({'detail': f'Part cannot be larger than {upload.chunk_size} bytes.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        part_digest = digest(data)
+        NoteBodyBlob.objects.bulk_create([NoteBodyBlob.from_chunk(part_digest, data, compress=False)], ignore_conflicts=True) # Part may be in the store already
+        NoteBodyChunk.objects.update_or_create(upload=upload, index=int(index), defaults={'note': note, 'blob_id': part_digest, 'offset': int(index) * upload.chunk_size})
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+    @action(detail=True, methods=['POST'], url_path=UPLOAD_URL + r'/commit')
+    def upload_commit(self, request, pk=None, upload_id=None):
+        """Verify uploaded parts against the checksum and replace note's body with them. Returns 412 if the note was changed since the upload started."""
+        note = self.get_object()
+        upload = self._get_upload(request, note, upload_id)
+
+        serializer = NoteUploadCommitSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        parts = serializer.validated_data['parts']
+
+        sizes = dict(upload.chunks.values_list('index', 'blob__size'))
+        if sorted(sizes) != list(range(parts)):
+            return Response({'parts': ['Uploaded parts don\'t match the number of parts.'], 'missing': sorted(set(range(parts)) - set(sizes))}, status=status.HTTP_400_BAD_REQUEST)
+        if any(sizes[index] != upload.chunk_size for index in range(parts - 1)):
+            return Response({'parts': [f'Every part but the last one must have {upload.chunk_size} bytes.']}, status=status.HTTP_400_BAD_REQUEST)
+        if upload_sha256(upload) != serializer.validated_data['sha256'].lower():
+            return Response({'sha256': ['Checksum doesn\'t match uploaded data.']}, status=status.HTTP_400_BAD_REQUEST)
+        if note.version != upload.base_version:
+            raise PreconditionFailed()
+
+        with transaction.atomic():
+            if parts == 1: # Body fitting in one part is stored the same way as body sent in one request
+                note.set_body(decompress_chunk(*upload.chunks.values_list('blob__data', 'blob__is_compressed').get()), Note.BINARY_BODY)
+            else:
+                note.body = b''
+                note.body_format = Note.CHUNKED_BODY
+                note.body_size = sum(sizes.values())
+            if not note.compare_and_swap(['body', 'body_format']):
+                raise PreconditionFailed()
+            if note.body_format == Note.CHUNKED_BODY:
+                NoteBodyChunk.of_bodies([note]).delete() # Manifest of the previous body
+                upload.chunks.update(upload=None) # Uploaded parts become the body without copying any data
+            upload.delete()
+            record_revisions([note], request.user.id)
+            publish_notes_changed([note.pk])
+
+        return Response({'version': note.version, 'size': sum(sizes.values())}, status=status.HTTP_200_OK, headers={'ETag': note_etag(note)})
+
+
+    @action(detail=True, methods=['GET'])
+    def revisions(self, request, pk=None):
+        """List revisions of the note, newest first (without bodies - get them one by one via `revisions/<version>/`)."""
+        note = self.get_object()
+        revisions = note.revisions.select_related('author').defer('data').order_by('-version')
+        return Response(NoteRevisionSerializer(revisions, many=True).data)
+
+
+    @action(detail=True, methods=['GET'], url_path=r'revisions/(?P<version>[0-9]+)')
+    def revision(self, request, pk=None, version=None):
+        """
+        Get the note as it was after given version was written. Revisions of encrypted notes are encrypted with the key that was used at that time,
+        so they can't be decrypted after encryption was changed.
+        """
+        note = self.get_object()
+        revision = get_object_or_404(NoteRevision.objects.select_related('author'), note=note, version=version)
+        return Response(NoteRevisionDetailSerializer(revision).data)
+
+
+    @action(detail=True, methods=['PUT'])
+    def search_tokens(self, request, pk=None):
+        """
+        Replace current user's blind index tokens of the note (`{"tokens": [<base64>, ...]}`). Tokens can also be sent along with the body on create/update,
+        this endpoint lets users with read permission index notes shared with them.
+        """
+        note = self.get_object()
+        serializer = NoteSearchTokensSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        note_item = NoteItem.objects.filter(note=note, user_key=get_request_user_key(request)).first()
+        if not note_item:
+            raise NotFound('Note is not shared with this user.')
+        with transaction.atomic():
+            NoteSearchToken.replace(note_item, serializer.validated_data['tokens'])
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+    @action(detail=True, methods=['GET'], url_path='key')
+    def raw_key(self, request, pk=None):
+        """Download current user's wrapped symmetric key of the note as raw bytes (`application/octet-stream`)."""
+        note = self.get_object()
+        user_key = get_request_user_key(request)
+        encryption_key = NoteItem.objects.filter(note=note, user_key=user_key).values_list('encryption_key', flat=True).first()
+        if not encryption_key:
+            raise NotFound('Note has no encryption key for this user.')
+        return HttpResponse(encryption_key, content_type=RawBytesParser.media_type)
+
+
+    @action(detail=False, methods=['POST'])
+    def bodies(self, request):
+        """Get bodies of many notes at once. Expects `{"ids": [<note_id>, ...]}`, notes the user has no access to are skipped."""
+        serializer = NoteBodiesRequestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        user_key = get_request_user_key(request)
+        if not user_key: # User without a key has access to no note (filtering on None would match notes without any NoteItem)
+            return Response([], status=status.HTTP_200_OK)
+        notes = Note.objects.filter(id__in=serializer.validated_data['ids'], noteitem__user_key=user_key).only('id', 'body', 'body_format', 'body_size')
+
+        return Response(NoteBodySerializer(notes, many=True).data, status=status.HTTP_200_OK)
+
+
     # One cannot separate changing body from changing the encryption state from sending a key as those operations are tightly coupled - encrypted text without the key is useless and vice versa.
     # Marking encrypted text as not encrypted (without updating the text) would also render the text useless thus all those operations have to be combined in one endpoint
     # TODO: THIS SHOULD SET ENCRYPTION FOR ALL USERS THAT HAVE ACCESS TO THE NOTE!
@@ -93,6 +550,7 @@ class NotesViewSet(CreateModelMixin, RetrieveModelMixin, UpdateModelMixin, Destr
         Also encrypted note's body differs from unencrypted thus new body is mandatory to store along those keys).
         """
         note = self.get_object() # Automatically get the note by pk from URL
+        self._check_if_match(request, note)
 
         serializer = ChangeEncryptionSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -104,26 +562,31 @@ class NotesViewSet(CreateModelMixin, RetrieveModelMixin, UpdateModelMixin, Destr
         if is_encrypted and not encryption_keys:
             return Response({'encryption_keys': ['This field is required if is_encrypted is true']})
 
-        note.body = new_note_body.encode(settings.DEFAULT_ENCODING) # Set new body
         note.is_encrypted = is_encrypted # Set encrypted state
-        note.save() # Save this note in db (I always forget)
+        note.set_text_body(new_note_body.encode(settings.DEFAULT_ENCODING)) # Set new body (compressed if note is no longer encrypted)
 
         # Disable encryption
         if not is_encrypted:
-            NoteItem.objects.filter(note=note).update(encryption_key=None) # If id_encrypted is set to false (notes are no longer encrypted) than delete encryption_keys for all users who have access to this nore as they (keys) are no longer needed
+            with transaction.atomic(): # New body and removal of the keys are saved together or not at all
+                if not note.compare_and_swap(['body', 'body_format', 'is_encrypted']): # Save this note in db (I always forget) unless it was changed concurrently
+                    raise PreconditionFailed()
+                users_affected = NoteItem.objects.filter(note=note).update(encryption_key=None, pending_encryption_key=None) # If id_encrypted is set to false (notes are no longer encrypted) than delete encryption_keys for all users who have access to this nore as they (keys) are no longer needed
+                NoteSearchToken.objects.filter(note_item__note=note).delete() # Plaintext notes are searched by full-text search
+                record_revisions([note], request.user.id)
+                publish_notes_changed([note.pk])
             return Response({
                 'detail': 'Encryption disabled successfully',
                 'note_id': str(note.id),
                 'is_encrypted': is_encrypted,
-                'users_affected': NoteItem.objects.filter(note=note).count()
+                'users_affected': users_affected
             }, status=status.HTTP_200_OK)
 
 
         # Enable/Update encryption:
-        note_items = NoteItem.objects.filter(note=note).select_related('user_key').all() # Query for all NoteItems associated with current note and get related UserKeys in order to mathc user ids
-        new_symmetric_keys_lookup = {key.get('user_id'): key.get('key') for key in encryption_keys} # Create a lookup dict from JSON data for O(n) complexity. This line results in {user_id: symmetric_key} dictionary
+        note_items = list(NoteItem.objects.filter(note=note).select_related('user_key').only('id', 'encryption_key', 'user_key', 'user_key__user')) # Query for all NoteItems associated with current note and get related UserKeys (user ids only) in order to match user ids
+        new_symmetric_keys_lookup = {str(key.get('user_id')): key.get('key') for key in encryption_keys} # Create a lookup dict from JSON data for O(n) complexity. This line results in {user_id: symmetric_key} dictionary
 
-        required_user_ids = {str(note_item.user_key.user.id) for note_item in note_items} # Get all user IDs that have access to the note
+        required_user_ids = {str(note_item.user_key.user_id) for note_item in note_items} # Get all user IDs that have access to the note
         provided_user_ids = set(new_symmetric_keys_lookup.keys()) # Get all user IDs that were provided in the request
         missing_user_ids = required_user_ids - provided_user_ids # Find missing user IDs
 
@@ -133,15 +596,20 @@ class NotesViewSet(CreateModelMixin, RetrieveModelMixin, UpdateModelMixin, Destr
                 'detail': f'Encryption keys required for all users with access to this note',
                 'required_users': list(required_user_ids),
                 'missing_users': list(missing_user_ids)
-            }, status=status.HTTP_400_BAD_REQUEST) # Return info with all missing user ids
+            }, status=status.HTTP_400_BAD_REQUEST) # Return info with all missing user ids - nothing was written to db yet
 
-        # Update symmetric keys in db:
         for note_item in note_items:
-            note_item_user_id = str(note_item.user_key.user.id) # Get user id from current NoteItem
-            new_symmetric_key = new_symmetric_keys_lookup.get(note_item_user_id) # Get encrypted symmtric key associated with user id; using `[]` instead of .get() method as I want to raise excption if encryption keys were NOT provided for ALL users 
-            if new_symmetric_key:
-                note_item.encryption_key = new_symmetric_key.encode(settings.DEFAULT_ENCODING)
-                note_item.save()
+            note_item.encryption_key = new_symmetric_keys_lookup[str(note_item.user_key.user_id)].encode(settings.DEFAULT_ENCODING) # Every user has a key here (checked above)
+            note_item.pending_encryption_key = None # Key staged by user's key rotation wraps the replaced symmetric key - it has to be re-wrapped again
+
+        # Save new body and all wrapped keys atomically - keys are written with one UPDATE statement regardless of the number of users
+        with transaction.atomic():
+            lock_key_holders([note_item.user_key.user_id for note_item in note_items]) # Staged keys of a user's rotation cannot be swapped in meanwhile
+            if not note.compare_and_swap(['body', 'body_format', 'is_encrypted']):
+                raise PreconditionFailed()
+            NoteItem.objects.bulk_update(note_items, ['encryption_key', 'pending_encryption_key'])
+            record_revisions([note], request.user.id)
+            publish_note_event(NOTE_CHANGED, note.pk, [note_item.user_key.user_id for note_item in note_items])
 
         return Response({
             'detail': 'Encryption updated successfully',
@@ -160,7 +628,7 @@ class NotesViewSet(CreateModelMixin, RetrieveModelMixin, UpdateModelMixin, Destr
         note = self.get_object()
 
         if request.method == 'GET': # Return list of users with access to this note
-            note_items = NoteItem.objects.filter(note=note).select_related('user_key__user')
+            note_items = NoteItem.objects.filter(note=note).select_related('user_key__user').order_by('user_key__user__username')
             shared_users = [
                 {
                     'user_id': item.user_key.user.id,
@@ -182,37 +650,172 @@ class NotesViewSet(CreateModelMixin, RetrieveModelMixin, UpdateModelMixin, Destr
             encryption_key = request.data.get('encryption_key')
             permission = request.data.get('permission')
 
-            user_key_target = self._get_user_key([target_user]) # This is a UserKey instance of a user that the note will be shared to
-            user_key_current = self._get_user_key([request.user.id]) # This is a UserKey of a user that shares the note
-
-            # Verify if the target user has already access to this note
-            if (note_item := NoteItem.objects.filter(note=note, user_key=user_key_target)).exists():
-                obj = note_item.first()
-                if obj.permission != 'O':
-                    obj.permission = permission
-                    obj.save()
-                return Response({'detail': f'Updated {target_user} permissions to the note'}, status=status.HTTP_200_OK)
-
-            if note.is_encrypted and not user_key_target:
-                return Response({'non_field_errors': [f'Public key is required for encrypted notes.']}, status=status.HTTP_400_BAD_REQUEST)
-
-            if note.is_encrypted:
-                new_note_item = NoteItem.objects.create(
-                    note=note,
-                    user_key=user_key_target,
-                    encryption_key=encryption_key.encode(settings.DEFAULT_ENCODING), # Only for encrypted notes set encryption_key, empty otherwise
-                    permission=permission
-                )
-            else:
-                new_note_item = NoteItem.objects.create(
-                    note=note,
-                    user_key=user_key_target,
-                    permission=permission
-                )
+            with transaction.atomic():
+                lock_key_holders([target_user]) # Target user's key rotation cannot commit (and move their NoteItems) until the new one is saved
+                user_key_target = self._get_user_key([target_user]) # This is a UserKey instance of a user that the note will be shared to
+
+                # Verify if the target user has already access to this note
+                if (note_item := NoteItem.objects.filter(note=note, user_key=user_key_target)).exists():
+                    obj = note_item.first()
+                    if obj.permission != 'O':
+                        obj.permission = permission
+                        obj.save()
+                    return Response({'detail': f'Updated {target_user} permissions to the note'}, status=status.HTTP_200_OK)
+
+                if note.is_encrypted and not user_key_target:
+                    return Response({'non_field_errors': [f'Public key is required for encrypted notes.']}, status=status.HTTP_400_BAD_REQUEST)
+
+                if note.is_encrypted:
+                    new_note_item = NoteItem.objects.create(
+                        note=note,
+                        user_key=user_key_target,
+                        encryption_key=encryption_key.encode(settings.DEFAULT_ENCODING), # Only for encrypted notes set encryption_key, empty otherwise
+                        permission=permission
+                    )
+                else:
+                    new_note_item = NoteItem.objects.create(
+                        note=note,
+                        user_key=user_key_target,
+                        permission=permission
+                    )
 
             return Response({'detail': f'Note shared: {new_note_item.id}'}, status=status.HTTP_201_CREATED)
 
 
+    @action(detail=True, methods=['POST'])
+    def bulk_share(self, request, pk=None):
+        """
+        Share note with many users at once. Expects `{"shares": [{"user": <user_id>, "permission": "R", "encryption_key": "..."}, ...]}`
+        (`encryption_key` is required for encrypted notes only). All changes are applied in a single transaction and the response holds result for every user.
+        """
+        note = self.get_object()
+
+        serializer = BulkShareNoteSerializer(data=request.data, context={'note': note})
+        serializer.is_valid(raise_exception=True)
+        shares = serializer.validated_data['shares']
+
+        UserKey = apps.get_model(settings.AUTH_USER_KEY_MODEL)
+        with transaction.atomic():
+            lock_key_holders([share['user'] for share in shares]) # Key rotations of target users cannot commit until their NoteItems are saved
+            user_keys = {user_key.user_id: user_key for user_key in UserKey.objects.active().filter(user__in=[share['user'] for share in shares])} # All target UserKeys in one query
+            existing_note_items = {note_item.user_key.user_id: note_item for note_item in NoteItem.objects.filter(note=note, user_key__in=user_keys.values()).select_related('user_key')}
+
+            results = []
+            note_items_to_create = []
+            note_items_to_update = []
+            for share in shares:
+                user_id = share['user']
+                result = {'user': str(user_id)}
+                if user_id not in user_keys:
+                    result.update({'status': 'failed', 'detail': 'User has no public key'})
+                elif note_item := existing_note_items.get(user_id):
+                    if note_item.permission == NoteItem.OWNER_PERMISSION or note_item.permission == share['permission']:
+                        result.update({'status': 'unchanged'}) # Owner's permissions are never changed
+                    else:
+                        note_item.permission = share['permission']
+                        note_item.change_seq = NextChangeSeq() # Bulk operations bypass save() thus change sequence is bumped by hand
+                        note_items_to_update.append(note_item)
+                        result.update({'status': 'updated'})
+                else:
+                    note_items_to_create.append(NoteItem(
+                        note=note,
+                        user_key=user_keys[user_id],
+                        encryption_key=share['encryption_key'].encode(settings.DEFAULT_ENCODING) if note.is_encrypted else None, # Only for encrypted notes set encryption_key, empty otherwise
+                        permission=share['permission'],
+                        change_seq=NextChangeSeq()
+                    ))
+                    result.update({'status': 'created'})
+                results.append(result)
+
+            NoteItem.objects.bulk_create(note_items_to_create)
+            NoteItem.objects.bulk_update(note_items_to_update, ['permission', 'change_seq'])
+            invalidate_permissions([(note_item.user_key.user_id, note.pk) for note_item in note_items_to_create + note_items_to_update]) # Bulk operations don't send signals
+            publish_note_event(NOTE_SHARED, note.pk, [note_item.user_key.user_id for note_item in note_items_to_create])
+            publish_note_event(NOTE_CHANGED, note.pk, [note_item.user_key.user_id for note_item in note_items_to_update])
+
+        return Response({'results': results}, status=status.HTTP_200_OK)
+
+
+    @action(detail=False, methods=['POST'])
+    def batch(self, request):
+        """
+        Create, update and delete many notes in one request. Expects `{"operations": [{"op": "create"|"update"|"delete", ...}, ...]}` where
+        create takes `title`, `body`, `is_encrypted`, `encryption_key`, update takes `id`, `title`, `body` and delete takes `id`.
+        Permissions are checked for all notes with one query and all allowed operations run in one transaction.
+        Response holds result (with HTTP status code) for every operation in the same order.
+        """
+        serializer = NoteBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        operations = serializer.validated_data['operations']
+
+        user_key = get_request_user_key(request)
+        if not user_key:
+            return Response({'non_field_errors': ['Public key is required to manage notes.']}, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            note_ids = [operation['id'] for operation in operations if operation['op'] != NoteBatchOperationSerializer.CREATE]
+            notes = {note.id: note for note in Note.objects.filter(id__in=note_ids).defer('body').order_by('id').select_for_update(of=('self',))} # Locked (in id order to avoid deadlocks) until commit, so version checks below hold when the notes are written
+            permissions = dict(NoteItem.objects.filter(note__in=note_ids, user_key=user_key).values_list('note', 'permission'))
+
+            results = []
+            notes_to_create = []
+            note_items_to_create = []
+            notes_to_update = []
+            notes_to_delete = []
+            for operation in operations:
+                op = operation['op']
+                if op == NoteBatchOperationSerializer.CREATE:
+                    note = Note(owner_id=request.user.id, title=operation['title'], is_encrypted=operation['is_encrypted'], change_seq=NextChangeSeq())
+                    note.set_text_body(operation['body'])
+                    notes_to_create.append(note)
+                    note_items_to_create.append(NoteItem(
+                        note=note,
+                        user_key=user_key,
+                        encryption_key=operation['encryption_key'].encode(settings.DEFAULT_ENCODING) if note.is_encrypted else None,
+                        permission=NoteItem.OWNER_PERMISSION
+                    ))
+                    results.append({'op': op, 'id': str(note.id), 'status': status.HTTP_201_CREATED})
+                    continue
+
+                note = notes.get(operation['id'])
+                if not note:
+                    results.append({'op': op, 'id': str(operation['id']), 'status': status.HTTP_404_NOT_FOUND})
+                    continue
+
+                is_owner = note.owner_id == request.user.id
+                permission = permissions.get(note.id)
+                can_update = op == NoteBatchOperationSerializer.UPDATE and (is_owner or permission in ['W', 'S', 'O'])
+                if can_update and operation.get('version', note.version) != note.version:
+                    results.append({'op': op, 'id': str(note.id), 'status': status.HTTP_412_PRECONDITION_FAILED}) # Client edited an outdated version
+                elif can_update:
+                    note.title = operation['title']
+                    note.set_text_body(operation['body'])
+                    note.version = F('version') + 1
+                    note.change_seq = NextChangeSeq() # Bulk operations bypass save() thus change sequence is bumped by hand
+                    notes_to_update.append(note)
+                    results.append({'op': op, 'id': str(note.id), 'status': status.HTTP_200_OK})
+                elif op == NoteBatchOperationSerializer.DELETE and (is_owner or permission == 'O'):
+                    notes_to_delete.append(note.id)
+                    results.append({'op': op, 'id': str(note.id), 'status': status.HTTP_204_NO_CONTENT})
+                else:
+                    results.append({'op': op, 'id': str(note.id), 'status': status.HTTP_403_FORBIDDEN})
+
+            Note.objects.bulk_create(notes_to_create)
+            NoteItem.objects.bulk_create(note_items_to_create)
+            Note.objects.bulk_update(notes_to_update, ['title', 'body', 'body_format', 'body_size', 'version', 'change_seq'])
+            write_body_chunks(notes_to_create + notes_to_update) # Bulk operations bypass save()
+            write_search_vectors(notes_to_create + notes_to_update)
+            versions = dict(Note.objects.filter(id__in=[note.id for note in notes_to_update]).values_list('id', 'version'))
+            for note in notes_to_update:
+                note.version = versions[note.id] # Resolve F('version') + 1
+            record_revisions(notes_to_create + notes_to_update, request.user.id)
+            if notes_to_delete:
+                Note.objects.filter(id__in=notes_to_delete).delete() # Users are notified about deleted notes by NoteItem signals
+            publish_notes_changed([note.pk for note in notes_to_create + notes_to_update]) # Bulk operations don't send signals
+
+        return Response({'results': results}, status=status.HTTP_200_OK)
+
+
     @action(detail=False, methods=['DELETE'])
     def remove_access(self, request):
         """Remove a user's access to a note by deleting their NoteItem."""
@@ -223,18 +826,13 @@ class NotesViewSet(CreateModelMixin, RetrieveModelMixin, UpdateModelMixin, Destr
         user_id = serializer.validated_data['user']
 
         try:
-            UserKey = apps.get_model(settings.AUTH_USER_KEY_MODEL)
-            user_key = UserKey.objects.get(user=user_id)
-        
-            deleted_count, _ = NoteItem.objects.filter(note_id=note_id, user_key=user_key).delete()
+            deleted_count, _ = NoteItem.objects.filter(note_id=note_id, user_key__user=user_id).delete() # Access given to any of user's keys (active or retained ones) is removed
 
             if deleted_count == 0:
                 return Response({'detail': 'User doesn\'t have access to the note'}, status=status.HTTP_404_NOT_FOUND)
 
             return Response({'detail': 'Access removed successfully'}, status=status.HTTP_204_NO_CONTENT)
 
-        except UserKey.DoesNotExist:
-            return Response({'detail': 'UserKey not found'}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             return Response({'detail': f'An error occurred: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
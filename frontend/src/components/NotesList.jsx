@@ -29,6 +29,13 @@ const NotesList = () => {
             return;
         }
 
+        if (item.body === null) { // Body was not loaded - sending it back would overwrite the note
+            setRenameError('Note body is not loaded yet');
+            setIsRenaming(null);
+            setNewTitle("");
+            return;
+        }
+
         const status = await saveUpdateNote(item.id, { title: newTitle, body: item.body });
         if (status.error) {
             setRenameError(status.error);
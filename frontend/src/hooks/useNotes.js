@@ -18,6 +18,12 @@ const useNotes = () => {
 
         try {
             const response = await NotesService.fetchNotes();
+            const withoutBody = response.data.filter(note => note.body === null && note.body_size !== null); // Large bodies are not part of the list
+            if (withoutBody.length) {
+                const bodies = await NotesService.fetchBodies(withoutBody.map(note => note.id));
+                const bodyById = new Map(bodies.data.map(note => [note.id, note.body]));
+                withoutBody.forEach(note => { note.body = bodyById.get(note.id) ?? null });
+            }
             // console.log(response.data);
             const notesWithCorrectKey = await manageEncryptedSymmetricKey(response.data) //* response.data is a list of notes. Each note comes with symmetric encrypted key. In order to use this key (decrypt notes) first one must decrypt and import those symmetric keys 
             decryptAllNotes(notesWithCorrectKey)
@@ -122,13 +128,13 @@ const useNotes = () => {
     }, []);
 
     // This is used to retrieve list of users to whom note may be shared to. Thus this function should be in useNotes.jsx and not in useAuth.jsx
-    const listUsers = useCallback(async () => {
+    const listUsers = useCallback(async (search) => {
         setIsLoading(true);
         setError(null);
 
         try {
-            const response = await UserService.getUsersList();
-            return { success: true, data: response.data };
+            const response = await UserService.getUsersList(search ? { search } : undefined);
+            return { success: true, data: response.data.results, next: response.data.next };
         } catch (err) {
             const errorMessage = err.response?.data?.message || 'Failed to obtain list of users';
             setError(errorMessage);
@@ -138,6 +144,27 @@ const useNotes = () => {
         }
     }, []);
 
+    const getPublicKey = useCallback(async (userId) => {
+        setIsLoading(true);
+        setError(null);
+
+        try {
+            const response = await UserService.getPublicKeys([userId]);
+            const publicKey = response.data.find(key => key.user === userId); // Users without a verified key are left out of the lookup
+            if (!publicKey) {
+                setError('User has no public key yet');
+                return { success: false, error: 'User has no public key yet' };
+            }
+            return { success: true, data: publicKey };
+        } catch (err) {
+            const errorMessage = err.response?.data?.message || 'Failed to obtain public key of the user';
+            setError(errorMessage);
+            return { success: false, error: errorMessage };
+        } finally {
+            setIsLoading(false);
+        }
+    }, []);
+
     const shareNote = useCallback(async (noteId, encryption_key, user, permission) => {
         setIsLoading(true);
         setError(null);
@@ -170,7 +197,7 @@ const useNotes = () => {
         }
     }
 
-    return { fetchNotes, createNote, createEncryptedNote, saveUpdateNote, deleteNote, removeAccess, listUsers, shareNote, handleNewNoteCreation, isLoading, error }
+    return { fetchNotes, createNote, createEncryptedNote, saveUpdateNote, deleteNote, removeAccess, listUsers, getPublicKey, shareNote, handleNewNoteCreation, isLoading, error }
 }
 
 export default useNotes
\ No newline at end of file
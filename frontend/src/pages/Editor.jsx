@@ -25,7 +25,7 @@ const Editor = () => {
         navigate('/notes')
     }, [navigate])
 
-    if (!currentNote) {
+    if (!currentNote || currentNote.body === null) { // Body not loaded (large notes are fetched separately) - empty editor would overwrite it on save
         return <Blank />
     }
 
@@ -6,6 +6,10 @@ class NotesService {
         return apiClient.get('/notes/notes/me/');
     }
 
+    fetchBodies(ids) {
+        return apiClient.post('/notes/notes/bodies/', { ids: ids }); // Bodies that are not included in the list of notes (large ones)
+    }
+
     createNote(data) {
         return apiClient.post('/notes/notes/', data);
     }
@@ -3,8 +3,12 @@ import { apiClient } from "@/services/ApiClient"
 
 class UserService {
 
-    getUsersList() {
-        return apiClient.get('/users/users/'); // This endpoint is used for geting users list in order to share notes to other users
+    getUsersList(params) {
+        return apiClient.get('/users/users/', { params }); // This endpoint is used for geting users list in order to share notes to other users (params: search, page_size, cursor)
+    }
+
+    getPublicKeys(userIds) {
+        return apiClient.get('/users/keys/lookup/', { params: { users: userIds.join(',') } }); // Public keys of users the note is going to be shared with
     }
 
     createUser(data) {